@@ -8,17 +8,30 @@ from dotenv import load_dotenv
 import urllib.parse as urlparse
 import io
 import time
-import streamlit as st
 import logging
+import contextvars
+from contextlib import contextmanager
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from Alertlab_api.aws_utils import get_s3_client_and_bucket_name, upload_log_to_s3, get_logger_and_log_stream
+from Alertlab_api import timeseries_store, rollups
+from Alertlab_api.rate_limiter import get_scheduler
+from Alertlab_api.http_client import get_client
+from Alertlab_api.token_manager import TokenManager
+from Alertlab_api import data_budget, range_chunking, shared_cache
+from Alertlab_api.data_budget import get_ledger, DataBudgetExceeded
+from Alertlab_api.instrumentation import span, timed, url_template
+from Alertlab_api.timeseries_batch import TimeseriesBatch
+from Alertlab_api.timeseries_decode import decode_timeseries_stream, CHUNK_BYTES
 
 load_dotenv()  # Still needed for local development
 
 
 TOKEN_KEY = 'token.txt'
+# Sensors fetched at once by get_list_timeseries. The scheduler still caps the overall request rate.
+TIMESERIES_WORKERS = int(os.getenv("ALERTLABS_TIMESERIES_WORKERS", "4"))
 logger, log_stream = get_logger_and_log_stream()
 
 def secrets_file_exists():
@@ -28,6 +41,8 @@ def secrets_file_exists():
 def get_secret(key):
     """Unified secrets loader for Streamlit Cloud or local .env."""
     if secrets_file_exists():
+        # Imported here so headless tools (e.g. the backfill daemon) never load Streamlit.
+        import streamlit as st
         try:
             value = st.secrets[key]
             logger.info(f"Loaded {key} from Streamlit secrets.")
@@ -39,10 +54,54 @@ def get_secret(key):
     
     return os.getenv(key)
 
+def _request(method, url, priority=None, **kwargs):
+    """
+    Send one HTTP request to AlertLabs through the shared rate-limit scheduler (see rate_limiter.py)
+    on the pooled keep-alive client (see http_client.py), which also applies the default timeouts.
+    Every API function in this module must use this (or _stream_request) instead of calling requests directly.
+    """
+    client = get_client()
+    # Timed from queueing to the last byte, so the span shows what the caller waited for the API
+    with span("api", method=method, route=url_template(url)) as s:
+        response = get_scheduler().execute(lambda: client.request(method, url, **kwargs), priority=priority)
+        s["status"] = response.status_code
+        s["bytes"] = len(response.content)
+    return response
+
+@contextmanager
+def _stream_request(method, url, priority=None, **kwargs):
+    """
+    _request for a body that is read as it arrives: yields (response, api span attributes) and keeps the
+    'api' span open until the block has consumed the body, so slow downloads still count as API time.
+    The response is closed on the way out.
+    """
+    client = get_client()
+    with span("api", method=method, route=url_template(url)) as s:
+        response = get_scheduler().execute(lambda: client.request(method, url, stream=True, **kwargs), priority=priority)
+        s["status"] = response.status_code
+        # Until the body has been read; the caller sets the real size
+        s["bytes"] = int(response.headers.get("Content-Length") or 0)
+        try:
+            yield response, s
+        finally:
+            response.close()
+
 #########################################################################################################################
 # AUTHORIZATION FUNCTIONS 
-HIDDEN_LOGIN_API = "https://www.alertaq.com/api/v4/login"
-TOKEN_API = 'https://www.alertaq.com/api/v4/public/login'
+# Base URLs can be pointed at a local mock server (see mock_server.py) through the environment or set_base_url.
+ALERTAQ_URL = os.getenv("ALERTAQ_URL", "https://www.alertaq.com")
+ALERTAQ_API_URL = os.getenv("ALERTAQ_API_URL", "https://api.alertaq.com")
+HIDDEN_LOGIN_API = f"{ALERTAQ_URL}/api/v4/login"
+TOKEN_API = f'{ALERTAQ_URL}/api/v4/public/login'
+
+def set_base_url(url, api_url=None):
+    """Send every alertaq.com call to another base URL, e.g. http://127.0.0.1:8765 for the mock server."""
+    global ALERTAQ_URL, ALERTAQ_API_URL, HIDDEN_LOGIN_API, TOKEN_API, PROPERTY_DETAILS_ENDPOINT
+    ALERTAQ_URL = url.rstrip("/")
+    ALERTAQ_API_URL = (api_url or url).rstrip("/")
+    HIDDEN_LOGIN_API = f"{ALERTAQ_URL}/api/v4/login"
+    TOKEN_API = f'{ALERTAQ_URL}/api/v4/public/login'
+    PROPERTY_DETAILS_ENDPOINT = f"{ALERTAQ_URL}/api/v4/dataModel/read"
 
 def _get_credentials():
     """Fetch credentials from Streamlit secrets or .env fallback."""
@@ -97,7 +156,7 @@ def _generate_new_token():
     }
 
     try:
-        response = requests.post(TOKEN_API, json=body, headers={"Content-Type": "application/json"})
+        response = _request('POST', TOKEN_API, json=body, headers={"Content-Type": "application/json"})
         response.raise_for_status()  # Raise exception for HTTP errors
         if response.status_code == 201:
             token_data = response.json()
@@ -120,7 +179,7 @@ def _generate_new_hidden_token():
         'password': credentials["password"], 
     }
     try:
-        response = requests.post(HIDDEN_LOGIN_API, data=body)
+        response = _request('POST', HIDDEN_LOGIN_API, data=body)
         if response.status_code == 201:
             token_data = response.json()
             hidden_token = token_data.get('access_token')
@@ -131,35 +190,65 @@ def _generate_new_hidden_token():
         logger.error(f"Error generating new hidden token: {e}")
         return None
 
-def get_token(query_type="default"):
+# Public tokens live 30 days; we treat them as expired after 29 like the S3 date check always has.
+DEFAULT_TOKEN_LIFETIME = 29 * 86400
+# The hidden login does not tell us its lifetime, so it is re-used for this long.
+HIDDEN_TOKEN_TTL_SECONDS = int(os.getenv("ALERTLABS_HIDDEN_TOKEN_TTL", "3600"))
+
+def _load_default_token(min_valid=0):
     """
-    Get the current token, refreshing it if necessary.
-    params = 'hidden_api'
+    Token from S3 if it is still valid for min_valid seconds, otherwise a new one written back to S3
+    (so a refresh inside the margin really replaces it, for every replica).
     """
-    if query_type == 'hidden_api':
-        hidden_token = _generate_new_hidden_token()
-        logger.info("Hidden token generated successfully.")
-        return hidden_token
-
-    if query_type == 'default':
-        token, token_date = _read_token_from_file()
-        if token and token_date:
-            today = datetime.now()
-            if (today - token_date).days <= 29:
-                return token
-    
+    token, token_date = _read_token_from_file()
+    if token and token_date:
+        expires_at = token_date.timestamp() + DEFAULT_TOKEN_LIFETIME
+        if time.time() < expires_at - min_valid:
+            return token, expires_at
     new_token = _generate_new_token()
+    if not new_token:
+        return None, None
     _write_token_to_file(new_token)
-    return new_token
+    return new_token, time.time() + DEFAULT_TOKEN_LIFETIME
+
+def _load_hidden_token(min_valid=0):
+    hidden_token = _generate_new_hidden_token()
+    if not hidden_token:
+        return None, None
+    logger.info("Hidden token generated successfully.")
+    return hidden_token, time.time() + HIDDEN_TOKEN_TTL_SECONDS
+
+_token_manager = TokenManager(
+    loaders={'default': _load_default_token, 'hidden_api': _load_hidden_token},
+    refresh_margins={'default': 86400, 'hidden_api': 300},
+)
+
+def get_token(query_type="default"):
+    """
+    Get the current token from the in-process cache, loading or refreshing it if necessary.
+    S3 and the login APIs are only hit on first use and when a token is close to expiry.
+    params = 'hidden_api'
+    """
+    if query_type != 'hidden_api':
+        query_type = 'default'
+    return _token_manager.get(query_type)
+
+def set_token(token, query_type="default", lifetime=DEFAULT_TOKEN_LIFETIME):
+    """Use this token instead of loading one from S3 / the login APIs (e.g. against the mock server)."""
+    _token_manager.set(query_type, token, time.time() + lifetime)
+
+def invalidate_token(query_type="default"):
+    """Forget a cached token so the next get_token call loads a fresh one."""
+    _token_manager.invalidate(query_type)
 ################################################################################################################################################################################################
 #DATA EXTRACTION FUNCTIONS 
 
 #Gets all the sensors 
 def get_all_sensors(token):
 
-    url = f"https://api.alertaq.com/api/v4/public/sensors"
+    url = f"{ALERTAQ_API_URL}/api/v4/public/sensors"
     headers = {"token": token}
-    response = requests.get(url, headers=headers)
+    response = _request('GET', url, headers=headers)
     if response.status_code != 200:
         raise Exception(f"Failed to fetch sensors: {response.text}")
     return response.json().get('dataModel', [])
@@ -167,9 +256,9 @@ def get_all_sensors(token):
 # Works well. 
 def get_locations(token):
     """Fetch all locations from the API."""
-    url = "https://www.alertaq.com/api/v4/public/locations"
+    url = f"{ALERTAQ_URL}/api/v4/public/locations"
     headers = {"token": token}
-    response = requests.get(url, headers=headers)
+    response = _request('GET', url, headers=headers)
     if response.status_code != 200:
         raise Exception(f"Failed to fetch locations: {response.text}")
     data = response.json()
@@ -181,45 +270,219 @@ def get_sensoreventsatlocation(location_id, token):
     #token = get_token()
     url = f"https://www.alertlabsdashboard.com/api/v3/dataModel/read/allSensorEventsAtLocation?locationID={location_id}"
     headers = {"token": token}
-    response = requests.get(url, headers=headers)
+    response = _request('GET', url, headers=headers)
     if response.status_code != 200:
         raise Exception(f"Failed to fetch sensor events: {response.text}")
     return response.json()
 
 #Change to v4 and add help comments for rate, and series. 
 def _get_timeseries(sensor_id, start_date, end_date, rate="h", series="W", token=None):
-    """Fetch timeseries data for a sensor."""
+    """Fetch timeseries data for a sensor, as a TimeseriesBatch (call .to_frame() for the time/series/Datetime frame)."""
     if not token:
         token = get_token()
     if not sensor_id or not start_date or not end_date:
         raise ValueError("sensor_id, start_date, and end_date are required")
-    url = f"https://www.alertaq.com/api/v4/public/timeseries?sensorID={sensor_id}&from={start_date}&to={end_date}&rate={rate}&series={series}"
+    url = f"{ALERTAQ_URL}/api/v4/public/timeseries?sensorID={sensor_id}&from={start_date}&to={end_date}&rate={rate}&series={series}"
     headers = {"token": token}
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"Failed to fetch timeseries: {response.text}")
-    response_json = response.json()
+    # The body is decoded as it arrives (see timeseries_decode.py) instead of through response.json()
+    with _stream_request('GET', url, headers=headers) as (response, api_span):
+        if response.status_code != 200:
+            # Every response counts against the device's monthly data budget, errors included.
+            get_ledger().record(sensor_id, len(response.content))
+            api_span["bytes"] = len(response.content)
+            raise Exception(f"Failed to fetch timeseries: {response.text}")
+        step = timeseries_store.RATE_SECONDS.get(rate, 3600)
+        expected_rows = (int(float(end_date)) - int(float(start_date))) // step + 1
+        with span("timeseries_decode", rate=rate) as s:
+            response_json, batch, n_bytes = decode_timeseries_stream(
+                response.iter_content(chunk_size=CHUNK_BYTES), sensor_id, rate, series, expected_rows)
+            s["bytes"] = api_span["bytes"] = n_bytes
+            s["rows"] = len(batch) if batch is not None else 0
+    get_ledger().record(sensor_id, n_bytes)
     if response_json.get("error") != None:
         logger.info(f"Error in timeseries data: {response_json['error']}")
         return None
-    values = response_json['dataModel'][sensor_id]
-    df = pd.DataFrame(values, columns=['time', 'series'])
+    if batch is None:
+        values = response_json['dataModel'][sensor_id]
+        batch = TimeseriesBatch.from_pairs(values, sensor_id, rate, series)
+    return batch
+
+def _timeseries_frame(df):
+    """Add the local Datetime column to a frame of raw ['time', 'series'] rows."""
     df['Datetime'] = pd.to_datetime(df['time'], unit='ms') - timedelta(hours=4)
     return df
 
-def get_list_timeseries(sensor_list, start_date="1720119038", end_date="1720205438", rate="h", series="water", token=None):
-    time_series_list = []
-    for sensor in sensor_list:
-        time_series_data = _get_timeseries(sensor_id=sensor,
-                                             start_date=start_date,
-                                             end_date=end_date,
-                                             rate=rate, 
-                                             token=token
-                                            )
-        if time_series_data is not None:
-            time_series_list.append(time_series_data)
+def _get_stored_timeseries(sensor_id, start_date, end_date, rate="h", series="W", token=None, chunk_workers=None):
+    """
+    Same as _get_timeseries, but served from the local timeseries store.
+    Only the sub-ranges of the window the store does not hold yet are requested, closed days from the shared
+    S3 cache first (see shared_cache.py), the rest from the API if the device's monthly data budget allows it
+    (see data_budget.py).
+    Hourly/daily windows whose minute data is already held are answered from the rollups once they have been
+    checked against the API's own buckets (see rollups.py).
+    chunk_workers: chunks fetched at once, range_chunking.CHUNK_WORKERS by default.
+    """
+    rollup_until = rollups.held_until(sensor_id, start_date, rate, series)
+    verified = rollups.is_verified(rate, series) if rollup_until is not None else False
+    if rollup_until is not None and verified is not False:
+        rollup_end = min(rollup_until - 1, int(float(end_date)))
+        rollup = rollups.read_rollup(sensor_id, start_date, rollup_end, rollups.RATE_LEVELS[rate], series)
+        if verified:
+            batch = TimeseriesBatch.from_frame(rollups.rollup_as_series(rollup, series), sensor_id, rate, series)
+        else:
+            # Rollups have not been checked against the API for this rate/series yet: ask the API and compare
+            batch = _get_timeseries(sensor_id, start_date, rollup_end, rate=rate, series=series, token=token)
+            if batch is None:
+                return None
+            rollups.verify_against(batch.raw_frame(), rollup, rate, series)
+        if rollup_until > int(float(end_date)):
+            return batch
+        # Only the part after the held minute data goes through the regular path.
+        rest = _get_stored_timeseries(sensor_id, rollup_until, end_date, rate=rate, series=series, token=token, chunk_workers=chunk_workers)
+        return TimeseriesBatch.concat([batch, rest])
+
+    gaps = timeseries_store.missing_ranges(sensor_id, start_date, end_date, rate, series)
+    gaps = shared_cache.fill_gaps(sensor_id, gaps, rate, series)
+    estimated_bytes = sum(data_budget.estimate_response_bytes(start, end, rate) for start, end in gaps)
+    decision = get_ledger().decide(sensor_id, estimated_bytes, rate) if gaps else data_budget.ALLOW
+    if decision == data_budget.DOWNGRADE:
+        logger.warning(f"Sensor {sensor_id} is near its monthly data budget, serving hourly instead of minute data")
+        return _get_stored_timeseries(sensor_id, start_date, end_date, rate="h", series=series, token=token, chunk_workers=chunk_workers)
+    if decision == data_budget.CACHE_ONLY:
+        rows = timeseries_store.read_rows(sensor_id, start_date, end_date, rate, series)
+        if rows.empty:
+            raise DataBudgetExceeded(f"Sensor {sensor_id} has used its monthly data budget and nothing is cached for this range")
+        logger.warning(f"Sensor {sensor_id} has used its monthly data budget, serving cached data only")
+        return TimeseriesBatch.from_frame(rows, sensor_id, rate, series)
+
+    def fetch(gap_start, gap_end):
+        return _get_timeseries(sensor_id, gap_start, gap_end, rate=rate, series=series, token=token)
+
+    # Long gaps are fetched as concurrent chunks, each retried and stored on its own (see range_chunking.py)
+    chunks = range_chunking.split_ranges(gaps, rate)
+    rows = timeseries_store.read_through(sensor_id, start_date, end_date, range_chunking.with_retries(fetch, label=f"sensor {sensor_id}"),
+                                         rate=rate, series=series, ranges=chunks, max_workers=range_chunking.CHUNK_WORKERS if chunk_workers is None else chunk_workers)
+    if rows is None:
+        return None
+    return TimeseriesBatch.from_frame(rows, sensor_id, rate, series)
+
+def _get_budgeted_timeseries(sensor_id, start_date, end_date, rate="h", series="W", token=None, chunk_workers=None):
+    """_get_timeseries without the store, with the data budget applied (there is no cache to fall back on)."""
+    decision = get_ledger().decide(sensor_id, data_budget.estimate_response_bytes(start_date, end_date, rate), rate)
+    if decision == data_budget.CACHE_ONLY:
+        raise DataBudgetExceeded(f"Sensor {sensor_id} has used its monthly data budget")
+    if decision == data_budget.DOWNGRADE:
+        logger.warning(f"Sensor {sensor_id} is near its monthly data budget, serving hourly instead of minute data")
+        rate = "h"
+    return _get_chunked_timeseries(sensor_id, start_date, end_date, rate=rate, series=series, token=token, max_workers=chunk_workers)
+
+def _get_chunked_timeseries(sensor_id, start_date, end_date, rate="h", series="W", token=None, max_workers=None):
+    """
+    _get_timeseries for windows of any length: long windows are fetched as concurrent chunks (see range_chunking.py),
+    each retried on its own, and stitched back together. Chunks that still fail are left out with a warning;
+    if none came back the first error is raised (or None returned, as _get_timeseries does for API errors).
+    """
+    ranges = range_chunking.split_range(start_date, end_date, rate)
+
+    def fetch(chunk_start, chunk_end):
+        return _get_timeseries(sensor_id, chunk_start, chunk_end, rate=rate, series=series, token=token)
+
+    batches, errors = [], []
+    for _, _, batch, error in range_chunking.fetch_ranges(ranges, range_chunking.with_retries(fetch, label=f"sensor {sensor_id}"), max_workers):
+        if error is not None:
+            logger.error(f"Failed to fetch a chunk of timeseries for sensor {sensor_id}: {error}")
+            errors.append(error)
+        if batch is not None:
+            batches.append(batch)
+    if not batches:
+        if errors:
+            raise errors[0]
+        return None
+    if len(batches) < len(ranges):
+        logger.warning(f"Serving partial data for sensor {sensor_id}: {len(ranges) - len(batches)} of {len(ranges)} chunk(s) failed")
+    return range_chunking.stitch(batches)
+
+@timed()
+def fetch_timeseries_batch(sensor_list, start_date, end_date, rate="h", series="W", token=None, use_store=True, max_workers=TIMESERIES_WORKERS,
+                           chunk_workers=None):
+    """
+    Fetch timeseries for several sensors concurrently (at most max_workers in flight).
+    Returns a list of (sensor_id, TimeseriesBatch or None, exception or None) in the same order as sensor_list,
+    so one failing sensor does not abort the rest of the batch.
+    chunk_workers: chunks of each sensor fetched at once. By default the sensors share range_chunking.CHUNK_WORKERS.
+    """
+    if use_store and not timeseries_store.STORE_DISABLED:
+        fetch_timeseries = _get_stored_timeseries
+    else:
+        fetch_timeseries = _get_budgeted_timeseries
+    if not token and len(sensor_list) > 0:
+        token = get_token()
+    sensor_workers = max(1, min(max_workers, len(sensor_list)))
+    if chunk_workers is None:
+        chunk_workers = range_chunking.nested_workers(range_chunking.CHUNK_WORKERS, sensor_workers)
+
+    def fetch(sensor):
+        try:
+            batch = fetch_timeseries(sensor_id=sensor, start_date=start_date, end_date=end_date, rate=rate, series=series, token=token,
+                                     chunk_workers=chunk_workers)
+            # The float64 originals are only needed until the store has them
+            return sensor, None if batch is None else batch.compact(), None
+        except Exception as e:
+            logger.error(f"Failed to fetch timeseries for sensor {sensor}: {e}")
+            return sensor, None, e
+
+    if sensor_workers <= 1:
+        return [fetch(sensor) for sensor in sensor_list]
+    with ThreadPoolExecutor(max_workers=sensor_workers) as executor:
+        # Each task gets a copy of the caller's context so the request priority carries over.
+        futures = [executor.submit(contextvars.copy_context().run, fetch, sensor) for sensor in sensor_list]
+        return [future.result() for future in futures]
+
+def get_list_timeseries(sensor_list, start_date="1720119038", end_date="1720205438", rate="h", series="W", token=None, use_store=True, max_workers=TIMESERIES_WORKERS):
+    """
+    Fetch timeseries for every sensor in sensor_list, in order, as TimeseriesBatches (.to_frame() gives the
+    time/series/Datetime DataFrame). Sensors that fail or return an error are left out;
+    if every sensor failed the first error is raised. Long windows are fetched per sensor in concurrent chunks
+    (see range_chunking.py); iter_list_timeseries hands the chunks over as they arrive.
+    use_store: read through the local timeseries store (see timeseries_store.py) instead of always hitting the API.
+    max_workers: number of sensors fetched concurrently, 1 fetches them one after another.
+    """
+    results = fetch_timeseries_batch(sensor_list, start_date, end_date, rate=rate, series=series, token=token, use_store=use_store, max_workers=max_workers)
+    time_series_list = [df for _, df, _ in results if df is not None]
+    errors = [error for _, _, error in results if error is not None]
+    if errors and not time_series_list:
+        raise errors[0]
     return time_series_list
 
+def iter_list_timeseries(sensor_list, start_date, end_date, rate="h", series="W", token=None, use_store=True, max_workers=TIMESERIES_WORKERS):
+    """
+    get_list_timeseries delivered in chronological chunks (see range_chunking.py), for charts that should start
+    drawing before a long window has fully arrived. Chunks are fetched concurrently and yielded in order as
+    (chunk_start, chunk_end, batches), batches being that chunk's get_list_timeseries result (possibly empty).
+    range_chunking.stitch joins the chunks of one sensor. If no chunk returned anything the first error is raised.
+    """
+    if not token and len(sensor_list) > 0:
+        token = get_token()
+    end = int(float(end_date))
+    ranges = range_chunking.split_range(start_date, end, rate)
+    # The chunks are the outer pool; the sensors of each chunk share max_workers and fetch their chunk in one go.
+    chunk_workers = max(1, min(range_chunking.CHUNK_WORKERS, len(ranges)))
+    sensor_workers = range_chunking.nested_workers(max_workers, chunk_workers)
+
+    def fetch(chunk_start, chunk_end):
+        # Chunks are [start, end) but the API's `to` is inclusive; the last chunk keeps the caller's end.
+        return fetch_timeseries_batch(sensor_list, chunk_start, end if chunk_end == end else chunk_end - 1, rate=rate, series=series,
+                                      token=token, use_store=use_store, max_workers=sensor_workers, chunk_workers=1)
+
+    first_error, received = None, False
+    for chunk_start, chunk_end, results, _ in range_chunking.fetch_ranges(ranges, fetch, chunk_workers):
+        batches = [df for _, df, _ in results if df is not None]
+        first_error = first_error or next((error for _, _, error in results if error is not None), None)
+        received = received or len(batches) > 0
+        yield chunk_start, chunk_end, batches
+    if first_error is not None and not received:
+        raise first_error
+
 #v2 would be deprecated soon. Make a copy of this function's output for future use. 
 def get_property_detailsv2(location_id, authorization_header):
     location_ids_json = json.dumps(location_id)
@@ -231,17 +494,17 @@ def get_property_detailsv2(location_id, authorization_header):
     params = {
         "locationIDs": location_ids_json,
     }
-    response = requests.get(property_details_url, headers=headers, params=params)
+    response = _request('GET', property_details_url, headers=headers, params=params)
     return response.json()
 
-#v4 version of the property details function
-def get_property_detailsv4(location_id):
-    """
-    Returns property details for a single property. Use it after the query to filter for queried location_id.
-    """
+PROPERTY_DETAILS_ENDPOINT = f"{ALERTAQ_URL}/api/v4/dataModel/read"
+# Locations asked for per dataModel/read call by get_property_detailsv4_batch.
+PROPERTY_DETAILS_CHUNK_SIZE = 50
+
+def _read_property_details(where):
+    """POST a locationsV2 dataModel/read for the given `where` filter using the hidden token."""
     hidden_token = get_token('hidden_api')
     #time.sleep(3)
-    propertydetails_endpoint = "https://www.alertaq.com/api/v4/dataModel/read"
     headers = {
         "authorization": hidden_token,
         "Content-Type": "application/json; charset=utf-8"
@@ -257,11 +520,7 @@ def get_property_detailsv4(location_id):
                 "users", "groupType", "nodeType", "commercialPropertyType", "buildingType",
                 "numberFloors", "ancestors", "vacationMode", "notes", "hasNotes", "flags"
             ],
-            "where": {
-                "_id": {
-                    "$eq": location_id  # Dynamically inserted
-                }
-            },
+            "where": where,
             "children": {
                 "sensors": {
                     "fields": ["location_id", "_id"]
@@ -272,9 +531,37 @@ def get_property_detailsv4(location_id):
 
     body = json.dumps(body)
 
-    response = requests.post(propertydetails_endpoint, headers=headers, data=body)
+    response = _request('POST', PROPERTY_DETAILS_ENDPOINT, headers=headers, data=body)
+    if response.status_code == 401:
+        # Cached hidden token was revoked early; log in again once.
+        invalidate_token('hidden_api')
+        headers["authorization"] = get_token('hidden_api')
+        response = _request('POST', PROPERTY_DETAILS_ENDPOINT, headers=headers, data=body)
     return response.json()
 
+#v4 version of the property details function
+def get_property_detailsv4(location_id):
+    """
+    Returns property details for a single property. Use it after the query to filter for queried location_id.
+    """
+    return _read_property_details({"_id": {"$eq": location_id}})
+
+def get_property_detailsv4_batch(location_ids, chunk_size=PROPERTY_DETAILS_CHUNK_SIZE):
+    """
+    Returns the property details records (the 'dataModel' entries) for many locations,
+    asking for chunk_size locations per request instead of one request per location.
+    """
+    location_ids = list(dict.fromkeys(location_ids))
+    records = []
+    for i in range(0, len(location_ids), chunk_size):
+        chunk = location_ids[i:i + chunk_size]
+        response_json = _read_property_details({"_id": {"$in": chunk}})
+        if not isinstance(response_json, dict) or response_json.get('dataModel') is None:
+            logger.error(f"Property details request for {len(chunk)} location(s) failed: {str(response_json)[:200]}")
+            continue
+        records.extend(response_json['dataModel'])
+    return records
+
 # An alternative to this has to be found. Very important. This function is the basis to get the parent name which is later used in the dashboard. 
 #This function is deprecated, we would only use self joins in v4 version
 def get_only_parent_id(parent_id, authorization_header):
@@ -286,7 +573,7 @@ def get_only_parent_id(parent_id, authorization_header):
     params = {
         "locationIDs": location_ids_json,
     }
-    response = requests.get(url, headers=headers, params=params)
+    response = _request('GET', url, headers=headers, params=params)
     if "friendlyName" in response.json().keys():
         return response.json()["friendlyName"]
     else:
@@ -317,9 +604,9 @@ def get_water_costs(location_id, token=None):
         token = get_token()
     if not location_id:
         raise ValueError("location_id is required")
-    url = f"https://www.alertaq.com/api/v4/public/locations/{location_id}/bills/water"
+    url = f"{ALERTAQ_URL}/api/v4/public/locations/{location_id}/bills/water"
     headers = {"authorization": f"Bearer {token}"}
-    response = requests.get(url, headers=headers)
+    response = _request('GET', url, headers=headers)
     if response.status_code != 200:
         raise Exception(f"Failed to fetch water costs: {response.text}")
     return response.json()
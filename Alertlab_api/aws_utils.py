@@ -1,9 +1,10 @@
 # aws_utils.py
-import os, boto3, io, logging
+import os, sys, boto3, io, logging
 from datetime import datetime
-import streamlit as st
 from dotenv import load_dotenv
 from pathlib import Path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api.log_shipper import S3LogShipper
 
 # Load local .env if available
 load_dotenv()
@@ -15,6 +16,8 @@ def secrets_file_exists():
 def get_secret(key):
     """Unified secrets loader for Streamlit Cloud or local .env."""
     if secrets_file_exists():
+        # Imported here so headless tools (e.g. the backfill daemon) never load Streamlit.
+        import streamlit as st
         try:
             value = st.secrets[key]
             #logger.info(f"Loaded {key} from Streamlit secrets.")
@@ -34,6 +37,12 @@ BUCKET_NAME = get_secret("BUCKET_NAME")
 #LOG_LOC = get_secret("LOG_LOC") or "Logs/"
 
 LOG_KEY = f'Logs/app-session-at-{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.log'
+# Logs are shipped as gzip'd segments under this prefix (pid added so processes started in the same second do not collide)
+LOG_PREFIX = f'Logs/app-session-at-{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}-{os.getpid()}/'
+LOG_SEGMENT_BYTES = int(os.getenv("LOG_SEGMENT_BYTES", str(256 * 1024)))
+LOG_SEGMENT_SECONDS = int(os.getenv("LOG_SEGMENT_SECONDS", "300"))
+LOG_BUFFER_BYTES = int(os.getenv("LOG_BUFFER_BYTES", str(4 * 1024 * 1024)))
+LOG_FLUSH_SECONDS = int(os.getenv("LOG_FLUSH_SECONDS", "30"))
 
 # Initialize S3 client
 _s3_client = boto3.client(
@@ -43,14 +52,22 @@ _s3_client = boto3.client(
     region_name=AWS_REGION,
 )
 
-# Initialize logger and log stream
-_log_stream = io.StringIO()
+# Initialize logger and log stream (bounded, rotating, uploaded to S3 in the background)
+_log_stream = S3LogShipper(
+    _s3_client,
+    BUCKET_NAME,
+    LOG_PREFIX,
+    max_segment_bytes=LOG_SEGMENT_BYTES,
+    max_segment_seconds=LOG_SEGMENT_SECONDS,
+    max_buffer_bytes=LOG_BUFFER_BYTES,
+    flush_interval=LOG_FLUSH_SECONDS,
+)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
         logging.StreamHandler(),        # Console
-        logging.StreamHandler(_log_stream)  # In-memory stream for S3 uploads
+        _log_stream                     # Segments shipped to S3
     ]
 )
 _logger = logging.getLogger(__name__)
@@ -61,6 +78,10 @@ def upload_log_to_s3(logger, log_stream):
     example_usage: upload_log_to_s3(logger, log_stream)
     """
     try:
+        if isinstance(log_stream, S3LogShipper):
+            # Only the records since the last upload are sent, as a new segment, by the shipper's thread
+            log_stream.request_flush()
+            return
         s3, BUCKET_NAME = get_s3_client_and_bucket_name()
         # Retrieve log content from the in-memory stream
         log_contents = log_stream.getvalue()
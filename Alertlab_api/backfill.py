@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import time
+import argparse
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api import alertlab_api, timeseries_store, data_budget, leak_detector, shared_cache
+from Alertlab_api.rate_limiter import TokenBucket, request_priority, BACKGROUND
+from Alertlab_api.timeseries_batch import TimeseriesBatch
+from Alertlab_api.aws_utils import get_logger_and_log_stream
+
+logger, log_stream = get_logger_and_log_stream()
+
+#########################################################################################################################
+# HEADLESS BACKFILL / TAIL DAEMON
+# Loads `history_days` of history for every Flowie / Flowie-O sensor into the local timeseries store,
+# one bounded request at a time in round robin, then keeps tailing new data every `tail_interval` seconds.
+# Progress is checkpointed per sensor so a restart picks up where it stopped.
+# It never imports Streamlit, and it can be pointed at the mock server:
+#   python -m Alertlab_api.backfill --base-url http://127.0.0.1:8765 --days 30 --once
+
+FLOWIE_TYPES = ('Flowie', 'Flowie-O')
+# Span of one request per rate, ~0.35 MB per request at minute resolution (1.44 MB per 30 days).
+CHUNK_SECONDS = {"m": 7 * 86400, "h": 90 * 86400, "d": 365 * 86400}
+# Share of the 3600 requests/hour account quota the daemon may use; the rest is left to the dashboards.
+BACKFILL_REQUESTS_PER_HOUR = int(os.getenv("BACKFILL_REQUESTS_PER_HOUR", "1800"))
+# A sensor whose request failed is retried after BACKFILL_RETRY_SECONDS, doubling per consecutive failure,
+# and parked (skipped until the daemon runs with --retry-parked) after BACKFILL_MAX_FAILURES in a row.
+BACKFILL_RETRY_SECONDS = int(os.getenv("BACKFILL_RETRY_SECONDS", "60"))
+BACKFILL_MAX_FAILURES = int(os.getenv("BACKFILL_MAX_FAILURES", "8"))
+CHECKPOINT_PATH = os.getenv("BACKFILL_CHECKPOINT_PATH", os.path.join(timeseries_store.STORE_DIR, "_backfill_checkpoint.json"))
+
+
+def load_checkpoint(path=CHECKPOINT_PATH):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (ValueError, OSError) as e:
+        logger.error(f"Unreadable backfill checkpoint {path}, starting over: {e}")
+        return {}
+
+
+def save_checkpoint(checkpoint, path=CHECKPOINT_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def list_flowie_sensors(token):
+    """Sensor ids of every Flowie / Flowie-O the account can see."""
+    sensors = alertlab_api.get_all_sensors(token)
+    return [s['_id'] for s in sensors if s.get('friendlyType') in FLOWIE_TYPES]
+
+
+class BackfillDaemon:
+    """
+    clock and sleep can be swapped for fakes in tests; store_root points the writes at another store directory.
+    listeners are called as listener(sensor_id, rows, rate, series) after new rows (a TimeseriesBatch) are written.
+    """
+
+    def __init__(self, rate="m", series="W", history_days=30, requests_per_hour=BACKFILL_REQUESTS_PER_HOUR,
+                 checkpoint_path=CHECKPOINT_PATH, tail_interval=900, token=None, sensors=None,
+                 store_root=None, clock=time.time, sleep=time.sleep, max_failures=BACKFILL_MAX_FAILURES,
+                 retry_seconds=BACKFILL_RETRY_SECONDS, retry_parked=False):
+        self.rate = rate
+        self.series = series
+        self.history_days = history_days
+        self.checkpoint_path = checkpoint_path
+        self.tail_interval = tail_interval
+        self.token = token
+        self.store_root = store_root
+        self.listeners = []
+        self._fixed_sensors = sensors
+        self._clock = clock
+        self._sleep = sleep
+        self._bucket = TokenBucket(requests_per_hour / 3600.0, 1, clock)
+        self.max_failures = max_failures
+        self.retry_seconds = retry_seconds
+        self.checkpoint = load_checkpoint(checkpoint_path)
+        if retry_parked:
+            for state in self.checkpoint.values():
+                state["failures"] = 0
+                state.pop("retry_at", None)
+        self.requests_made = 0
+
+    def _pace(self):
+        """Wait for the daemon's own share of the quota before each request."""
+        delay = self._bucket.time_until_available()
+        if delay > 0:
+            self._sleep(delay)
+        self._bucket.consume()
+        self.requests_made += 1
+
+    def _token(self):
+        return self.token or alertlab_api.get_token()
+
+    def sensors(self):
+        if self._fixed_sensors:
+            return list(self._fixed_sensors)
+        self._pace()
+        return list_flowie_sensors(self._token())
+
+    def _state(self, sensor_id):
+        key = f"{sensor_id}|{self.series}|{self.rate}"
+        if key not in self.checkpoint:
+            start = int(self._clock()) - self.history_days * 86400
+            self.checkpoint[key] = {"cursor": start, "failures": 0}
+        return self.checkpoint[key]
+
+    def is_parked(self, sensor_id):
+        return self._state(sensor_id).get("failures", 0) >= self.max_failures
+
+    def _failed(self, sensor_id, state):
+        """Count a failed request and schedule the sensor's next attempt, parking it after max_failures in a row."""
+        state["failures"] = state.get("failures", 0) + 1
+        state["retry_at"] = int(self._clock()) + self.retry_seconds * 2 ** (state["failures"] - 1)
+        if state["failures"] >= self.max_failures:
+            logger.error(f"Backfill of sensor {sensor_id} parked after {state['failures']} failed requests in a row "
+                         f"(run with --retry-parked to try it again)")
+        save_checkpoint(self.checkpoint, self.checkpoint_path)
+
+    def step(self, sensor_id):
+        """
+        Advance one sensor by at most one chunk. Returns True if it advanced and may have more to do,
+        False once it is caught up, its request failed, it is waiting out a failure backoff or it is parked.
+        Ranges the store already holds (e.g. fetched by the dashboard) are skipped without a request, and closed
+        days another replica already fetched are copied from the shared cache (see shared_cache.py).
+        """
+        state = self._state(sensor_id)
+        if state.get("failures", 0) >= self.max_failures or self._clock() < state.get("retry_at", 0):
+            return False
+        settled = int(self._clock()) - timeseries_store.SETTLE_SECONDS
+        cursor = state["cursor"]
+        if cursor >= settled - timeseries_store.RATE_SECONDS[self.rate]:
+            return False
+        chunk_end = min(cursor + CHUNK_SECONDS[self.rate], settled)
+        gaps = timeseries_store.missing_ranges(sensor_id, cursor, chunk_end, self.rate, self.series, self.store_root)
+        store_gaps = gaps
+        gaps = shared_cache.fill_gaps(sensor_id, gaps, self.rate, self.series, self.store_root)
+        if gaps != store_gaps and self.listeners:
+            # Days copied from the shared cache go to the listeners like fetched ones
+            shared_rows = TimeseriesBatch.from_frame(timeseries_store.read_rows(sensor_id, cursor, chunk_end, self.rate, self.series, self.store_root),
+                                                     sensor_id, self.rate, self.series)
+            for listener in self.listeners:
+                listener(sensor_id, shared_rows, self.rate, self.series)
+        estimated_bytes = sum(data_budget.estimate_response_bytes(start, end, self.rate) for start, end in gaps)
+        if gaps and data_budget.get_ledger().decide(sensor_id, estimated_bytes, self.rate) != data_budget.ALLOW:
+            # Never spend a device's remaining monthly budget on history; the dashboard may need it.
+            logger.warning(f"Backfill of sensor {sensor_id} paused, it is near its monthly data budget")
+            return False
+        for gap_start, gap_end in gaps:
+            self._pace()
+            try:
+                rows = alertlab_api._get_timeseries(sensor_id, gap_start, gap_end, rate=self.rate, series=self.series, token=self._token())
+            except Exception as e:
+                rows = None
+                logger.error(f"Backfill request failed for sensor {sensor_id} [{gap_start}, {gap_end}): {e}")
+            if rows is None:
+                # Leave the cursor where it is and retry this sensor once its backoff has passed.
+                self._failed(sensor_id, state)
+                return False
+            timeseries_store.write_rows(sensor_id, rows, self.rate, self.series, covered=(gap_start, gap_end), root=self.store_root)
+            for listener in self.listeners:
+                listener(sensor_id, rows, self.rate, self.series)
+        state["cursor"] = chunk_end
+        state["updated"] = int(self._clock())
+        state["failures"] = 0
+        state.pop("retry_at", None)
+        save_checkpoint(self.checkpoint, self.checkpoint_path)
+        return True
+
+    def run_once(self):
+        """Bring every sensor up to date, interleaving sensors so progress is spread evenly."""
+        with request_priority(BACKGROUND):
+            sensors = self.sensors()
+            logger.info(f"Backfill pass over {len(sensors)} sensor(s) at rate={self.rate}, series={self.series}")
+            parked = [sensor_id for sensor_id in sensors if self.is_parked(sensor_id)]
+            if parked:
+                logger.warning(f"Skipping {len(parked)} parked sensor(s): {', '.join(parked)}")
+            pending = list(sensors)
+            while pending:
+                pending = [sensor_id for sensor_id in pending if self.step(sensor_id)]
+        return self.requests_made
+
+    def run_forever(self):
+        while True:
+            self.run_once()
+            logger.info(f"Backfill caught up ({self.requests_made} request(s) so far), tailing again in {self.tail_interval}s")
+            self._sleep(self.tail_interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backfill and tail AlertLabs timeseries into the local store.")
+    parser.add_argument("--rate", default="m", choices=sorted(CHUNK_SECONDS))
+    parser.add_argument("--series", default="W")
+    parser.add_argument("--days", type=int, default=30, help="history to load for sensors without a checkpoint")
+    parser.add_argument("--requests-per-hour", type=int, default=BACKFILL_REQUESTS_PER_HOUR)
+    parser.add_argument("--tail-interval", type=int, default=900, help="seconds between tail passes")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--sensor", action="append", dest="sensors", help="only this sensor id (repeatable)")
+    parser.add_argument("--base-url", help="send requests here instead of alertaq.com (e.g. the mock server)")
+    parser.add_argument("--token", help="use this API token instead of the S3 / login flow")
+    parser.add_argument("--once", action="store_true", help="exit after one backfill pass instead of tailing")
+    parser.add_argument("--retry-parked", action="store_true", help="try sensors parked after repeated failures again")
+    parser.add_argument("--no-leak-detector", action="store_true", help="do not run the leak detector on the new rows")
+    args = parser.parse_args(argv)
+
+    if args.base_url:
+        alertlab_api.set_base_url(args.base_url)
+    daemon = BackfillDaemon(rate=args.rate, series=args.series, history_days=args.days,
+                            requests_per_hour=args.requests_per_hour, checkpoint_path=args.checkpoint,
+                            tail_interval=args.tail_interval, token=args.token, sensors=args.sensors,
+                            retry_parked=args.retry_parked)
+    if not args.no_leak_detector and args.rate == leak_detector.RATE and args.series == leak_detector.SERIES:
+        # Every sensor's new minute rows go through the detector as soon as they are stored (see leak_detector.py)
+        daemon.listeners.append(leak_detector.on_rows)
+    if args.once:
+        daemon.run_once()
+        logger.info(f"Backfill pass finished with {daemon.requests_made} request(s).")
+    else:
+        daemon.run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import os
+import sys
+import json
+import time
+import calendar
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api import timeseries_store
+from Alertlab_api.aws_utils import get_logger_and_log_stream
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, only the in-process one
+    fcntl = None
+
+logger, log_stream = get_logger_and_log_stream()
+
+#########################################################################################################################
+# PER-DEVICE MONTHLY DATA BUDGET
+# AlertLabs caps each device at 100 MB of responses per calendar month (see notes/7-29-2024.txt).
+# The ledger records the response bytes of every timeseries request per sensor and month, projects the
+# month-end usage from the pace so far, and decides what to do with a new request:
+#   ALLOW       send it
+#   DOWNGRADE   minute data would push the projection over DOWNGRADE_AT: ask for hourly data instead
+#   CACHE_ONLY  the request would go over REFUSE_AT: serve what the local store holds, or refuse
+
+MONTHLY_DEVICE_BUDGET_BYTES = int(float(os.getenv("ALERTLABS_DEVICE_BUDGET_MB", "100")) * 1024 * 1024)
+DOWNGRADE_AT = float(os.getenv("ALERTLABS_BUDGET_DOWNGRADE_AT", "0.8"))
+REFUSE_AT = float(os.getenv("ALERTLABS_BUDGET_REFUSE_AT", "0.98"))
+LEDGER_PATH = os.getenv("ALERTLABS_BUDGET_LEDGER_PATH", os.path.join(timeseries_store.STORE_DIR, "_data_budget.json"))
+
+# 30 days of minute data is 1441959 bytes for 43200 points, about 33.4 bytes per [time, value] pair.
+BYTES_PER_POINT = 1441959 / 43200
+
+ALLOW = "allow"
+DOWNGRADE = "downgrade"
+CACHE_ONLY = "cache_only"
+
+
+class DataBudgetExceeded(Exception):
+    """Raised when a request would exceed a device's monthly budget and nothing is cached."""
+
+
+def estimate_response_bytes(start, end, rate="h"):
+    step = timeseries_store.RATE_SECONDS.get(rate, 3600)
+    points = max(0, int(float(end)) - int(float(start))) // step + 1
+    return int(points * BYTES_PER_POINT)
+
+
+@contextmanager
+def _file_lock(path):
+    """Exclusive lock on path + '.lock' across processes (the dashboards and the backfill daemon share the ledger)."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class DataBudgetLedger:
+    """
+    Persistent {month: {sensor_id: {"bytes": int, "requests": int}}} ledger. Only the current month is kept.
+    clock can be swapped for a fake in tests.
+    """
+
+    def __init__(self, path=LEDGER_PATH, budget_bytes=MONTHLY_DEVICE_BUDGET_BYTES, downgrade_at=DOWNGRADE_AT,
+                 refuse_at=REFUSE_AT, clock=time.time):
+        self.path = path
+        self.budget_bytes = budget_bytes
+        self.downgrade_at = downgrade_at
+        self.refuse_at = refuse_at
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._months = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (ValueError, OSError) as e:
+            logger.error(f"Unreadable data budget ledger {self.path}, starting empty: {e}")
+            return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "w") as f:
+            json.dump(self._months, f)
+        os.replace(tmp_path, self.path)
+
+    def _month(self):
+        return datetime.fromtimestamp(self._clock()).strftime("%Y-%m")
+
+    def _elapsed_fraction(self):
+        """Fraction of the calendar month gone by, at least a week so one early backfill does not dominate the projection."""
+        now = datetime.fromtimestamp(self._clock())
+        days_in_month = calendar.monthrange(now.year, now.month)[1]
+        elapsed_days = (now.day - 1) + (now.hour * 3600 + now.minute * 60 + now.second) / 86400
+        return max(elapsed_days, 7.0) / days_in_month
+
+    def record(self, sensor_id, n_bytes):
+        with self._lock, _file_lock(self.path):
+            # Re-read under the file lock so a dashboard and the backfill daemon sharing the file do not drop each
+            # other's bytes. Months before the current one no longer decide anything and are dropped.
+            current = self._month()
+            self._months = {current: self._load().get(current, {})}
+            entry = self._months[current].setdefault(sensor_id, {"bytes": 0, "requests": 0})
+            entry["bytes"] += int(n_bytes)
+            entry["requests"] += 1
+            self._save()
+
+    def used(self, sensor_id):
+        with self._lock:
+            return self._months.get(self._month(), {}).get(sensor_id, {}).get("bytes", 0)
+
+    def projected(self, sensor_id):
+        """Month-end usage if the sensor keeps consuming at its pace so far."""
+        return self.used(sensor_id) / self._elapsed_fraction()
+
+    def decide(self, sensor_id, estimated_bytes, rate="h"):
+        used = self.used(sensor_id)
+        if used + estimated_bytes > self.refuse_at * self.budget_bytes:
+            # Hourly data is 60x smaller, which may still fit where minute data does not.
+            if rate == "m" and used + estimated_bytes / 60 <= self.refuse_at * self.budget_bytes:
+                return DOWNGRADE
+            return CACHE_ONLY
+        if rate == "m" and max(self.projected(sensor_id), used + estimated_bytes) > self.downgrade_at * self.budget_bytes:
+            return DOWNGRADE
+        return ALLOW
+
+    def summary(self, sensor_ids=None):
+        """This month's usage per sensor, heaviest first, for display in the dashboard."""
+        with self._lock:
+            month = dict(self._months.get(self._month(), {}))
+        if sensor_ids is not None:
+            month = {s: month.get(s, {"bytes": 0, "requests": 0}) for s in sensor_ids}
+        rows = []
+        for sensor_id, entry in month.items():
+            projected = entry["bytes"] / self._elapsed_fraction()
+            rows.append({
+                "sensor_id": sensor_id,
+                "used_mb": round(entry["bytes"] / 1024 / 1024, 2),
+                "projected_mb": round(projected / 1024 / 1024, 2),
+                "budget_pct": round(100 * projected / self.budget_bytes, 1),
+                "requests": entry["requests"],
+            })
+        df = pd.DataFrame(rows, columns=["sensor_id", "used_mb", "projected_mb", "budget_pct", "requests"])
+        return df.sort_values("projected_mb", ascending=False).reset_index(drop=True)
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger():
+    """Return the process-wide ledger."""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = DataBudgetLedger()
+        return _ledger
+
+
+def set_ledger(ledger):
+    global _ledger
+    with _ledger_lock:
+        _ledger = ledger
@@ -0,0 +1,77 @@
+import os
+import sys
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api.aws_utils import get_logger_and_log_stream
+
+logger, log_stream = get_logger_and_log_stream()
+
+#########################################################################################################################
+# SHARED HTTP CLIENT
+# One pooled requests.Session per process, so calls to alertaq.com reuse kept-alive TLS connections
+# instead of paying a new handshake each time, and nothing can hang a script run without a timeout.
+
+CONNECT_TIMEOUT = float(os.getenv("ALERTLABS_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("ALERTLABS_READ_TIMEOUT", "60"))
+DEFAULT_POOL_SIZE = int(os.getenv("ALERTLABS_POOL_SIZE", "4"))
+
+# Connections kept open per host. The timeseries host gets the most since get_list_timeseries fetches in parallel.
+HOST_POOL_SIZES = {
+    "www.alertaq.com": 8,
+    "api.alertaq.com": 4,
+    "www.alertlabsdashboard.com": 2,
+}
+
+
+class AlertLabsClient:
+    """
+    Thin wrapper around a requests.Session with per-host connection pools,
+    gzip/deflate negotiation and a default (connect, read) timeout on every request.
+    """
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, host_pool_sizes=None, default_pool_size=DEFAULT_POOL_SIZE):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive",
+        })
+        default_adapter = HTTPAdapter(pool_connections=len(HOST_POOL_SIZES) + 1, pool_maxsize=default_pool_size)
+        self.session.mount("https://", default_adapter)
+        self.session.mount("http://", default_adapter)
+        for host, pool_size in (host_pool_sizes or HOST_POOL_SIZES).items():
+            # pool_block keeps us at pool_size open connections per host instead of opening throwaway ones.
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+            self.session.mount(f"https://{host}/", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide client shared by every API function and Streamlit session."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = AlertLabsClient()
+            logger.info(f"Created pooled AlertLabs HTTP client (timeout={_client.timeout}).")
+        return _client
+
+
+def set_client(client):
+    """Replace the process-wide client (e.g. with one pointed at a local mock server)."""
+    global _client
+    with _client_lock:
+        if _client is not None and _client is not client:
+            _client.close()
+        _client = client
@@ -0,0 +1,206 @@
+import re
+import json
+import time
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+#########################################################################################################################
+# TIMING SPANS AND HISTOGRAMS
+# Wrap anything worth timing in a span:
+#   with span("api", method="GET", route=url_template(url)) as s:
+#       ...
+#       s["status"] = response.status_code; s["bytes"] = len(response.content)
+# or decorate a function with @timed("aggregate"). Every span lands in a process-wide histogram keyed by its
+# name and labels (export_json / export_prometheus), and in the trace of the current session if one is open
+# (session_trace), which is what the dashboard's hidden timing panel shows for a single run.
+# Label values should stay low-cardinality (route templates, not URLs with ids).
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Labels that are recorded on the span but not used to key histograms (they are per-call values)
+VALUE_ATTRIBUTES = ("bytes", "rows")
+
+_ID_SEGMENT = re.compile(r"^([0-9a-fA-F]{24}|\d+|[0-9a-fA-F-]{36})$")
+_trace = contextvars.ContextVar("instrumentation_trace", default=None)
+
+
+def url_template(url):
+    """URL path with id-like segments replaced by {id}, e.g. /api/v2/locations/{id}."""
+    path = urlparse(url).path or "/"
+    return "/".join("{id}" if _ID_SEGMENT.match(segment) else segment for segment in path.split("/"))
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.bytes = 0
+
+    def observe(self, seconds, n_bytes=0):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self.bytes += n_bytes
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (Prometheus style estimate)."""
+        if self.count == 0:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets + (self.max,), self.counts):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class Registry:
+    """Thread-safe {(name, labels): Histogram} store."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, seconds, n_bytes=0):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds, n_bytes)
+
+    def snapshot(self):
+        with self._lock:
+            return [(name, dict(labels), h.count, h.sum, h.max, h.bytes, list(h.counts), h.quantile(0.5), h.quantile(0.95))
+                    for (name, labels), h in sorted(self._histograms.items())]
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+_registry = Registry()
+
+
+def get_registry():
+    return _registry
+
+
+def set_registry(registry):
+    global _registry
+    _registry = registry
+
+
+##### Spans
+
+@contextmanager
+def span(name, **labels):
+    """Time the block. The yielded dict can be updated with more labels and with 'bytes' / 'rows' values."""
+    attributes = dict(labels)
+    started = time.perf_counter()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes.setdefault("error", type(e).__name__)
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        values = {k: attributes.pop(k) for k in VALUE_ATTRIBUTES if k in attributes}
+        _registry.observe(name, attributes, seconds, int(values.get("bytes") or 0))
+        trace = _trace.get()
+        if trace is not None:
+            # list.append is atomic, so spans from worker threads (which copy the context) can share the trace
+            trace.append({"span": name, **attributes, **values, "ms": round(seconds * 1000, 2), "at": time.time()})
+
+
+def timed(name=None):
+    """Decorator form of span, named after the function unless a name is given."""
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def begin_trace():
+    """
+    Start a new trace for the current context and return it, for code that cannot be wrapped in a block
+    (a Streamlit script run). It stays active until the next begin_trace in the same context.
+    """
+    trace = []
+    _trace.set(trace)
+    return trace
+
+
+@contextmanager
+def session_trace():
+    """Collect every span finished inside the block (and in threads started with its context) into a list."""
+    trace = []
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+
+##### Export
+
+def export_json(registry=None):
+    rows = []
+    for name, labels, count, total, maximum, n_bytes, counts, p50, p95 in (registry or _registry).snapshot():
+        rows.append({
+            "span": name, "labels": labels, "count": count, "sum_seconds": round(total, 6), "max_seconds": round(maximum, 6),
+            "p50_seconds": p50, "p95_seconds": p95, "bytes": n_bytes,
+            "buckets": dict(zip([str(b) for b in (registry or _registry).buckets] + ["+Inf"], counts)),
+        })
+    return json.dumps(rows, indent=1)
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prometheus_labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    pairs = [f'{re.sub(r"[^a-zA-Z0-9_]", "_", k)}="{_escape_label_value(v)}"' for k, v in labels.items()]
+    return "{" + ",".join(pairs) + "}"
+
+
+def export_prometheus(registry=None, prefix="alertlabs"):
+    """Prometheus text exposition format: one histogram family for all spans (label `span`), plus a bytes counter."""
+    registry = registry or _registry
+    snapshot = registry.snapshot()
+    lines = [f"# HELP {prefix}_span_seconds Duration of instrumented operations.", f"# TYPE {prefix}_span_seconds histogram"]
+    for name, labels, count, total, _, _, counts, _, _ in snapshot:
+        cumulative = 0
+        for bound, n in zip([str(b) for b in registry.buckets] + ["+Inf"], counts):
+            cumulative += n
+            lines.append(f"{prefix}_span_seconds_bucket{_prometheus_labels(labels, span=name, le=bound)} {cumulative}")
+        lines.append(f"{prefix}_span_seconds_sum{_prometheus_labels(labels, span=name)} {total:.6f}")
+        lines.append(f"{prefix}_span_seconds_count{_prometheus_labels(labels, span=name)} {count}")
+    lines += [f"# HELP {prefix}_span_bytes_total Bytes reported by instrumented operations (API response sizes).",
+              f"# TYPE {prefix}_span_bytes_total counter"]
+    for name, labels, _, _, _, n_bytes, _, _, _ in snapshot:
+        if n_bytes:
+            lines.append(f"{prefix}_span_bytes_total{_prometheus_labels(labels, span=name)} {n_bytes}")
+    return "\n".join(lines) + "\n"
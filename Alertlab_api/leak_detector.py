@@ -0,0 +1,320 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import deque
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api import timeseries_store
+from Alertlab_api.rollups import NIGHT_HOURS, LOCAL_OFFSET_HOURS
+from Alertlab_api.aws_utils import get_logger_and_log_stream
+
+logger, log_stream = get_logger_and_log_stream()
+
+#########################################################################################################################
+# STREAMING LEAK DETECTOR
+# Watches the minute water series of every sensor as it lands in the store and flags
+#   continuous_flow   water has not stopped for CONTINUOUS_FLOW_HOURS (value: lowest flow over the last
+#                     MIN_FLOW_WINDOW_MINUTES, i.e. the leak rate, in litres per minute)
+#   night_flow_spike  a night's 1-5 AM mean flow is NIGHT_SPIKE_RATIO times the EWMA of the previous nights
+#                     (the same night window as the dashboard's night KPI)
+# State per sensor is O(1) per sample: the current non-zero run, a monotonic deque for the windowed minimum,
+# the running sum of the current night and the EWMA of past nights. Each sensor has a cursor; catch_up reads the
+# store's held minute rows from the cursor up to the settled edge, so it does not matter whether the backfill
+# daemon, the dashboard or anything else fetched them. Layout:
+#   <STORE_DIR>/_leak_detector/state/<sensor id>.json
+#   <STORE_DIR>/_leak_detector/events.jsonl          (one event per line, what the dashboard lists)
+# replay() runs a fresh in-memory detector over recorded series, for checking thresholds against history.
+
+RATE = "m"
+SERIES = "W"
+STEP_MS = timeseries_store.RATE_SECONDS[RATE] * 1000
+CONTINUOUS_FLOW_HOURS = float(os.getenv("LEAK_CONTINUOUS_FLOW_HOURS", "4"))
+MIN_FLOW_WINDOW_MINUTES = int(os.getenv("LEAK_MIN_FLOW_WINDOW_MINUTES", "60"))
+# Readings at or below this (litres per minute) count as no flow
+NO_FLOW_LITRES = float(os.getenv("LEAK_NO_FLOW_LITRES", "0"))
+NIGHT_SPIKE_RATIO = float(os.getenv("LEAK_NIGHT_SPIKE_RATIO", "1.5"))
+# Night means below this (litres per minute) are never a spike, however quiet the previous nights were
+NIGHT_SPIKE_MIN_LITRES = float(os.getenv("LEAK_NIGHT_SPIKE_MIN_LITRES", "0.5"))
+NIGHT_EWMA_ALPHA = float(os.getenv("LEAK_NIGHT_EWMA_ALPHA", "0.2"))
+NIGHT_WARMUP = int(os.getenv("LEAK_NIGHT_WARMUP", "3"))
+# A night with readings for less than this share of its minutes is not judged
+NIGHT_MIN_COVERAGE = 0.5
+NIGHT_MINUTES = 5 * 60
+# A first catch_up starts at most this far back
+LOOKBACK_DAYS = int(os.getenv("LEAK_LOOKBACK_DAYS", "7"))
+
+
+def _detector_dir(root=None):
+    return os.path.join(root or timeseries_store.STORE_DIR, "_leak_detector")
+
+
+def _local_day(time_ms):
+    return int((time_ms // 3600000 + LOCAL_OFFSET_HOURS) // 24)
+
+
+class SensorLeakState:
+    def __init__(self, sensor_id):
+        self.sensor_id = sensor_id
+        self.cursor_ms = None  # next sample time to look at
+        self.last_time_ms = None
+        self.run_start_ms = None  # start of the current non-zero run
+        self.run_alerted = False
+        self.window = deque()  # (time_ms, value), values increasing: window[0] is the windowed minimum
+        self.night_day = None
+        self.night_start_ms = None
+        self.night_end_ms = None
+        self.night_sum = 0.0
+        self.night_count = 0
+        self.night_ewma = None
+        self.nights_seen = 0
+
+    def push(self, time_ms, value):
+        """Fold in one sample (in time order) and return the events it completes."""
+        events = []
+        time_ms, value = int(time_ms), float(value)
+        contiguous = self.last_time_ms is not None and time_ms - self.last_time_ms <= 2 * STEP_MS
+
+        # Windowed minimum over the last MIN_FLOW_WINDOW_MINUTES
+        if not contiguous:
+            self.window.clear()
+        while self.window and self.window[-1][1] >= value:
+            self.window.pop()
+        self.window.append((time_ms, value))
+        while self.window[0][0] <= time_ms - MIN_FLOW_WINDOW_MINUTES * 60000:
+            self.window.popleft()
+
+        # Consecutive flow
+        if value > NO_FLOW_LITRES:
+            if self.run_start_ms is None or not contiguous:
+                self.run_start_ms, self.run_alerted = time_ms, False
+            if not self.run_alerted and time_ms + STEP_MS - self.run_start_ms >= CONTINUOUS_FLOW_HOURS * 3600000:
+                self.run_alerted = True
+                events.append(self._event("continuous_flow", self.run_start_ms, time_ms, self.window[0][1], self.night_ewma))
+        else:
+            self.run_start_ms, self.run_alerted = None, False
+
+        # Night mean against the EWMA of earlier nights (rollups.is_night, inlined for scalars)
+        night = NIGHT_HOURS[0] <= (time_ms // 3600000 + LOCAL_OFFSET_HOURS) % 24 <= NIGHT_HOURS[1]
+        if self.night_count and (not night or _local_day(time_ms) != self.night_day):
+            events += self._close_night()
+        if night:
+            if not self.night_count:
+                self.night_day, self.night_start_ms = _local_day(time_ms), time_ms
+            self.night_sum += value
+            self.night_count += 1
+            self.night_end_ms = time_ms
+
+        self.last_time_ms = time_ms
+        self.cursor_ms = time_ms + STEP_MS
+        return events
+
+    def _close_night(self):
+        events = []
+        mean = self.night_sum / self.night_count
+        if self.night_count >= NIGHT_MIN_COVERAGE * NIGHT_MINUTES:
+            if (self.nights_seen >= NIGHT_WARMUP and mean >= NIGHT_SPIKE_MIN_LITRES
+                    and mean > NIGHT_SPIKE_RATIO * self.night_ewma):
+                events.append(self._event("night_flow_spike", self.night_start_ms, self.night_end_ms, mean, self.night_ewma))
+            self.night_ewma = mean if self.night_ewma is None else NIGHT_EWMA_ALPHA * mean + (1 - NIGHT_EWMA_ALPHA) * self.night_ewma
+            self.nights_seen += 1
+        self.night_day, self.night_start_ms, self.night_end_ms = None, None, None
+        self.night_sum, self.night_count = 0.0, 0
+        return events
+
+    def _event(self, kind, start_ms, end_ms, value, baseline):
+        return {"sensor_id": self.sensor_id, "kind": kind, "start_ms": int(start_ms), "end_ms": int(end_ms),
+                "value": round(float(value), 3), "baseline": None if baseline is None else round(float(baseline), 3),
+                "detected_at": int(time.time())}
+
+    def to_dict(self):
+        data = {k: v for k, v in self.__dict__.items() if k != "window"}
+        data["window"] = list(self.window)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls(data["sensor_id"])
+        state.__dict__.update({k: v for k, v in data.items() if k != "window"})
+        state.window = deque(tuple(item) for item in data.get("window", []))
+        return state
+
+
+class LeakDetector:
+    """
+    Per-sensor states plus the event table. persist=False keeps everything in memory (replay, tests);
+    clock can be swapped for a fake.
+    """
+
+    def __init__(self, root=None, persist=True, clock=time.time):
+        self.root = root
+        self.persist = persist
+        self._clock = clock
+        self._states = {}
+        self._lock = threading.Lock()
+        self.events = []  # events found by an in-memory instance (persisted ones go to the event table)
+
+    def _state_path(self, sensor_id):
+        return os.path.join(_detector_dir(self.root), "state", f"{sensor_id}.json")
+
+    def state(self, sensor_id):
+        state = self._states.get(sensor_id)
+        if state is None and self.persist:
+            try:
+                with open(self._state_path(sensor_id), "r") as f:
+                    state = SensorLeakState.from_dict(json.load(f))
+            except FileNotFoundError:
+                pass
+            except (ValueError, KeyError, OSError) as e:
+                logger.error(f"Unreadable leak detector state for sensor {sensor_id}, starting over: {e}")
+        state = state or SensorLeakState(sensor_id)
+        self._states[sensor_id] = state
+        return state
+
+    def feed(self, sensor_id, time_ms, values):
+        """Fold in samples (sorted by time); the ones before the sensor's cursor are skipped. Returns new events."""
+        time_ms = np.asarray(time_ms, dtype='int64')
+        values = np.nan_to_num(np.asarray(values, dtype='float64'))
+        with self._lock:
+            state = self.state(sensor_id)
+            start = 0 if state.cursor_ms is None else int(np.searchsorted(time_ms, state.cursor_ms, side='left'))
+            events = []
+            for t, v in zip(time_ms[start:].tolist(), values[start:].tolist()):
+                events += state.push(t, v)
+            if start < len(time_ms):
+                self._save(state, events)
+        return events
+
+    def _save(self, state, events):
+        if not self.persist:
+            self.events += events
+            return
+        directory = _detector_dir(self.root)
+        os.makedirs(os.path.join(directory, "state"), exist_ok=True)
+        timeseries_store._atomic_write_bytes(self._state_path(state.sensor_id), json.dumps(state.to_dict()).encode("utf-8"))
+        if events:
+            with open(os.path.join(directory, "events.jsonl"), "a") as f:
+                f.write("".join(json.dumps(event) + "\n" for event in events))
+            for event in events:
+                logger.warning(f"Leak detector: {event['kind']} on sensor {event['sensor_id']} (value {event['value']}, baseline {event['baseline']})")
+
+    def catch_up(self, sensor_id):
+        """Feed the sensor's held, settled minute rows from its cursor on. Returns new events."""
+        settled_ms = (int(self._clock()) - timeseries_store.SETTLE_SECONDS) * 1000
+        coverage = timeseries_store.merge_intervals(timeseries_store.read_coverage(sensor_id, SERIES, RATE, self.root))
+        with self._lock:
+            cursor_ms = self.state(sensor_id).cursor_ms
+        if cursor_ms is None:
+            cursor_ms = (int(self._clock()) - LOOKBACK_DAYS * 86400) * 1000
+        events = []
+        for c_start, c_end in coverage:
+            # Coverage is in seconds, [start, end); a gap the store never filled is skipped (and breaks any run)
+            start_ms, end_ms = max(c_start * 1000, cursor_ms), min(c_end * 1000, settled_ms)
+            if end_ms <= start_ms:
+                continue
+            rows = timeseries_store.read_rows(sensor_id, start_ms // 1000, (end_ms - 1) // 1000, RATE, SERIES, self.root)
+            if not rows.empty:
+                events += self.feed(sensor_id, rows['time'].to_numpy(), rows['series'].to_numpy())
+        return events
+
+
+def replay(series_by_sensor):
+    """
+    Run a fresh in-memory detector over recorded series {sensor_id: (time_ms, values)} (or frames with
+    'time' and 'series') and return the events it raises, in order.
+    """
+    detector = LeakDetector(persist=False)
+    for sensor_id, recorded in series_by_sensor.items():
+        if isinstance(recorded, pd.DataFrame):
+            recorded = (recorded['time'].to_numpy(), recorded['series'].to_numpy())
+        detector.feed(sensor_id, *recorded)
+    return detector.events
+
+
+def read_events(sensor_ids=None, since_ms=None, root=None):
+    """Events from the table, newest first, as a DataFrame (empty if there are none)."""
+    columns = ["sensor_id", "kind", "start_ms", "end_ms", "value", "baseline", "detected_at"]
+    path = os.path.join(_detector_dir(root), "events.jsonl")
+    events = []
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue  # a line cut short by a crash
+    except FileNotFoundError:
+        pass
+    df = pd.DataFrame(events, columns=columns)
+    if sensor_ids is not None:
+        df = df[df["sensor_id"].isin(list(sensor_ids))]
+    if since_ms is not None:
+        df = df[df["end_ms"] >= since_ms]
+    df = df.sort_values("end_ms", ascending=False).reset_index(drop=True)
+    # Same local clock as the charts (UTC-4)
+    df["start"] = pd.to_datetime(df["start_ms"], unit='ms') + pd.Timedelta(hours=LOCAL_OFFSET_HOURS)
+    df["end"] = pd.to_datetime(df["end_ms"], unit='ms') + pd.Timedelta(hours=LOCAL_OFFSET_HOURS)
+    return df
+
+
+_detector = None
+_detector_lock = threading.Lock()
+
+
+def get_detector():
+    global _detector
+    with _detector_lock:
+        if _detector is None:
+            _detector = LeakDetector()
+        return _detector
+
+
+def set_detector(detector):
+    global _detector
+    with _detector_lock:
+        _detector = detector
+
+
+def on_rows(sensor_id, rows, rate, series):
+    """Backfill daemon listener (see BackfillDaemon.listeners)."""
+    if rate == RATE and series == SERIES:
+        get_detector().catch_up(sensor_id)
+
+
+def on_rows_written(sensor_id, rate, series, days, root=None):
+    """Store write listener, for processes other than the backfill daemon that should run the detector."""
+    if rate == RATE and series == SERIES and root == get_detector().root:
+        get_detector().catch_up(sensor_id)
+
+
+def enable():
+    """Run the detector on every minute write to the store from this process."""
+    timeseries_store.add_write_listener(on_rows_written)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded minute series through the leak detector.")
+    parser.add_argument("--store", help="store directory to replay (default: the configured store)")
+    parser.add_argument("--sensor", action="append", dest="sensors", help="only this sensor id (repeatable)")
+    parser.add_argument("--csv", action="append", default=[], help="a CSV with time (ms) and series columns, named after its file")
+    parser.add_argument("--days", type=int, default=30, help="how far back to replay from the store")
+    args = parser.parse_args(argv)
+
+    recorded = {os.path.splitext(os.path.basename(path))[0]: pd.read_csv(path) for path in args.csv}
+    if not args.csv:
+        root = args.store or timeseries_store.STORE_DIR
+        sensors = args.sensors or sorted(name.split("=", 1)[1] for name in os.listdir(root) if name.startswith("sensor="))
+        end = int(time.time())
+        for sensor_id in sensors:
+            recorded[sensor_id] = timeseries_store.read_rows(sensor_id, end - args.days * 86400, end, RATE, SERIES, root)
+    events = replay(recorded)
+    for event in events:
+        print(json.dumps(event))
+    logger.info(f"Replayed {len(recorded)} sensor(s), {len(events)} event(s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import sys
+import gzip
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+
+#########################################################################################################################
+# S3 LOG SHIPPER
+# A logging handler that keeps records in a small in-memory segment, seals the segment once it reaches
+# max_segment_bytes or max_segment_seconds, and has a background thread upload sealed segments gzip'd, each
+# under its own key:
+#   <prefix>part-00001.log.gz, <prefix>part-00002.log.gz, ...
+# At most max_buffer_bytes of log text are held; if S3 is unreachable for long enough the oldest sealed
+# segments are dropped (and the drop is noted in the next segment) rather than letting memory grow.
+# It does not import aws_utils, so any object with put_object(Bucket=, Key=, Body=, ...) can stand in for S3.
+
+
+class S3LogShipper(logging.Handler):
+    """
+    client: a boto3 S3 client (or stand-in), or a callable returning one, so it can be created lazily.
+    clock can be swapped for a fake in tests; start_thread=False leaves flushing to explicit flush() calls.
+    """
+
+    def __init__(self, client, bucket, prefix, max_segment_bytes=256 * 1024, max_segment_seconds=300,
+                 max_buffer_bytes=4 * 1024 * 1024, flush_interval=30, clock=time.time, start_thread=True):
+        super().__init__()
+        self._client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_seconds = max_segment_seconds
+        self.max_buffer_bytes = max_buffer_bytes
+        self.flush_interval = flush_interval
+        self._clock = clock
+        self._segment = []
+        self._segment_bytes = 0
+        self._segment_started = None
+        self._sealed = deque()  # (sequence number, bytes) waiting for upload
+        self._sealed_bytes = 0
+        self._sequence = 0
+        self._dropped_bytes = 0
+        self._upload_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self.uploaded_segments = 0
+        self.uploaded_bytes = 0
+        self._thread = None
+        if start_thread and bucket:
+            self._thread = threading.Thread(target=self._run, name="s3-log-shipper", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    ##### Buffering
+
+    def emit(self, record):
+        try:
+            line = (self.format(record) + "\n").encode("utf-8", errors="replace")
+        except Exception:
+            self.handleError(record)
+            return
+        with self.lock:
+            if self._segment_started is None:
+                self._segment_started = self._clock()
+            self._segment.append(line)
+            self._segment_bytes += len(line)
+            if self._segment_bytes >= self.max_segment_bytes:
+                self._seal()
+        if self._sealed and self._thread is not None:
+            self._wake.set()
+
+    def _seal(self):
+        """Close the current segment and queue it for upload (caller holds self.lock)."""
+        if not self._segment:
+            return
+        data = b"".join(self._segment)
+        if self._dropped_bytes:
+            note = f"--- {self._dropped_bytes} bytes of earlier log records dropped, S3 upload was falling behind ---\n"
+            data = note.encode("utf-8") + data
+            self._dropped_bytes = 0
+        self._sequence += 1
+        self._sealed.append((self._sequence, data))
+        self._sealed_bytes += len(data)
+        self._segment, self._segment_bytes, self._segment_started = [], 0, None
+        self._enforce_cap()
+
+    def _enforce_cap(self):
+        while self._sealed and self._sealed_bytes + self._segment_bytes > self.max_buffer_bytes:
+            _, data = self._sealed.popleft()
+            self._sealed_bytes -= len(data)
+            self._dropped_bytes += len(data)
+
+    def rotate(self, force=False):
+        """Seal the current segment if it is old enough (or unconditionally with force)."""
+        with self.lock:
+            if self._segment and (force or self._clock() - self._segment_started >= self.max_segment_seconds):
+                self._seal()
+
+    def buffered_bytes(self):
+        with self.lock:
+            return self._sealed_bytes + self._segment_bytes
+
+    def getvalue(self):
+        """Log text still held in memory (not uploaded yet), like StringIO.getvalue()."""
+        with self.lock:
+            data = b"".join([d for _, d in self._sealed] + self._segment)
+        return data.decode("utf-8", errors="replace")
+
+    ##### Uploading
+
+    def key_for(self, sequence):
+        return f"{self.prefix}part-{sequence:05d}.log.gz"
+
+    def _s3(self):
+        return self._client() if callable(self._client) and not hasattr(self._client, "put_object") else self._client
+
+    def flush(self, force=True):
+        """Upload every sealed segment; with force the current segment is sealed and uploaded too."""
+        if not self.bucket:
+            return 0
+        self.rotate(force=force)
+        uploaded = 0
+        with self._upload_lock:
+            while True:
+                with self.lock:
+                    if not self._sealed:
+                        break
+                    sequence, data = self._sealed[0]
+                try:
+                    self._s3().put_object(Bucket=self.bucket, Key=self.key_for(sequence), Body=gzip.compress(data),
+                                          ContentType="text/plain", ContentEncoding="gzip")
+                except Exception as e:
+                    # Not through logging: the record would land back in this handler. The segment stays queued.
+                    print(f"Failed to upload log segment {self.key_for(sequence)} to S3: {e}", file=sys.stderr)
+                    break
+                with self.lock:
+                    if self._sealed and self._sealed[0][0] == sequence:
+                        self._sealed.popleft()
+                        self._sealed_bytes -= len(data)
+                self.uploaded_segments += 1
+                self.uploaded_bytes += len(data)
+                uploaded += 1
+        return uploaded
+
+    def request_flush(self):
+        """Ask the background thread to upload everything buffered so far, without waiting for it."""
+        with self.lock:
+            self._seal()
+        if self._thread is not None:
+            self._wake.set()
+        else:
+            self.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush(force=False)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self.flush()
+        super().close()
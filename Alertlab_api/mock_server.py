@@ -0,0 +1,328 @@
+import io
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+
+#########################################################################################################################
+# LOCAL MOCK ALERTLABS SERVER
+# Serves the handful of v4 endpoints alertlab_api.py uses with deterministic synthetic data, so headless
+# tools can be exercised without credentials or quota:
+#   server, base_url = start_mock_server()
+#   alertlab_api.set_base_url(base_url)
+# Only the request path is matched, the host part of the real URLs is replaced by set_base_url.
+# For benchmarks it can add per-request latency, enforce a request rate (429 + Retry-After like the real API)
+# and serve recorded locations / sensors / property details (see record_fixtures) instead of generated ones.
+# MockS3 stands in for the bucket behind the shared timeseries cache.
+
+RATE_MS = {"m": 60 * 1000, "h": 3600 * 1000, "d": 86400 * 1000}
+MOCK_TOKEN = "mock-token"
+
+
+def _location(i):
+    return {"_id": f"loc-{i}", "name": f"Mock Property {i}", "parentID": "org-0", "nodeType": "building"}
+
+
+def _sensor(i, n_locations):
+    return {
+        "_id": f"sensor-{i}",
+        "name": f"Mock Flowie {i}",
+        "serialNumber": f"SN{i:05d}",
+        "friendlyType": "Flowie-O" if i % 2 else "Flowie",
+        "location_id": f"loc-{i % n_locations}",
+    }
+
+
+def synthetic_values(sensor_id, times_ms, rate="m", coarse="sample"):
+    """
+    Deterministic litres per bucket (numpy array, one per bucket start in times_ms) with a daily pattern and a
+    small night baseline. How coarser buckets are built is a parameter, since the real API's aggregation is not
+    documented: "sample" scales the bucket's first minute to the bucket length, "sum" adds up its minutes.
+    """
+    times_ms = np.asarray(times_ms, dtype='int64')
+    if rate != "m" and coarse == "sum":
+        minutes = times_ms[:, None] + np.arange(0, RATE_MS[rate], RATE_MS["m"], dtype='int64')[None, :]
+        return np.round(synthetic_values(sensor_id, minutes.ravel(), "m").reshape(minutes.shape).sum(axis=1), 3)
+    if rate != "m":
+        return np.round(synthetic_values(sensor_id, times_ms, "m") * (RATE_MS[rate] // RATE_MS["m"]), 3)
+    # Cheap integer hash of (sensor, minute) so a month of minutes is generated without a Python loop
+    x = (times_ms // RATE_MS["m"]).astype('uint64') * np.uint64(2654435761) ^ np.uint64(zlib.crc32(sensor_id.encode()))
+    x ^= x >> np.uint64(15)
+    x *= np.uint64(0x2C1B3C6D)
+    x ^= x >> np.uint64(12)
+    noise = (x % np.uint64(1000)).astype('float64') / 1000.0
+    hour = (times_ms // 3600000) % 24
+    return np.round(np.where((hour >= 1) & (hour <= 5), 0.2 + noise, 2.0 + 3.0 * noise), 3)
+
+
+def synthetic_value(sensor_id, time_ms, rate="m", coarse="sample"):
+    return float(synthetic_values(sensor_id, [time_ms], rate, coarse)[0])
+
+
+class MockAlertLabs:
+    """The data set and request counters behind the HTTP handler."""
+
+    def __init__(self, n_sensors=8, n_locations=4, latency=0.0, jitter=0.0, requests_per_hour=None, burst=5, fixtures_dir=None,
+                 coarse="sample"):
+        """
+        coarse: how hourly / daily buckets are built from minutes, "sample" or "sum" (see synthetic_values).
+        latency / jitter: seconds added to every response (jitter is uniform on top of latency).
+        requests_per_hour / burst: answer 429 with Retry-After beyond this rate, None for no limit.
+        fixtures_dir: directory written by record_fixtures; its locations, sensors and property details replace the generated ones.
+        """
+        self.locations = [{"_id": "org-0", "name": "Mock Org", "nodeType": "org"}] + [_location(i) for i in range(n_locations)]
+        self.sensors = [_sensor(i, n_locations) for i in range(n_sensors)]
+        self.property_details = {}
+        self.coarse = coarse
+        self.latency = latency
+        self.jitter = jitter
+        self.requests_per_hour = requests_per_hour
+        self.burst = burst
+        self._allowance = float(burst)
+        self._allowance_at = time.monotonic()
+        self.requests = {}
+        self.bytes_sent = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        if fixtures_dir:
+            self.load_fixtures(fixtures_dir)
+
+    def load_fixtures(self, directory):
+        for name in ("locations", "sensors", "property_details"):
+            path = os.path.join(directory, f"{name}.json")
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    data = json.load(f)
+                if name == "property_details":
+                    self.property_details = {record["_id"]: record for record in data}
+                else:
+                    setattr(self, name, data)
+
+    def count(self, route, n_bytes):
+        with self._lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+            self.bytes_sent += n_bytes
+
+    def admit(self):
+        """0 if a request may be served now, otherwise the seconds to put in Retry-After."""
+        if not self.requests_per_hour:
+            return 0
+        rate = self.requests_per_hour / 3600.0
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.burst, self._allowance + (now - self._allowance_at) * rate)
+            self._allowance_at = now
+            if self._allowance >= 1:
+                self._allowance -= 1
+                return 0
+            self.throttled += 1
+            return max(1, int((1 - self._allowance) / rate + 0.999))
+
+    def delay(self):
+        return self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def timeseries(self, sensor_id, start, end, rate):
+        step = RATE_MS.get(rate, RATE_MS["h"])
+        t = (int(float(start)) * 1000 // step) * step
+        end_ms = int(float(end)) * 1000
+        times = np.arange(t, end_ms + 1, step, dtype='int64')
+        values = synthetic_values(sensor_id, times, rate, self.coarse)
+        return {"error": None, "dataModel": {sensor_id: [[int(t), float(v)] for t, v in zip(times, values)]}}
+
+    def route(self, method, path, query, body):
+        """Return (route_name, status, payload dict) for a request."""
+        if method == "GET" and path == "/_mock/stats":
+            with self._lock:
+                return "stats", 200, {"requests": dict(self.requests), "bytes_sent": self.bytes_sent, "throttled": self.throttled}
+        if method == "POST" and path == "/api/v4/public/login":
+            return "login", 201, {"token": MOCK_TOKEN}
+        if method == "POST" and path == "/api/v4/login":
+            return "hidden_login", 201, {"access_token": MOCK_TOKEN}
+        if method == "GET" and path == "/api/v4/public/sensors":
+            return "sensors", 200, {"error": None, "dataModel": self.sensors}
+        if method == "GET" and path == "/api/v4/public/locations":
+            return "locations", 200, {"error": None, "dataModel": self.locations}
+        if method == "GET" and path == "/api/v4/public/timeseries":
+            sensor_id = query.get("sensorID", [None])[0]
+            if sensor_id not in {s["_id"] for s in self.sensors}:
+                return "timeseries", 200, {"error": "unknown sensor", "dataModel": None}
+            return "timeseries", 200, self.timeseries(sensor_id, query["from"][0], query["to"][0], query.get("rate", ["h"])[0])
+        if method == "POST" and path == "/api/v4/dataModel/read":
+            where = json.loads(body or b"{}").get("locationsV2", {}).get("where", {}).get("_id", {})
+            ids = where.get("$in") or [where.get("$eq")]
+            records = [self.property_details.get(i) or {"_id": i, "numberSuites": 4, "numberFloors": 2,
+                       "commercialPropertyType": "Residential", "age": 30, "users": ["u1"]} for i in ids if i]
+            return "property_details", 200, {"error": None, "dataModel": records}
+        return "unknown", 404, {"error": f"no mock route for {method} {path}"}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self, method):
+        parsed = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        mock = self.server.mock
+        # The stats route is for the benchmark harness and is neither delayed, limited nor counted.
+        is_stats = parsed.path == "/_mock/stats"
+        delay = 0 if is_stats else mock.delay()
+        if delay > 0:
+            time.sleep(delay)
+        retry_after = 0 if is_stats else mock.admit()
+        if retry_after:
+            route, status, payload = "throttled", 429, {"error": "Too Many Requests"}
+        else:
+            route, status, payload = mock.route(method, parsed.path, parse_qs(parsed.query), body)
+        data = json.dumps(payload).encode("utf-8")
+        if not is_stats:
+            mock.count(route, len(data))
+        self.send_response(status)
+        if retry_after:
+            self.send_header("Retry-After", str(retry_after))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_server(mock=None, host="127.0.0.1", port=0):
+    """Start the mock server on a background thread. Returns (server, base_url); call server.shutdown() when done."""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.mock = mock or MockAlertLabs()
+    threading.Thread(target=server.serve_forever, name="mock-alertlabs", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+class MockS3:
+    """
+    Just enough of a boto3 S3 client for the shared timeseries cache (see shared_cache.py): put_object (with
+    IfNoneMatch='*'), get_object and head_object, raising botocore's ClientError with S3's error codes.
+    Objects live in memory, or under directory/<bucket>/<key> if a directory is given, so several processes
+    (dashboard replicas) can share one. calls counts requests per operation.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._objects = {}
+        self._lock = threading.Lock()
+        self.calls = {"put_object": 0, "get_object": 0, "head_object": 0}
+
+    @staticmethod
+    def _error(code, status, operation):
+        from botocore.exceptions import ClientError
+        return ClientError({"Error": {"Code": code, "Message": code}, "ResponseMetadata": {"HTTPStatusCode": status}}, operation)
+
+    def _path(self, bucket, key):
+        return os.path.join(self.directory, bucket, *key.split("/"))
+
+    def _read(self, bucket, key):
+        if self.directory is None:
+            return self._objects.get((bucket, key))
+        try:
+            with open(self._path(bucket, key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None, **kwargs):
+        body = Body.read() if hasattr(Body, "read") else (Body.encode("utf-8") if isinstance(Body, str) else bytes(Body))
+        with self._lock:
+            self.calls["put_object"] += 1
+            if self.directory is None:
+                if IfNoneMatch == "*" and (Bucket, Key) in self._objects:
+                    raise self._error("PreconditionFailed", 412, "PutObject")
+                self._objects[(Bucket, Key)] = body
+                return {"ETag": f'"{zlib.crc32(body):08x}"'}
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(body)
+        if IfNoneMatch == "*":
+            # A hard link fails if the key exists, so only one writer across processes wins
+            try:
+                os.link(tmp_path, path)
+            except FileExistsError:
+                raise self._error("PreconditionFailed", 412, "PutObject")
+            finally:
+                os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+        return {"ETag": f'"{zlib.crc32(body):08x}"'}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        with self._lock:
+            self.calls["get_object"] += 1
+        body = self._read(Bucket, Key)
+        if body is None:
+            raise self._error("NoSuchKey", 404, "GetObject")
+        return {"Body": io.BytesIO(body), "ContentLength": len(body)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        with self._lock:
+            self.calls["head_object"] += 1
+        body = self._read(Bucket, Key)
+        if body is None:
+            # HEAD responses have no body, so boto reports the bare status code
+            raise self._error("404", 404, "HeadObject")
+        return {"ContentLength": len(body)}
+
+
+def record_fixtures(directory, token=None):
+    """
+    Save the account's real locations, sensors and property details for MockAlertLabs(fixtures_dir=...).
+    They contain client names, so keep the directory out of git (benchmarks/fixtures/ is ignored).
+    """
+    from Alertlab_api import alertlab_api
+    token = token or alertlab_api.get_token()
+    os.makedirs(directory, exist_ok=True)
+    locations = alertlab_api.get_locations(token)
+    sensors = alertlab_api.get_all_sensors(token)
+    details = alertlab_api.get_property_detailsv4_batch([l["_id"] for l in locations])
+    for name, data in (("locations", locations), ("sensors", sensors), ("property_details", details)):
+        with open(os.path.join(directory, f"{name}.json"), "w") as f:
+            json.dump(data, f)
+    return len(locations), len(sensors)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a local mock AlertLabs API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--sensors", type=int, default=8)
+    parser.add_argument("--locations", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--requests-per-hour", type=int, default=None, help="answer 429 beyond this rate")
+    parser.add_argument("--fixtures", help="directory written by record_fixtures")
+    parser.add_argument("--coarse", default="sample", choices=["sample", "sum"], help="how hourly / daily buckets are built from minutes")
+    args = parser.parse_args(argv)
+    mock = MockAlertLabs(args.sensors, args.locations, latency=args.latency, requests_per_hour=args.requests_per_hour, fixtures_dir=args.fixtures,
+                         coarse=args.coarse)
+    server, base_url = start_mock_server(mock, args.host, args.port)
+    print(f"Mock AlertLabs API on {base_url} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
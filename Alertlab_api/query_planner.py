@@ -0,0 +1,93 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api.alertlab_api import fetch_timeseries_batch, TIMESERIES_WORKERS
+from Alertlab_api.timeseries_store import align_range, merge_intervals
+from Alertlab_api.aws_utils import get_logger_and_log_stream
+
+logger, log_stream = get_logger_and_log_stream()
+
+#########################################################################################################################
+# QUERY PLANNER
+# A dashboard Query needs several overlapping windows of the same sensors (7 day KPIs, heatmap, chart).
+# The plan collects them first, fetches the smallest set of ranges that covers all of them once,
+# and then hands every window a row slice of the fetched batches.
+
+
+class QueryPlan:
+    """
+    example_usage:
+        plan = QueryPlan(token=token)
+        plan.add("seven_day", sensor_list, seven_days_ago_unix, today_unix, rate="h", series="W")
+        plan.add("chart", queried_sensors, start_date_unix, end_date_unix, rate="m", series="W")
+        plan.execute()
+        seven_day_dataframes = plan.get("seven_day")
+    """
+
+    def __init__(self, token=None, use_store=True, max_workers=TIMESERIES_WORKERS):
+        self.token = token
+        self.use_store = use_store
+        self.max_workers = max_workers
+        self._windows = {}
+        # (sensor, rate, series) -> list of (start, end, dataframe) covering ranges
+        self._fetched = {}
+        self.errors = {}
+
+    def add(self, name, sensor_list, start_date, end_date, rate="h", series="W"):
+        """Register a window the page needs. Nothing is fetched until execute()."""
+        start, _ = align_range(start_date, end_date, rate)
+        self._windows[name] = (list(sensor_list), start, int(float(end_date)), rate, series)
+
+    def has(self, name):
+        return name in self._windows
+
+    def covering_fetches(self):
+        """
+        Minimal covering ranges per sensor/rate/series, grouped so that sensors needing the
+        exact same range are fetched in one batch: {(start, end, rate, series): [sensor, ...]}
+        """
+        intervals = {}
+        for sensor_list, start, end, rate, series in self._windows.values():
+            for sensor in sensor_list:
+                # Windows are inclusive of their end, so touching windows are merged as well.
+                intervals.setdefault((sensor, rate, series), []).append((start, end + 1))
+        batches = {}
+        for (sensor, rate, series), sensor_intervals in intervals.items():
+            for start, end in merge_intervals(sensor_intervals):
+                batches.setdefault((start, end - 1, rate, series), []).append(sensor)
+        return batches
+
+    def execute(self):
+        batches = self.covering_fetches()
+        logger.info(f"Query plan: {len(self._windows)} window(s) collapsed into {sum(len(s) for s in batches.values())} sensor fetch(es)")
+        for (start, end, rate, series), sensor_list in batches.items():
+            results = fetch_timeseries_batch(sensor_list, start, end, rate=rate, series=series, token=self.token,
+                                             use_store=self.use_store, max_workers=self.max_workers)
+            for sensor, df, error in results:
+                if error is not None:
+                    self.errors[sensor] = error
+                if df is not None:
+                    self._fetched.setdefault((sensor, rate, series), []).append((start, end, df))
+        return self
+
+    def _slice(self, sensor, start, end, rate, series):
+        for fetched_start, fetched_end, df in self._fetched.get((sensor, rate, series), []):
+            if fetched_start <= start and end <= fetched_end:
+                # A slice of the batch's arrays is a view, not a copy.
+                return df.between(start * 1000, end * 1000)
+        return None
+
+    def get(self, name):
+        """
+        TimeseriesBatches for a registered window, in the order of its sensor list, with failed sensors left out
+        (same contract as get_list_timeseries). They share arrays with the fetched batches, treat them as read-only.
+        """
+        sensor_list, start, end, rate, series = self._windows[name]
+        frames = []
+        for sensor in sensor_list:
+            df = self._slice(sensor, start, end, rate, series)
+            if df is not None:
+                frames.append(df)
+        if not frames and any(sensor in self.errors for sensor in sensor_list):
+            raise next(self.errors[sensor] for sensor in sensor_list if sensor in self.errors)
+        return frames
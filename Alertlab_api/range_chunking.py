@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api.aws_utils import get_logger_and_log_stream
+from Alertlab_api.timeseries_batch import TimeseriesBatch
+
+logger, log_stream = get_logger_and_log_stream()
+
+#########################################################################################################################
+# RANGE CHUNKING
+# A multi-month window at minute resolution is one slow, all-or-nothing request. Long windows are split into
+# chunks of CHUNK_DAYS[rate] (boundaries on multiples of the chunk length since the epoch, so they line up
+# with the store's buckets and day partitions), fetched concurrently through the usual scheduler, retried
+# chunk by chunk, and stitched back together. Every chunk is a request against the hourly budget (3600/h,
+# burst of 5), so chunks are kept large and windows that fit in one chunk length are not split at all.
+# Ranges here are [start, end) in unix seconds, like store gaps; the API's `to` is inclusive, so neighbouring
+# chunks share their boundary bucket and stitch() drops the copy.
+
+CHUNK_DAYS = {
+    "m": float(os.getenv("ALERTLABS_MINUTE_CHUNK_DAYS", "15")),  # ~21.6k rows / ~500 KB per request
+    "h": float(os.getenv("ALERTLABS_HOUR_CHUNK_DAYS", "180")),
+    "d": float(os.getenv("ALERTLABS_DAY_CHUNK_DAYS", "1825")),
+}
+# Chunks of one sensor fetched at once (the scheduler still caps the overall request rate)
+CHUNK_WORKERS = int(os.getenv("ALERTLABS_CHUNK_WORKERS", "4"))
+# Pools nested inside another pool (chunks of each sensor of a batch, sensors of each chunk) share its workers
+# through nested_workers, so a batch stays at about one pool's worth of threads instead of the product.
+# Extra attempts for a chunk whose request raised, waiting CHUNK_RETRY_SECONDS, then twice that, ...
+CHUNK_RETRIES = int(os.getenv("ALERTLABS_CHUNK_RETRIES", "2"))
+CHUNK_RETRY_SECONDS = float(os.getenv("ALERTLABS_CHUNK_RETRY_SECONDS", "1"))
+
+
+def chunk_seconds(rate):
+    return int(CHUNK_DAYS.get(rate, CHUNK_DAYS["h"]) * 86400)
+
+
+def split_range(start, end, rate):
+    """[start, end) cut at multiples of the rate's chunk length, as a list of [start, end) pieces."""
+    start, end = int(float(start)), int(float(end))
+    size = chunk_seconds(rate)
+    if end - start <= size:
+        return [(start, end)]
+    pieces = []
+    cursor = start
+    while cursor < end:
+        boundary = min((cursor // size + 1) * size, end)
+        pieces.append((cursor, boundary))
+        cursor = boundary
+    return pieces or [(start, end)]
+
+
+def nested_workers(workers, outer_workers):
+    """Workers for a pool run inside each of outer_workers concurrent tasks, so that together they use about `workers`."""
+    return max(1, workers // max(1, outer_workers))
+
+
+def split_ranges(ranges, rate):
+    return [piece for start, end in ranges for piece in split_range(start, end, rate)]
+
+
+def with_retries(fetch, retries=None, backoff=None, label="chunk"):
+    """fetch(start, end), called again after a pause if it raises. None (an API level error) is not retried."""
+    retries = CHUNK_RETRIES if retries is None else retries
+    backoff = CHUNK_RETRY_SECONDS if backoff is None else backoff
+
+    def fetch_with_retries(start, end):
+        for attempt in range(retries + 1):
+            try:
+                return fetch(start, end)
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                logger.warning(f"Fetching {label} {start}-{end} failed ({e}), retry {attempt + 1} of {retries}")
+                time.sleep(backoff * 2 ** attempt)
+    return fetch_with_retries
+
+
+def fetch_ranges(ranges, fetch, max_workers=None):
+    """
+    Call fetch(start, end) for every range, at most max_workers at once, and yield (start, end, result, error)
+    in range order as soon as each range (and every one before it) is done, so the caller can use the first
+    chunks while later ones are still in flight. Stopping the iteration early cancels the ranges not started yet.
+    """
+    max_workers = CHUNK_WORKERS if max_workers is None else max_workers
+
+    def call(start, end):
+        try:
+            return fetch(start, end), None
+        except Exception as e:
+            return None, e
+
+    if max_workers <= 1 or len(ranges) <= 1:
+        for start, end in ranges:
+            yield (start, end) + call(start, end)
+        return
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(ranges)))
+    try:
+        # Each task gets a copy of the caller's context so the request priority and trace carry over.
+        futures = [executor.submit(contextvars.copy_context().run, call, start, end) for start, end in ranges]
+        for (start, end), future in zip(ranges, futures):
+            yield (start, end) + future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def stitch(batches):
+    """Concatenate the batches of consecutive chunks into one, keeping the first copy of any repeated bucket."""
+    batch = TimeseriesBatch.concat(batches)
+    if len(batch) > 1 and not (np.diff(batch.time) > 0).all():
+        order = np.argsort(batch.time, kind='stable')
+        time_ms = batch.time[order]
+        keep = np.concatenate(([True], time_ms[1:] != time_ms[:-1]))
+        batch = batch.take(order[keep])
+    return batch
@@ -0,0 +1,221 @@
+import os
+import sys
+import time
+import heapq
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api.aws_utils import get_logger_and_log_stream
+
+logger, log_stream = get_logger_and_log_stream()
+
+#########################################################################################################################
+# REQUEST SCHEDULER
+# AlertLabs allows 3600 requests/hour (1 request/second) for the whole account, so every call in
+# alertlab_api.py waits for a token from one shared scheduler per process.
+
+REQUESTS_PER_HOUR = int(os.getenv("ALERTLABS_REQUESTS_PER_HOUR", "3600"))
+BURST = int(os.getenv("ALERTLABS_REQUEST_BURST", "5"))
+DEFAULT_RETRY_AFTER = 30
+
+# Priority classes, lower value is served first.
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", NORMAL: "normal", BACKGROUND: "background"}
+
+_current_priority = contextvars.ContextVar("alertlabs_request_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def request_priority(priority):
+    """
+    Run the API calls inside the block with the given priority class.
+    example_usage:
+        with request_priority(BACKGROUND):
+            get_list_timeseries(...)
+    """
+    reset_token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(reset_token)
+
+
+def current_priority():
+    return _current_priority.get()
+
+
+def parse_retry_after(value, default=DEFAULT_RETRY_AFTER):
+    """Retry-After is either a number of seconds or an HTTP date."""
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `burst` tokens."""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def time_until_available(self, tokens=1):
+        self._refill()
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    def consume(self, tokens=1):
+        self._refill()
+        self.tokens -= tokens
+
+    def drain(self):
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+class RequestScheduler:
+    """
+    Hands out request slots in priority order (then FIFO) at the bucket's rate.
+    A 429 (or a 503 with Retry-After) pauses every caller until the server says it is fine again.
+    clock and sleep can be swapped for fakes in tests.
+    """
+
+    def __init__(self, requests_per_hour=REQUESTS_PER_HOUR, burst=BURST, clock=time.monotonic, sleep=time.sleep, max_retries=3):
+        self._clock = clock
+        self._sleep = sleep
+        self._bucket = TokenBucket(requests_per_hour / 3600.0, burst, clock)
+        self._cond = threading.Condition(threading.Lock())
+        self._queue = []
+        self._counter = itertools.count()
+        self._blocked_until = 0.0
+        self.max_retries = max_retries
+        self._stats = {
+            "granted": {p: 0 for p in PRIORITY_NAMES},
+            "wait_total": {p: 0.0 for p in PRIORITY_NAMES},
+            "wait_max": {p: 0.0 for p in PRIORITY_NAMES},
+            "throttled": 0,
+            "retries": 0,
+        }
+
+    def acquire(self, priority=None):
+        """Block until this caller may send one request. Returns the seconds spent waiting."""
+        if priority is None:
+            priority = current_priority()
+        ticket = (priority, next(self._counter))
+        enqueued_at = self._clock()
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+            while True:
+                if self._queue[0] == ticket:
+                    delay = max(self._bucket.time_until_available(), self._blocked_until - self._clock())
+                    if delay <= 0:
+                        heapq.heappop(self._queue)
+                        self._bucket.consume()
+                        waited = self._clock() - enqueued_at
+                        self._record_grant(priority, waited)
+                        self._cond.notify_all()
+                        return waited
+                    # Sleep without holding the lock so a higher priority caller can take our place.
+                    self._cond.release()
+                    try:
+                        self._sleep(delay)
+                    finally:
+                        self._cond.acquire()
+                else:
+                    self._cond.wait()
+
+    def _record_grant(self, priority, waited):
+        stats = self._stats
+        stats["granted"][priority] = stats["granted"].get(priority, 0) + 1
+        stats["wait_total"][priority] = stats["wait_total"].get(priority, 0.0) + waited
+        stats["wait_max"][priority] = max(stats["wait_max"].get(priority, 0.0), waited)
+
+    def throttle(self, seconds, retry=False):
+        """Stop granting slots for `seconds` (used when the server answers 429). retry: count a retry too."""
+        with self._cond:
+            self._blocked_until = max(self._blocked_until, self._clock() + seconds)
+            self._bucket.drain()
+            self._stats["throttled"] += 1
+            if retry:
+                self._stats["retries"] += 1
+        logger.warning(f"AlertLabs rate limit hit, pausing requests for {seconds:.1f}s")
+
+    def execute(self, send, priority=None):
+        """
+        Call send() (which performs one HTTP request and returns the response) once a slot is free,
+        retrying after the server's Retry-After on 429/503. The last response is returned as is.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(priority)
+            response = send()
+            retry_after = response.headers.get("Retry-After")
+            throttled = response.status_code == 429 or (response.status_code == 503 and retry_after is not None)
+            if not throttled or attempt == self.max_retries:
+                return response
+            self.throttle(parse_retry_after(retry_after), retry=True)
+        return response
+
+    def stats(self):
+        """Snapshot of queue depth and wait times, keyed by priority name."""
+        with self._cond:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, _ in self._queue:
+                depth[PRIORITY_NAMES.get(priority, str(priority))] += 1
+            per_priority = {}
+            for priority, name in PRIORITY_NAMES.items():
+                granted = self._stats["granted"].get(priority, 0)
+                per_priority[name] = {
+                    "granted": granted,
+                    "queued": depth[name],
+                    "wait_total_s": round(self._stats["wait_total"].get(priority, 0.0), 3),
+                    "wait_mean_s": round(self._stats["wait_total"].get(priority, 0.0) / granted, 3) if granted else 0.0,
+                    "wait_max_s": round(self._stats["wait_max"].get(priority, 0.0), 3),
+                }
+            return {
+                "queue_depth": len(self._queue),
+                "tokens_available": round(max(self._bucket.tokens, 0.0), 3),
+                "blocked_for_s": round(max(0.0, self._blocked_until - self._clock()), 3),
+                "throttled": self._stats["throttled"],
+                "retries": self._stats["retries"],
+                "priorities": per_priority,
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return the process-wide scheduler shared by every Streamlit session."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
+
+
+def set_scheduler(scheduler):
+    """Replace the process-wide scheduler (e.g. with one built on a fake clock)."""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = scheduler
@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import threading
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api import timeseries_store
+from Alertlab_api.aws_utils import get_logger_and_log_stream
+
+logger, log_stream = get_logger_and_log_stream()
+
+#########################################################################################################################
+# MULTI-RESOLUTION ROLLUPS
+# Minute rows in the timeseries store are rolled up into coarser buckets per UTC day:
+#   <STORE_DIR>/rollups/sensor=<id>/series=<series>/level=<h|d>/day=YYYY-MM-DD.parquet
+#   columns: time (bucket start, ms), sum, min, max, count, night_sum
+# A day's rollups are rebuilt whenever minute rows for that day are written, so they stay current
+# at O(one day) per write. Hourly and daily reads for ranges whose minute data is held are then
+# answered from the rollups without touching minute rows or the network.
+# How the API aggregates hourly / daily buckets is not documented. rollup_as_series assumes water is summed
+# and anything else averaged; the first read a rate/series could answer from rollups goes to the API instead
+# and its response is compared with the rollups (verify_against). Only a match lets rollups answer that
+# rate/series from then on; a mismatch turns them off for it. The outcome is kept in rollups/_verified.json.
+
+LEVEL_SECONDS = {"h": 3600, "d": 86400}
+# Store/API rate codes that a rollup level can answer directly.
+RATE_LEVELS = {"h": "h", "d": "d"}
+# Rollup and API bucket values count as equal within this (the API rounds its values)
+VERIFY_RTOL = 1e-3
+VERIFY_ATOL = 0.05
+# Same 1-5 AM (inclusive) window as the dashboard's night KPI, on the dashboard's UTC-4 clock.
+NIGHT_HOURS = (1, 5)
+LOCAL_OFFSET_HOURS = -4
+
+_locks = {}
+_locks_guard = threading.Lock()
+_verified = {}
+_verified_lock = threading.Lock()
+
+
+def _rollup_lock(sensor_id, series):
+    with _locks_guard:
+        return _locks.setdefault((sensor_id, series), threading.Lock())
+
+
+def _rollup_dir(sensor_id, series, level, root=None):
+    return os.path.join(root or timeseries_store.STORE_DIR, "rollups", f"sensor={sensor_id}", f"series={series}", f"level={level}")
+
+
+def is_night(time_ms):
+    local_hour = (np.asarray(time_ms, dtype='int64') // 3600000 + LOCAL_OFFSET_HOURS) % 24
+    return (local_hour >= NIGHT_HOURS[0]) & (local_hour <= NIGHT_HOURS[1])
+
+
+def compute_rollup(minute_rows, level):
+    """Aggregate minute rows ('time' in ms, 'series') into buckets of the given level."""
+    step_ms = LEVEL_SECONDS[level] * 1000
+    times = minute_rows['time'].to_numpy(dtype='int64')
+    values = pd.to_numeric(minute_rows['series'], errors='coerce').to_numpy(dtype='float64')
+    frame = pd.DataFrame({
+        'time': (times // step_ms) * step_ms,
+        'value': values,
+        'night_value': np.where(is_night(times), values, 0.0),
+    })
+    grouped = frame.groupby('time', sort=True)
+    rollup = grouped['value'].agg(['sum', 'min', 'max', 'count'])
+    rollup['night_sum'] = grouped['night_value'].sum()
+    return rollup.reset_index()
+
+
+def update_day(sensor_id, day, series="W", root=None):
+    """Rebuild every rollup level of one UTC day from that day's minute partition."""
+    minute_rows = timeseries_store.read_day(sensor_id, day, rate="m", series=series, root=root)
+    if minute_rows is None or minute_rows.empty:
+        return
+    with _rollup_lock(sensor_id, series):
+        for level in LEVEL_SECONDS:
+            directory = _rollup_dir(sensor_id, series, level, root)
+            os.makedirs(directory, exist_ok=True)
+            timeseries_store._atomic_write_parquet(compute_rollup(minute_rows, level), os.path.join(directory, f"day={day}.parquet"))
+
+
+def on_rows_written(sensor_id, rate, series, days, root=None):
+    """Store write listener: keep the rollups of the touched days current."""
+    if rate != "m":
+        return
+    for day in days:
+        update_day(sensor_id, day, series, root)
+
+
+def rebuild(sensor_id, series="W", root=None):
+    """Rebuild all rollups of a sensor from its minute partitions (e.g. after copying a store in)."""
+    directory = timeseries_store._partition_dir(sensor_id, series, "m", root)
+    if not os.path.isdir(directory):
+        return
+    days = sorted(name[4:-8] for name in os.listdir(directory) if name.startswith("day=") and name.endswith(".parquet"))
+    for day in days:
+        update_day(sensor_id, day, series, root)
+
+
+def read_rollup(sensor_id, start, end, level="h", series="W", root=None):
+    """Rollup rows with bucket start in [start, end] (unix seconds), sorted by time."""
+    start = (int(float(start)) // LEVEL_SECONDS[level]) * LEVEL_SECONDS[level]
+    end = int(float(end))
+    directory = _rollup_dir(sensor_id, series, level, root)
+    frames = []
+    for day in timeseries_store._days_between(start, end + 1):
+        path = os.path.join(directory, f"day={day}.parquet")
+        if os.path.exists(path):
+            frames.append(pd.read_parquet(path))
+    if not frames:
+        return pd.DataFrame(columns=['time', 'sum', 'min', 'max', 'count', 'night_sum'])
+    df = pd.concat(frames, ignore_index=True)
+    return df[(df['time'] >= start * 1000) & (df['time'] <= end * 1000)].reset_index(drop=True)
+
+
+def rollup_as_series(rollup, series="W"):
+    """
+    ['time', 'series'] rows like the API returns: water volumes add up over a bucket,
+    anything else (temperature) is averaged.
+    """
+    if series == "W":
+        values = rollup['sum']
+    else:
+        values = rollup['sum'] / rollup['count'].where(rollup['count'] > 0)
+    return pd.DataFrame({'time': rollup['time'].astype('int64'), 'series': values.astype('float64')})
+
+
+def held_until(sensor_id, start, rate, series="W", root=None):
+    """
+    End (unix seconds, rounded down to a whole `rate` bucket) of the minute data held contiguously from
+    `start`, or None if minute data for `start` is not held. Rollups answer rate queries up to this point.
+    """
+    if rate not in RATE_LEVELS:
+        return None
+    step = timeseries_store.RATE_SECONDS[rate]
+    start = (int(float(start)) // step) * step
+    for c_start, c_end in timeseries_store.merge_intervals(timeseries_store.read_coverage(sensor_id, series, "m", root)):
+        if c_start <= start < c_end:
+            until = (c_end // step) * step
+            return until if until > start else None
+    return None
+
+
+def _verified_path(root=None):
+    return os.path.join(root or timeseries_store.STORE_DIR, "rollups", "_verified.json")
+
+
+def _load_verified(root=None):
+    """{'<rate>|<series>': True / False} for one store, read once. Called with _verified_lock held."""
+    path = _verified_path(root)
+    if path not in _verified:
+        try:
+            with open(path, "r") as f:
+                _verified[path] = json.load(f)
+        except FileNotFoundError:
+            _verified[path] = {}
+        except (ValueError, OSError) as e:
+            logger.error(f"Unreadable rollup verification file {path}, verifying again: {e}")
+            _verified[path] = {}
+    return _verified[path]
+
+
+def is_verified(rate, series="W", root=None):
+    """True if rollups matched the API for this rate/series, False if they did not, None if not checked yet."""
+    with _verified_lock:
+        return _load_verified(root).get(f"{rate}|{series}")
+
+
+def verify_against(api_rows, rollup, rate, series="W", root=None):
+    """
+    Compare an API response (['time', 'series'] rows at `rate`) with the rollup rows of the same window and
+    record whether rollups may answer this rate/series. Only buckets whose minutes are all held are compared.
+    Returns the outcome, or None if there was no complete bucket to compare (it is checked again next time).
+    """
+    minutes_per_bucket = LEVEL_SECONDS[RATE_LEVELS[rate]] // 60
+    complete = rollup[rollup['count'] == minutes_per_bucket]
+    expected = rollup_as_series(complete, series)
+    joined = expected.merge(api_rows[['time', 'series']].astype({'time': 'int64'}), on='time', suffixes=('_rollup', '_api'))
+    if joined.empty:
+        return None
+    ok = bool(np.isclose(joined['series_rollup'].to_numpy(dtype='float64'), joined['series_api'].to_numpy(dtype='float64'),
+                         rtol=VERIFY_RTOL, atol=VERIFY_ATOL, equal_nan=True).all())
+    if ok:
+        logger.info(f"Rollups match the API's rate={rate} series={series} buckets ({len(joined)} compared), serving them from now on")
+    else:
+        logger.warning(f"Rollups do not match the API's rate={rate} series={series} buckets, not serving them for it")
+    path = _verified_path(root)
+    with _verified_lock:
+        verified = _load_verified(root)
+        verified[f"{rate}|{series}"] = ok
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(verified, f)
+        os.replace(tmp_path, path)
+    return ok
+
+
+timeseries_store.add_write_listener(on_rows_written)
@@ -0,0 +1,354 @@
+import io
+import os
+import sys
+import json
+import time
+import queue
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api.aws_utils import get_logger_and_log_stream, get_s3_client_and_bucket_name
+from Alertlab_api.instrumentation import timed
+from Alertlab_api import timeseries_store
+
+logger, log_stream = get_logger_and_log_stream()
+
+#########################################################################################################################
+# SHARED S3 DAY CACHE
+# Every dashboard replica has its own local store, so each one used to fetch the same sensors from AlertLabs.
+# Closed UTC days never change once settled, so this second tier keeps them in S3 as zstd Parquet, shared by
+# every replica. It is consulted after the local store (for its gaps) and before the API:
+#   <prefix>objects/<sha256>.parquet                                             the day's rows, content addressed
+#   <prefix>days/sensor=<id>/series=<series>/rate=<rate>/day=YYYY-MM-DD.json      pointer {"object", "sha256", "rows"}
+# Days are published in the background once the local store holds them whole. Both objects are written with
+# IfNoneMatch='*', so the first replica to publish a day wins and nothing is ever overwritten. A pointer
+# never changes once written, so pointers and objects are kept locally: pointers in memory, objects in a
+# size-capped LRU directory in front of S3. A closed day is then fetched from AlertLabs by one replica and
+# read from S3 by the others. Two replicas that miss the same day at the same moment can both still fetch it.
+# Any object with put_object / get_object / head_object can stand in for S3 (see mock_server.MockS3).
+
+SHARED_CACHE_DISABLED = os.getenv("TIMESERIES_SHARED_CACHE_DISABLED", "").lower() in ("1", "true", "yes")
+SHARED_CACHE_PREFIX = os.getenv("TIMESERIES_SHARED_CACHE_PREFIX", "timeseries-cache/v1/")
+SHARED_CACHE_DIR = os.getenv("TIMESERIES_SHARED_CACHE_DIR", os.path.join(timeseries_store.STORE_DIR, "_shared_cache"))
+SHARED_CACHE_LOCAL_BYTES = int(float(os.getenv("TIMESERIES_SHARED_CACHE_LOCAL_MB", "512")) * 1024 * 1024)
+# Rates kept in S3; daily data is a single row per day, cheaper to ask the API for
+SHARED_CACHE_RATES = tuple(os.getenv("TIMESERIES_SHARED_CACHE_RATES", "m,h").split(","))
+# A day counts as closed this long after it ended (AlertLabs keeps filling in the most recent buckets)
+CLOSED_AFTER_SECONDS = int(os.getenv("TIMESERIES_SHARED_CACHE_CLOSED_AFTER_SECONDS", "3600"))
+# A day nobody has published yet is not asked for again for this long
+MISS_TTL_SECONDS = int(os.getenv("TIMESERIES_SHARED_CACHE_MISS_TTL_SECONDS", "300"))
+SHARED_CACHE_WORKERS = int(os.getenv("TIMESERIES_SHARED_CACHE_WORKERS", "8"))
+
+_NOT_FOUND = ("NoSuchKey", "404", "NotFound")
+_ALREADY_EXISTS = ("PreconditionFailed", "412", "ConditionalRequestConflict", "409")
+
+
+def _error_code(e):
+    return str(getattr(e, "response", {}).get("Error", {}).get("Code", ""))
+
+
+def is_closed(day, now=None):
+    return timeseries_store._day_start(day) + 86400 + CLOSED_AFTER_SECONDS <= (time.time() if now is None else now)
+
+
+def parquet_bytes(rows):
+    """A day's rows ('time' in ms, 'series') as zstd Parquet."""
+    rows = pd.DataFrame({'time': rows['time'].astype('int64'), 'series': pd.to_numeric(rows['series'], errors='coerce').astype('float64')})
+    buffer = io.BytesIO()
+    rows.sort_values('time').reset_index(drop=True).to_parquet(buffer, index=False, compression='zstd')
+    return buffer.getvalue()
+
+
+class DiskLRU:
+    """Files in one directory, capped at max_bytes; reading a file marks it as recently used (its mtime)."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        path = self._path(name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, name, data):
+        os.makedirs(self.directory, exist_ok=True)
+        timeseries_store._atomic_write_bytes(self._path(name), data)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            try:
+                entries = [e for e in os.scandir(self.directory) if e.is_file() and ".tmp-" not in e.name]
+            except OSError:
+                return
+            stats = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in entries]
+            total = sum(size for _, size, _ in stats)
+            for _, size, path in sorted(stats):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+
+class SharedDayCache:
+    """
+    client / bucket: a boto3 S3 client (or stand-in) and its bucket. local: the DiskLRU in front of S3.
+    clock can be swapped for a fake in tests; start_thread=False leaves publishing to explicit flush() calls.
+    """
+
+    def __init__(self, client, bucket, prefix=SHARED_CACHE_PREFIX, local=None, clock=time.time, start_thread=True):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.local = local or DiskLRU(SHARED_CACHE_DIR, SHARED_CACHE_LOCAL_BYTES)
+        self._clock = clock
+        self._pointers = {}
+        self._misses = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._start_thread = start_thread
+        self._thread = None
+        self.stats = {"hits": 0, "misses": 0, "published": 0, "already_published": 0, "errors": 0}
+
+    ##### Keys
+
+    def pointer_key(self, sensor_id, rate, series, day):
+        return f"{self.prefix}days/sensor={sensor_id}/series={series}/rate={rate}/day={day}.json"
+
+    def object_key(self, digest):
+        return f"{self.prefix}objects/{digest}.parquet"
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    ##### Reading
+
+    def _pointer(self, key):
+        """The day's pointer, or None if nobody has published it (remembered for MISS_TTL_SECONDS)."""
+        with self._lock:
+            if key in self._pointers:
+                return self._pointers[key]
+            if self._clock() - self._misses.get(key, float("-inf")) < MISS_TTL_SECONDS:
+                return None
+        try:
+            pointer = json.loads(self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read())
+        except Exception as e:
+            if _error_code(e) not in _NOT_FOUND:
+                raise
+            with self._lock:
+                self._misses[key] = self._clock()
+            return None
+        with self._lock:
+            self._pointers[key] = pointer
+        return pointer
+
+    def _object(self, pointer):
+        digest = pointer["sha256"]
+        data = self.local.get(f"{digest}.parquet")
+        if data is None:
+            data = self.client.get_object(Bucket=self.bucket, Key=pointer["object"])["Body"].read()
+            if hashlib.sha256(data).hexdigest() != digest:
+                raise ValueError(f"Shared cache object {pointer['object']} does not match its digest")
+            self.local.put(f"{digest}.parquet", data)
+        return data
+
+    def get_day(self, sensor_id, day, rate="h", series="W"):
+        """Rows of one closed day as a DataFrame ('time', 'series'), or None if it is not in the cache."""
+        pointer = self._pointer(self.pointer_key(sensor_id, rate, series, day))
+        if pointer is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return pd.read_parquet(io.BytesIO(self._object(pointer)))
+
+    @timed("shared_cache_fill")
+    def fill_gaps(self, sensor_id, gaps, rate="h", series="W", root=None):
+        """
+        Copy the closed days of the store gaps that the cache holds into the local store (marked as held, whole
+        days), and return the gaps that are still missing.
+        """
+        if rate not in SHARED_CACHE_RATES or not gaps:
+            return gaps
+        now = self._clock()
+        days = sorted({day for start, end in gaps for day in timeseries_store._days_between(start, end) if is_closed(day, now)})
+        if not days:
+            return gaps
+
+        def get(day):
+            try:
+                return day, self.get_day(sensor_id, day, rate, series)
+            except Exception as e:
+                self._count("errors")
+                logger.warning(f"Shared cache read of sensor {sensor_id} {day} ({rate}, {series}) failed: {e}")
+                return day, None
+
+        with ThreadPoolExecutor(max_workers=max(1, min(SHARED_CACHE_WORKERS, len(days)))) as executor:
+            found = [(day, rows) for day, rows in executor.map(get, days) if rows is not None]
+        for day, rows in found:
+            day_start = timeseries_store._day_start(day)
+            timeseries_store.write_rows(sensor_id, rows, rate, series, covered=(day_start, day_start + 86400), root=root)
+        if not found:
+            return gaps
+        logger.info(f"Shared cache served {len(found)} of {len(days)} closed day(s) for sensor {sensor_id} ({rate}, {series})")
+        covered = timeseries_store.merge_intervals(timeseries_store.read_coverage(sensor_id, series, rate, root))
+        return [piece for gap_start, gap_end in gaps for piece in timeseries_store.subtract_intervals(gap_start, gap_end, covered)]
+
+    ##### Publishing
+
+    def _put_if_absent(self, key, body):
+        """True if this call created the object, False if it already existed."""
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=body, IfNoneMatch="*")
+            return True
+        except Exception as e:
+            if _error_code(e) in _ALREADY_EXISTS:
+                return False
+            raise
+
+    def _is_published(self, key):
+        with self._lock:
+            if key in self._pointers:
+                return True
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except Exception as e:
+            if _error_code(e) in _NOT_FOUND:
+                return False
+            raise
+
+    def publish_day(self, sensor_id, day, rate="h", series="W", root=None):
+        """
+        Upload one day from the local store if it is closed, held whole and not published yet.
+        Returns True if this call published it.
+        """
+        key = self.pointer_key(sensor_id, rate, series, day)
+        day_start = timeseries_store._day_start(day)
+        covered = timeseries_store.merge_intervals(timeseries_store.read_coverage(sensor_id, series, rate, root))
+        if not is_closed(day, self._clock()) or timeseries_store.subtract_intervals(day_start, day_start + 86400, covered):
+            return False
+        if self._is_published(key):
+            return False
+        rows = timeseries_store.read_day(sensor_id, day, rate, series, root)
+        data = parquet_bytes(rows if rows is not None else pd.DataFrame({'time': [], 'series': []}))
+        digest = hashlib.sha256(data).hexdigest()
+        pointer = {"object": self.object_key(digest), "sha256": digest, "rows": 0 if rows is None else len(rows), "bytes": len(data)}
+        # The object goes first, so a pointer never names a missing object
+        self._put_if_absent(pointer["object"], data)
+        created = self._put_if_absent(key, json.dumps(pointer).encode("utf-8"))
+        self._count("published" if created else "already_published")
+        if created:
+            self.local.put(f"{digest}.parquet", data)
+            with self._lock:
+                self._pointers[key] = pointer
+                self._misses.pop(key, None)
+        else:
+            # Another replica got there first; its pointer is the one everybody reads
+            with self._lock:
+                self._pointers.pop(key, None)
+        return created
+
+    def enqueue(self, sensor_id, rate, series, days, root=None):
+        """Publish these days in the background (see publish_day for which ones are actually uploaded)."""
+        if rate not in SHARED_CACHE_RATES:
+            return
+        now = self._clock()
+        with self._lock:
+            for day in days:
+                item = (sensor_id, rate, series, day, root)
+                if item in self._queued or not is_closed(day, now) or self.pointer_key(sensor_id, rate, series, day) in self._pointers:
+                    continue
+                self._queued.add(item)
+                self._queue.put(item)
+            if self._start_thread and (self._thread is None or not self._thread.is_alive()) and not self._queue.empty():
+                self._thread = threading.Thread(target=self._run, name="shared-cache-publisher", daemon=True)
+                self._thread.start()
+
+    def _publish_next(self, block=True):
+        item = self._queue.get(block=block)
+        sensor_id, rate, series, day, root = item
+        try:
+            self.publish_day(sensor_id, day, rate, series, root)
+        except Exception as e:
+            self._count("errors")
+            logger.warning(f"Publishing sensor {sensor_id} {day} ({rate}, {series}) to the shared cache failed: {e}")
+        finally:
+            with self._lock:
+                self._queued.discard(item)
+            self._queue.task_done()
+
+    def _run(self):
+        while True:
+            self._publish_next()
+
+    def flush(self):
+        """Publish everything queued so far (in this thread if the background thread is off) and wait for it."""
+        if self._thread is None or not self._thread.is_alive():
+            while True:
+                try:
+                    self._publish_next(block=False)
+                except queue.Empty:
+                    break
+        self._queue.join()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_shared_cache():
+    """The process-wide SharedDayCache on the app's bucket, or None if it is disabled or there is no bucket."""
+    global _cache
+    with _cache_lock:
+        if _cache is None and not SHARED_CACHE_DISABLED:
+            client, bucket = get_s3_client_and_bucket_name()
+            if bucket:
+                _cache = SharedDayCache(client, bucket)
+        return _cache
+
+
+def set_shared_cache(cache):
+    """Swap in another cache (e.g. one on mock_server.MockS3 in tests), or None to turn the tier off."""
+    global _cache, SHARED_CACHE_DISABLED
+    with _cache_lock:
+        _cache = cache
+        SHARED_CACHE_DISABLED = cache is None
+
+
+def fill_gaps(sensor_id, gaps, rate="h", series="W", root=None):
+    """Store gaps left after the shared cache (the gaps unchanged if it is off or cannot be reached)."""
+    cache = get_shared_cache()
+    if cache is None:
+        return gaps
+    try:
+        return cache.fill_gaps(sensor_id, gaps, rate, series, root)
+    except Exception as e:
+        logger.warning(f"Shared cache unavailable for sensor {sensor_id}, going to the API: {e}")
+        return gaps
+
+
+def on_rows_written(sensor_id, rate, series, days, root=None):
+    """Store write listener: queue the closed days just written for publishing."""
+    cache = get_shared_cache()
+    if cache is not None:
+        cache.enqueue(sensor_id, rate, series, days, root)
+
+
+timeseries_store.add_write_listener(on_rows_written)
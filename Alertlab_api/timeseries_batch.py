@@ -0,0 +1,119 @@
+import itertools
+import numpy as np
+import pandas as pd
+
+#########################################################################################################################
+# COMPACT TIMESERIES BATCH
+# What the API layer returns for one sensor: an int64 array of bucket starts (ms) and a float32 array of values,
+# 12 bytes per reading instead of the ~24+ of a DataFrame with time, series and Datetime columns.
+# Internal code (store, aggregation, query planner, KPIs) works on the arrays; a DataFrame with the old
+# time / series / Datetime columns is only built when something asks for one (to_frame), and then kept.
+# float32 is for memory and charts only: a batch decoded from an API response also carries the original
+# float64 values (raw_values) until it has been written to the store, which persists those (raw_frame).
+# compact() drops them before a batch is handed to the app.
+
+
+class TimeseriesBatch:
+    __slots__ = ("time", "values", "raw_values", "sensor_id", "rate", "series", "_frame")
+
+    def __init__(self, time, values, sensor_id=None, rate=None, series=None, raw_values=None):
+        self.time = np.asarray(time, dtype='int64')
+        self.values = np.asarray(values, dtype='float32')
+        self.raw_values = None if raw_values is None else np.asarray(raw_values, dtype='float64')
+        self.sensor_id = sensor_id
+        self.rate = rate
+        self.series = series
+        self._frame = None
+
+    @classmethod
+    def from_pairs(cls, pairs, sensor_id=None, rate=None, series=None):
+        """From the API's [[time_ms, value], ...] list; null values become NaN."""
+        if len(pairs) == 0:
+            return cls.empty_batch(sensor_id, rate, series)
+        # Epoch milliseconds are well inside float64's exact integer range, so one float64 pass is lossless.
+        # fromiter over the flattened pairs is about twice as fast as np.array on a list of lists.
+        try:
+            array = np.fromiter(itertools.chain.from_iterable(pairs), dtype='float64', count=2 * len(pairs)).reshape(-1, 2)
+        except (ValueError, TypeError):
+            array = np.array(pairs, dtype='float64')
+        return cls(array[:, 0].astype('int64'), array[:, 1], sensor_id, rate, series, raw_values=array[:, 1])
+
+    @classmethod
+    def from_frame(cls, df, sensor_id=None, rate=None, series=None):
+        """From a frame with 'time' (ms) and 'series' columns, e.g. rows read from the store."""
+        return cls(df['time'].to_numpy(dtype='int64'), pd.to_numeric(df['series'], errors='coerce').to_numpy(dtype='float32'),
+                   sensor_id, rate, series)
+
+    @classmethod
+    def empty_batch(cls, sensor_id=None, rate=None, series=None):
+        return cls(np.empty(0, dtype='int64'), np.empty(0, dtype='float32'), sensor_id, rate, series)
+
+    @classmethod
+    def concat(cls, batches):
+        batches = [b for b in batches if b is not None]
+        if not batches:
+            return cls.empty_batch()
+        first = batches[0]
+        raw_values = None
+        if all(b.raw_values is not None for b in batches):
+            raw_values = np.concatenate([b.raw_values for b in batches])
+        return cls(np.concatenate([b.time for b in batches]), np.concatenate([b.values for b in batches]),
+                   first.sensor_id, first.rate, first.series, raw_values)
+
+    def __len__(self):
+        return len(self.time)
+
+    def __repr__(self):
+        return f"TimeseriesBatch(sensor_id={self.sensor_id!r}, rate={self.rate!r}, series={self.series!r}, rows={len(self)})"
+
+    @property
+    def empty(self):
+        return len(self.time) == 0
+
+    @property
+    def nbytes(self):
+        return self.time.nbytes + self.values.nbytes + (0 if self.raw_values is None else self.raw_values.nbytes)
+
+    def take(self, index):
+        """Rows at index (an integer array, mask or slice) as a new batch."""
+        raw_values = None if self.raw_values is None else self.raw_values[index]
+        return TimeseriesBatch(self.time[index], self.values[index], self.sensor_id, self.rate, self.series, raw_values)
+
+    def slice(self, lo, hi):
+        """Rows lo:hi as a new batch sharing this batch's arrays (no copy)."""
+        return self.take(slice(lo, hi))
+
+    def compact(self):
+        """This batch without the float64 raw_values, for keeping in memory once the store has them."""
+        if self.raw_values is None:
+            return self
+        return TimeseriesBatch(self.time, self.values, self.sensor_id, self.rate, self.series)
+
+    def between(self, start_ms, end_ms):
+        """Rows with start_ms <= time <= end_ms (the arrays are sorted by time)."""
+        lo = np.searchsorted(self.time, start_ms, side='left')
+        hi = np.searchsorted(self.time, end_ms, side='right')
+        return self.slice(lo, hi)
+
+    def raw_frame(self):
+        """['time', 'series'] frame as the API and the store use it (the original float64 values if kept), not cached."""
+        values = self.values.astype('float64') if self.raw_values is None else self.raw_values
+        return pd.DataFrame({'time': self.time, 'series': values})
+
+    def to_frame(self):
+        """The time / series / Datetime frame the rest of the app used to get, built on first use and kept."""
+        if self._frame is None:
+            frame = self.raw_frame()
+            # Same local clock as _timeseries_frame in alertlab_api.py (UTC-4)
+            frame['Datetime'] = pd.to_datetime(self.time, unit='ms') - pd.Timedelta(hours=4)
+            self._frame = frame
+        return self._frame
+
+    def __getitem__(self, column):
+        """df['time'] / df['series'] without building the frame; anything else goes through to_frame()."""
+        if column == 'time':
+            return pd.Series(self.time, name='time')
+        if column == 'series':
+            return pd.Series(self.values, name='series')
+        return self.to_frame()[column]
+
@@ -0,0 +1,143 @@
+import os
+import re
+import sys
+import json
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api.timeseries_batch import TimeseriesBatch
+
+#########################################################################################################################
+# STREAMING TIMESERIES DECODER
+# A month of minute data is ~1.4 MB of JSON; response.json() holds the text, the decoded text and a list of
+# [time, value] lists (several times the payload) before a single array is built. This decoder reads the body
+# chunk by chunk, finds the "dataModel": {"<sensor id>": [ array, and parses the pairs of each chunk with
+# numpy's text parser straight into preallocated int64 / float64 arrays (the batch keeps the float64 values for
+# the store next to its float32 ones, see timeseries_batch.py). Only the small envelope around the
+# array ({"error": ..., "dataModel": {"<id>": []}}) goes through json, so 'error' can be checked as before.
+# If the body does not look like that (e.g. an error response with "dataModel": null) the whole body is
+# json-decoded instead and the caller falls back to the regular path.
+
+CHUNK_BYTES = int(os.getenv("ALERTLABS_DECODE_CHUNK_BYTES", str(64 * 1024)))
+# Arrays are preallocated for the expected number of rows, but never more than this up front
+MAX_PREALLOCATED_ROWS = 1 << 21
+
+_PAIR_PUNCTUATION = bytes.maketrans(b"[],", b"   ")
+_ARRAY_END = re.compile(rb"\]\s*\]")
+_ARRAY_EMPTY = re.compile(rb"\s*\]")
+
+
+class TimeseriesDecodeError(ValueError):
+    pass
+
+
+class _Columns:
+    """Preallocated time / value arrays that double in size if the response holds more rows than expected."""
+
+    def __init__(self, capacity):
+        capacity = max(16, min(int(capacity), MAX_PREALLOCATED_ROWS))
+        self.time = np.empty(capacity, dtype='int64')
+        self.values = np.empty(capacity, dtype='float64')
+        self.rows = 0
+
+    def append(self, flat):
+        n = len(flat) // 2
+        if self.rows + n > len(self.time):
+            capacity = max(2 * len(self.time), self.rows + n)
+            self.time = np.concatenate([self.time[:self.rows], np.empty(capacity - self.rows, dtype='int64')])
+            self.values = np.concatenate([self.values[:self.rows], np.empty(capacity - self.rows, dtype='float64')])
+        # Epoch milliseconds are exact in float64
+        self.time[self.rows:self.rows + n] = flat[0::2]
+        self.values[self.rows:self.rows + n] = flat[1::2]
+        self.rows += n
+
+    def arrays(self):
+        time, values = self.time[:self.rows], self.values[:self.rows]
+        # Do not keep a mostly empty preallocation alive behind a view
+        if self.rows < 3 * len(self.time) // 4:
+            time, values = time.copy(), values.copy()
+        return time, values
+
+
+def _parse_pairs(body):
+    """Flat float64 [t0, v0, t1, v1, ...] from a run of complete '[t, v],[t, v]' pairs (null -> NaN)."""
+    pairs = body.count(b"[")
+    text = body.replace(b"null", b"nan").translate(_PAIR_PUNCTUATION)
+    if pairs == 0:
+        if text.strip():
+            raise TimeseriesDecodeError(f"Unexpected data in timeseries array: {body[:80]!r}")
+        return np.empty(0, dtype='float64')
+    try:
+        flat = np.fromstring(text, dtype='float64', sep=' ')
+    except ValueError as e:
+        raise TimeseriesDecodeError(f"Unparseable timeseries pairs: {e}") from e
+    if len(flat) != 2 * pairs:
+        raise TimeseriesDecodeError(f"Expected {2 * pairs} numbers in timeseries pairs, got {len(flat)}")
+    return flat
+
+
+def decode_timeseries_stream(chunks, sensor_id, rate=None, series=None, expected_rows=0):
+    """
+    Decode a /timeseries response body given as an iterable of byte chunks (e.g. response.iter_content()).
+    Returns (envelope, batch, n_bytes):
+      envelope  the response JSON, with the sensor's array left empty if it was streamed
+      batch     the TimeseriesBatch of the sensor, or None if the body was not in the expected shape
+                (then envelope is the full decoded body and the caller can read it the usual way)
+      n_bytes   body size, for the data budget ledger
+    """
+    key = re.compile(rb'"dataModel"\s*:\s*\{\s*' + re.escape(json.dumps(sensor_id).encode("utf-8")) + rb"\s*:\s*\[")
+    prefix, searched, n_bytes = b"", 0, 0
+    chunks = iter(chunks)
+
+    # Envelope up to the opening bracket of the sensor's array
+    match = None
+    for chunk in chunks:
+        n_bytes += len(chunk)
+        prefix += chunk
+        match = key.search(prefix, max(0, searched - 256))
+        searched = len(prefix)
+        if match:
+            break
+    if match is None:
+        return (json.loads(prefix) if prefix.strip() else {}), None, n_bytes
+
+    columns = _Columns(expected_rows)
+    head = prefix[:match.end() - 1]
+    pending = prefix[match.end():]
+    while not pending.strip():
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise TimeseriesDecodeError(f"Timeseries response for {sensor_id} ended inside the data array")
+        n_bytes += len(chunk)
+        pending += chunk
+    tail = None
+    if _ARRAY_EMPTY.match(pending):
+        tail = pending[_ARRAY_EMPTY.match(pending).end():]
+    while tail is None:
+        end = _ARRAY_END.search(pending)
+        if end is not None:
+            columns.append(_parse_pairs(pending[:end.start() + 1]))
+            tail = pending[end.end():]
+            break
+        cut = pending.rfind(b"]")
+        if cut >= 0:
+            columns.append(_parse_pairs(pending[:cut + 1]))
+            # The closing bracket is kept so an array end split across chunks ("]" | "]") is still found;
+            # it parses as whitespace the next time round.
+            pending = pending[cut:]
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise TimeseriesDecodeError(f"Timeseries response for {sensor_id} ended inside the data array")
+        n_bytes += len(chunk)
+        pending += chunk
+
+    # What follows the array is the rest of the (small) envelope
+    rest = [tail]
+    for chunk in chunks:
+        n_bytes += len(chunk)
+        rest.append(chunk)
+    try:
+        envelope = json.loads(head + b"[]" + b"".join(rest))
+    except ValueError as e:
+        raise TimeseriesDecodeError(f"Malformed timeseries response envelope: {e}") from e
+    time, values = columns.arrays()
+    return envelope, TimeseriesBatch(time, values, sensor_id, rate, series, raw_values=values), n_bytes
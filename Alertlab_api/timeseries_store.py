@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import threading
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api.aws_utils import get_logger_and_log_stream
+from Alertlab_api.instrumentation import timed
+from Alertlab_api.timeseries_batch import TimeseriesBatch
+from Alertlab_api import range_chunking
+
+logger, log_stream = get_logger_and_log_stream()
+
+#########################################################################################################################
+# LOCAL TIMESERIES STORE
+# Layout on disk:
+#   <STORE_DIR>/sensor=<id>/series=<series>/rate=<rate>/day=YYYY-MM-DD.parquet   (columns: time [ms], series)
+#   <STORE_DIR>/sensor=<id>/series=<series>/rate=<rate>/_coverage.json            (list of [start, end) in unix seconds)
+# The coverage file is what lets us ask the API only for the parts of a window we do not hold yet.
+
+STORE_DIR = os.getenv("TIMESERIES_STORE_DIR", os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".timeseries_store")))
+STORE_DISABLED = os.getenv("TIMESERIES_STORE_DISABLED", "").lower() in ("1", "true", "yes")
+
+RATE_SECONDS = {"m": 60, "h": 3600, "d": 86400}
+# AlertLabs keeps filling in the most recent buckets, so anything newer than this is never marked as held.
+SETTLE_SECONDS = 15 * 60
+
+_locks = {}
+_locks_guard = threading.Lock()
+# Called as listener(sensor_id, rate, series, days, root) after rows for those UTC days were written.
+_write_listeners = []
+
+
+def add_write_listener(listener):
+    """Register a callback for new rows, e.g. the rollup builder (see rollups.py)."""
+    if listener not in _write_listeners:
+        _write_listeners.append(listener)
+
+
+def _partition_lock(sensor_id, series, rate):
+    key = (sensor_id, series, rate)
+    with _locks_guard:
+        if key not in _locks:
+            _locks[key] = threading.Lock()
+        return _locks[key]
+
+
+def _partition_dir(sensor_id, series, rate, root=None):
+    return os.path.join(root or STORE_DIR, f"sensor={sensor_id}", f"series={series}", f"rate={rate}")
+
+
+def _day_of(ms):
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+def _day_start(day):
+    return int(datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
+
+
+def _days_between(start, end):
+    """UTC day labels touched by the half-open range [start, end) in unix seconds."""
+    days = []
+    current = (int(start) // 86400) * 86400
+    while current < end:
+        days.append(datetime.fromtimestamp(current, tz=timezone.utc).strftime("%Y-%m-%d"))
+        current += 86400
+    return days
+
+
+def _atomic_write_bytes(path, data):
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _atomic_write_parquet(df, path):
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def align_range(start, end, rate):
+    """Widen [start, end) outward to whole buckets of the given rate."""
+    step = RATE_SECONDS.get(rate, 3600)
+    start = (int(float(start)) // step) * step
+    end = -(-int(float(end)) // step) * step
+    return start, max(end, start + step)
+
+
+def merge_intervals(intervals):
+    """Sort and merge overlapping or touching [start, end) intervals."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def subtract_intervals(start, end, covered):
+    """Return the parts of [start, end) that are not in the (merged) covered intervals."""
+    gaps = []
+    cursor = start
+    for c_start, c_end in covered:
+        if c_end <= cursor:
+            continue
+        if c_start >= end:
+            break
+        if c_start > cursor:
+            gaps.append((cursor, min(c_start, end)))
+        cursor = max(cursor, c_end)
+        if cursor >= end:
+            break
+    if cursor < end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+def read_coverage(sensor_id, series, rate, root=None):
+    path = os.path.join(_partition_dir(sensor_id, series, rate, root), "_coverage.json")
+    try:
+        with open(path, "r") as f:
+            return [list(i) for i in json.load(f)]
+    except FileNotFoundError:
+        return []
+    except (ValueError, OSError) as e:
+        logger.warning(f"Unreadable coverage file {path}, treating as empty: {e}")
+        return []
+
+
+def _write_coverage(sensor_id, series, rate, coverage, root=None):
+    directory = _partition_dir(sensor_id, series, rate, root)
+    os.makedirs(directory, exist_ok=True)
+    _atomic_write_bytes(os.path.join(directory, "_coverage.json"), json.dumps(coverage).encode("utf-8"))
+
+
+def missing_ranges(sensor_id, start, end, rate="h", series="W", root=None):
+    """Bucket-aligned sub-ranges of [start, end) that have to be requested from the API."""
+    start, end = align_range(start, end, rate)
+    return subtract_intervals(start, end, merge_intervals(read_coverage(sensor_id, series, rate, root)))
+
+
+@timed("store_write_rows")
+def write_rows(sensor_id, rows, rate="h", series="W", covered=None, root=None):
+    """
+    Merge raw rows (DataFrame with 'time' in ms and 'series', or a TimeseriesBatch) into the day partitions.
+    covered: optional (start, end) range in unix seconds that the rows fully describe.
+    Only the part of it older than SETTLE_SECONDS is recorded as held.
+    """
+    directory = _partition_dir(sensor_id, series, rate, root)
+    touched_days = []
+    with _partition_lock(sensor_id, series, rate):
+        os.makedirs(directory, exist_ok=True)
+        if rows is not None and len(rows) > 0:
+            rows = rows.raw_frame() if isinstance(rows, TimeseriesBatch) else rows[['time', 'series']].copy()
+            rows['time'] = rows['time'].astype('int64')
+            rows['series'] = pd.to_numeric(rows['series'], errors='coerce')
+            # UTC day number per row, labelled once per day instead of once per row
+            day_numbers = rows['time'].to_numpy() // 86400000
+            for day_number in np.unique(day_numbers):
+                day = _day_of(int(day_number) * 86400000)
+                touched_days.append(day)
+                path = os.path.join(directory, f"day={day}.parquet")
+                day_rows = rows[day_numbers == day_number]
+                if os.path.exists(path):
+                    day_rows = pd.concat([pd.read_parquet(path), day_rows], ignore_index=True)
+                day_rows = day_rows.drop_duplicates(subset='time', keep='last').sort_values('time')
+                _atomic_write_parquet(day_rows.reset_index(drop=True), path)
+
+        if covered is not None:
+            settled_until = int(time.time()) - SETTLE_SECONDS
+            c_start, c_end = int(covered[0]), min(int(covered[1]), settled_until)
+            if c_end > c_start:
+                coverage = read_coverage(sensor_id, series, rate, root)
+                coverage.append([c_start, c_end])
+                _write_coverage(sensor_id, series, rate, merge_intervals(coverage), root)
+
+    for listener in (_write_listeners if touched_days else []):
+        try:
+            listener(sensor_id, rate, series, touched_days, root)
+        except Exception as e:
+            logger.error(f"Store write listener {getattr(listener, '__name__', listener)} failed for sensor {sensor_id}: {e}")
+
+
+def read_day(sensor_id, day, rate="h", series="W", root=None):
+    """Held rows of one UTC day partition, or None if there are none."""
+    path = os.path.join(_partition_dir(sensor_id, series, rate, root), f"day={day}.parquet")
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
+
+
+@timed("store_read_rows")
+def read_rows(sensor_id, start, end, rate="h", series="W", root=None):
+    """Return the held rows for [start, end] (inclusive, bucket-aligned start) sorted by time."""
+    start, _ = align_range(start, end, rate)
+    end = int(float(end))
+    directory = _partition_dir(sensor_id, series, rate, root)
+    frames = []
+    for day in _days_between(start, end + 1):
+        path = os.path.join(directory, f"day={day}.parquet")
+        if os.path.exists(path):
+            frames.append(pd.read_parquet(path))
+    if not frames:
+        return pd.DataFrame({'time': pd.Series(dtype='int64'), 'series': pd.Series(dtype='float64')})
+    df = pd.concat(frames, ignore_index=True)
+    df = df[(df['time'] >= start * 1000) & (df['time'] <= end * 1000)]
+    return df.reset_index(drop=True)
+
+
+def read_through(sensor_id, start, end, fetch, rate="h", series="W", root=None, ranges=None, max_workers=1):
+    """
+    Return rows for [start, end] from the store, calling fetch(gap_start, gap_end) for every
+    range that is not held yet. fetch must return a DataFrame with 'time' and 'series' (or a TimeseriesBatch)
+    or None on failure.
+    ranges: the ranges to fetch instead of the raw gaps, e.g. the gaps cut into chunks (see range_chunking.py);
+    each one is written, and marked as held, on its own, so one failing chunk does not lose the others.
+    max_workers: ranges fetched at once.
+    Returns None only when nothing is held and every fetch failed; if every fetch raised, the first error is raised.
+    """
+    gaps = missing_ranges(sensor_id, start, end, rate, series, root) if ranges is None else ranges
+    failed = False
+    errors = []
+    for gap_start, gap_end, rows, error in range_chunking.fetch_ranges(gaps, fetch, max_workers=max_workers):
+        if error is not None:
+            logger.error(f"Fetching {gap_start}-{gap_end} for sensor {sensor_id} failed: {error}")
+            errors.append(error)
+        if rows is None:
+            failed = True
+            continue
+        write_rows(sensor_id, rows, rate, series, covered=(gap_start, gap_end), root=root)
+    if gaps:
+        logger.info(f"Store fetched {len(gaps)} missing range(s) for sensor {sensor_id} ({rate}, {series})")
+    held = read_rows(sensor_id, start, end, rate, series, root)
+    if failed:
+        if held.empty:
+            if errors and len(errors) == len(gaps):
+                raise errors[0]
+            return None
+        logger.warning(f"Serving partial data for sensor {sensor_id}: at least one range failed to fetch")
+    return held
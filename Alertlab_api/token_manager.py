@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import threading
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api.aws_utils import get_logger_and_log_stream
+
+logger, log_stream = get_logger_and_log_stream()
+
+#########################################################################################################################
+# TOKEN MANAGER
+# Keeps every token type in memory until shortly before it expires. A token close to expiry is still
+# handed out while one background thread refreshes it; an expired or missing token is fetched by exactly
+# one caller while the others wait for its result (single-flight).
+
+
+class TokenManager:
+    """
+    loaders: {query_type: callable(min_valid) returning (token, expires_at_epoch_seconds) or (None, None);
+              the token must still be valid for min_valid seconds (the refresh margin), so a loader with a
+              shared copy (S3) does not hand back the same nearly expired token}
+    refresh_margins: {query_type: seconds before expiry at which a background refresh starts}
+    clock can be swapped for a fake in tests.
+    """
+
+    def __init__(self, loaders, refresh_margins=None, clock=time.time):
+        self._loaders = loaders
+        self._margins = refresh_margins or {}
+        self._clock = clock
+        self._tokens = {}
+        self._locks = {query_type: threading.Lock() for query_type in loaders}
+        self._in_flight = set()
+        self._in_flight_guard = threading.Lock()
+
+    def _is_valid(self, entry, margin=0):
+        return entry is not None and self._clock() < entry[1] - margin
+
+    def get(self, query_type="default"):
+        entry = self._tokens.get(query_type)
+        if self._is_valid(entry):
+            if not self._is_valid(entry, self._margins.get(query_type, 0)):
+                self._refresh_in_background(query_type)
+            return entry[0]
+        return self.refresh(query_type)
+
+    def refresh(self, query_type="default", force=False):
+        """Load a new token. Concurrent callers share one load instead of logging in once each."""
+        with self._locks[query_type]:
+            entry = self._tokens.get(query_type)
+            # Someone else refreshed it while we were waiting for the lock.
+            margin = self._margins.get(query_type, 0)
+            if not force and self._is_valid(entry, margin):
+                return entry[0]
+            token, expires_at = self._loaders[query_type](margin)
+            if token:
+                self._tokens[query_type] = (token, expires_at)
+                logger.info(f"Token '{query_type}' cached until {time.strftime('%Y-%m-%d %H:%M', time.localtime(expires_at))}.")
+                return token
+            logger.error(f"Token '{query_type}' could not be loaded.")
+            # A token that is about to expire is still better than none.
+            return entry[0] if self._is_valid(entry) else None
+
+    def _refresh_in_background(self, query_type):
+        with self._in_flight_guard:
+            if query_type in self._in_flight:
+                return
+            self._in_flight.add(query_type)
+
+        def run():
+            try:
+                self.refresh(query_type, force=True)
+            except Exception as e:
+                logger.error(f"Background refresh of token '{query_type}' failed: {e}")
+            finally:
+                with self._in_flight_guard:
+                    self._in_flight.discard(query_type)
+
+        threading.Thread(target=run, name=f"token-refresh-{query_type}", daemon=True).start()
+
+    def set(self, query_type, token, expires_at):
+        """Cache a token obtained elsewhere (e.g. a fixed token for the mock server)."""
+        self._tokens[query_type] = (token, expires_at)
+
+    def invalidate(self, query_type="default"):
+        """Drop a cached token, e.g. after the API rejected it."""
+        self._tokens.pop(query_type, None)
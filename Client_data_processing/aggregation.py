@@ -0,0 +1,153 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api.alertlab_api import _timeseries_frame
+from Alertlab_api.instrumentation import timed
+from Alertlab_api.timeseries_batch import TimeseriesBatch
+
+#########################################################################################################################
+# MULTI-SENSOR AGGREGATION
+# Sensors do not always report the same timestamps (a device can drop readings), so frames are first
+# placed on a regular time grid by timestamp, stacked into one (sensors x buckets) array and then
+# reduced in a single NumPy call. Readings of one sensor that fall in the same bucket (a coarser grid,
+# off-grid timestamps, duplicate rows) are added up, or averaged with bucket_how='mean'.
+
+RATE_MS = {"m": 60 * 1000, "h": 3600 * 1000, "d": 86400 * 1000}
+GAP_POLICIES = ("nan", "zero", "ffill")
+BUCKET_POLICIES = ("sum", "mean")
+
+
+def _times(df):
+    """int64 'time' array of a frame or TimeseriesBatch (no copy for batches)."""
+    return df.time if isinstance(df, TimeseriesBatch) else df['time'].to_numpy(dtype='int64')
+
+
+def infer_step(dataframes):
+    """
+    Coarsest spacing between readings across the frames, in ms (defaults to one hour): a batch's own rate if
+    it has one, otherwise the median spacing of its readings. A sensor the data budget downgraded to hourly
+    then puts everyone on the hourly grid (the minute readings are added up into it) instead of its hourly
+    totals landing in single minute buckets.
+    """
+    steps = []
+    for df in dataframes:
+        if isinstance(df, TimeseriesBatch) and df.rate in RATE_MS:
+            steps.append(RATE_MS[df.rate])
+            continue
+        times = _times(df)
+        if len(times) > 1:
+            diffs = np.diff(times)
+            diffs = diffs[diffs > 0]
+            if len(diffs):
+                steps.append(int(np.median(diffs)))
+    return max(steps) if steps else RATE_MS["h"]
+
+
+def bucket_how_for(series):
+    """How readings of one sensor are combined into a coarser bucket: litres add up, temperatures average."""
+    return "sum" if series in (None, "W") else "mean"
+
+
+def _ffill_rows(stacked):
+    """Forward fill NaNs along the time axis of a 2-D array without a Python loop over buckets."""
+    present = ~np.isnan(stacked)
+    idx = np.where(present, np.arange(stacked.shape[1]), 0)
+    np.maximum.accumulate(idx, axis=1, out=idx)
+    filled = stacked[np.arange(stacked.shape[0])[:, None], idx]
+    # Leading gaps have nothing to fill from and stay NaN.
+    filled[~np.maximum.accumulate(present, axis=1)] = np.nan
+    return filled
+
+
+def _nanpercentile_columns(stacked, q):
+    """
+    Per-column percentile ignoring NaNs (linear interpolation, like np.nanpercentile).
+    np.nanpercentile loops over columns internally, this sorts once instead.
+    """
+    ordered = np.sort(stacked, axis=0)  # NaNs sort to the end
+    counts = (~np.isnan(stacked)).sum(axis=0)
+    position = np.maximum(counts - 1, 0) * (q / 100.0)
+    lower = np.floor(position).astype('int64')
+    upper = np.ceil(position).astype('int64')
+    columns = np.arange(stacked.shape[1])
+    low_values = ordered[lower, columns]
+    return low_values + (ordered[upper, columns] - low_values) * (position - lower)
+
+
+@timed()
+def align_series(dataframes, rate=None, gap_policy="nan", column="series", bucket_how="sum"):
+    """
+    Place each frame's (or TimeseriesBatch's) `column` on a shared regular grid.
+    Returns (grid, stacked, present): grid is the int64 bucket start in ms, stacked is a
+    (len(dataframes) x len(grid)) float64 array after applying gap_policy, and present marks
+    the buckets where a sensor actually reported.
+    gap_policy: 'nan' leaves gaps as NaN, 'zero' fills them with 0, 'ffill' carries the last reading forward.
+    bucket_how: 'sum' (litres) or 'mean' (e.g. temperature) for several readings of a sensor in one bucket.
+    """
+    if gap_policy not in GAP_POLICIES:
+        raise ValueError(f"gap_policy must be one of {GAP_POLICIES}")
+    if bucket_how not in BUCKET_POLICIES:
+        raise ValueError(f"bucket_how must be one of {BUCKET_POLICIES}")
+    step = RATE_MS[rate] if rate in RATE_MS else infer_step(dataframes)
+    times = [_times(df) for df in dataframes]
+    non_empty = [t for t in times if len(t)]
+    if not non_empty:
+        return np.array([], dtype='int64'), np.empty((len(dataframes), 0)), np.empty((len(dataframes), 0), dtype=bool)
+
+    t0 = (min(t.min() for t in non_empty) // step) * step
+    t1 = max(t.max() for t in non_empty)
+    grid = np.arange(t0, t1 + 1, step, dtype='int64')
+    stacked = np.full((len(dataframes), len(grid)), np.nan)
+    present = np.zeros((len(dataframes), len(grid)), dtype=bool)
+    for i, (df, t) in enumerate(zip(dataframes, times)):
+        if len(t):
+            if isinstance(df, TimeseriesBatch) and column == "series":
+                values = df.values.astype('float64')
+            else:
+                values = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype='float64')
+            valid = ~np.isnan(values)
+            buckets = (t[valid] - t0) // step
+            counts = np.bincount(buckets, minlength=len(grid))
+            sums = np.bincount(buckets, weights=values[valid], minlength=len(grid))
+            present[i] = counts > 0
+            with np.errstate(invalid='ignore', divide='ignore'):
+                stacked[i] = np.where(present[i], sums / counts if bucket_how == "mean" else sums, np.nan)
+
+    if gap_policy == "zero":
+        stacked = np.where(present, stacked, 0.0)
+    elif gap_policy == "ffill":
+        stacked = _ffill_rows(stacked)
+    return grid, stacked, present
+
+
+@timed()
+def aggregate(dataframes, how="sum", rate=None, gap_policy="nan", column="series", bucket_how="sum"):
+    """
+    Combine several sensors' frames into one frame with columns time, series, Datetime and coverage
+    (the fraction of sensors that reported in each bucket).
+    how: 'sum', 'mean', 'min', 'max', 'median' or a percentile such as 'p95'.
+    Buckets where no value is available after gap_policy are NaN. bucket_how: see align_series.
+    Returns None for an empty list, like the old sum_columns.
+    """
+    if len(dataframes) == 0:
+        return None
+    grid, stacked, present = align_series(dataframes, rate=rate, gap_policy=gap_policy, column=column, bucket_how=bucket_how)
+    has_value = ~np.isnan(stacked).all(axis=0) if stacked.size else np.zeros(len(grid), dtype=bool)
+    with np.errstate(invalid='ignore'):
+        filled = np.where(np.isnan(stacked), 0.0, stacked)
+        if how == "sum":
+            values = filled.sum(axis=0)
+        elif how == "mean":
+            values = filled.sum(axis=0) / np.maximum((~np.isnan(stacked)).sum(axis=0), 1)
+        elif how in ("min", "max", "median") or how.startswith("p"):
+            q = {"min": 0, "max": 100, "median": 50}.get(how)
+            q = float(how[1:]) if q is None else q
+            values = _nanpercentile_columns(stacked, q) if stacked.size else np.array([])
+        else:
+            raise ValueError(f"Unknown aggregation: {how}")
+    values = np.where(has_value, values, np.nan)
+    coverage = present.sum(axis=0) / len(dataframes) if len(grid) else np.array([])
+    df = pd.DataFrame({'time': grid, 'series': values, 'coverage': coverage})
+    return _timeseries_frame(df)[['time', 'series', 'Datetime', 'coverage']]
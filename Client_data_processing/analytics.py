@@ -0,0 +1,143 @@
+import os
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api.instrumentation import timed
+
+#########################################################################################################################
+# SERIES ANALYTICS
+# Outlier clipping, robust baselines and linear trends over plain NumPy arrays, for the charts and anything else
+# that needs them. Everything is vectorized: no per-row apply and no statsmodels (a closed-form least-squares
+# fit gives the same line as plotly's trendline="ols").
+# analyze_series bundles them for the dashboard's summed series and caches the result per
+# (sensor set, window, rate, series), so a rerun with the same data is a dictionary lookup. The cached entry
+# is only reused if the values are byte-for-byte the same, so recent buckets that were still filling in
+# are picked up.
+
+OUTLIER_METHODS = ("iqr", "mad")
+# Scales the MAD to a standard deviation for normally distributed data
+MAD_TO_SIGMA = 1.4826
+ANALYTICS_CACHE_SIZE = int(os.getenv("ANALYTICS_CACHE_SIZE", "64"))
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def outlier_bounds(values, method="iqr", k=None):
+    """
+    (lower, upper) bounds outside which values count as outliers, ignoring NaNs.
+    iqr: Q1 - k * IQR, Q3 + k * IQR (k defaults to 1.5). mad: median -/+ k * 1.4826 * MAD (k defaults to 3.5).
+    """
+    values = np.asarray(values, dtype='float64')
+    if method not in OUTLIER_METHODS:
+        raise ValueError(f"method must be one of {OUTLIER_METHODS}")
+    if np.isnan(values).all():
+        return np.nan, np.nan
+    if method == "iqr":
+        k = 1.5 if k is None else k
+        q1, q3 = np.nanpercentile(values, [25, 75])
+        return q1 - k * (q3 - q1), q3 + k * (q3 - q1)
+    k = 3.5 if k is None else k
+    median = np.nanmedian(values)
+    spread = k * MAD_TO_SIGMA * np.nanmedian(np.abs(values - median))
+    return median - spread, median + spread
+
+
+def clip_outliers(values, method="iqr", k=None, replace="median"):
+    """
+    Copy of values with the outliers replaced: 'median' puts the median in their place (what the dashboard has
+    always shown), 'clip' pulls them back to the nearest bound, 'nan' blanks them. Returns (values, outlier mask).
+    """
+    values = np.asarray(values, dtype='float64')
+    lower, upper = outlier_bounds(values, method, k)
+    with np.errstate(invalid='ignore'):
+        outliers = (values < lower) | (values > upper)
+    if replace == "median":
+        cleaned = np.where(outliers, np.nanmedian(values) if outliers.any() else 0.0, values)
+    elif replace == "clip":
+        cleaned = np.clip(values, lower, upper)
+    elif replace == "nan":
+        cleaned = np.where(outliers, np.nan, values)
+    else:
+        raise ValueError("replace must be 'median', 'clip' or 'nan'")
+    return cleaned, outliers
+
+
+def rolling_baseline(values, window, quantile=0.5, min_periods=1):
+    """
+    Trailing rolling quantile (the median by default) over `window` points: a baseline that a few spikes
+    cannot drag up the way a rolling mean would.
+    """
+    return pd.Series(np.asarray(values, dtype='float64')).rolling(window, min_periods=min_periods).quantile(quantile).to_numpy()
+
+
+def linear_trend(x, y):
+    """
+    Ordinary least squares line through (x, y), NaNs dropped, in closed form.
+    Returns {"slope", "intercept", "r2", "n"}; slope and intercept are NaN with fewer than 2 points.
+    """
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    keep = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[keep], y[keep]
+    n = len(x)
+    if n < 2:
+        return {"slope": np.nan, "intercept": np.nan, "r2": np.nan, "n": n}
+    # Centering first keeps the sums well conditioned with epoch-millisecond x values
+    x_mean, y_mean = x.mean(), y.mean()
+    dx, dy = x - x_mean, y - y_mean
+    sxx, sxy, syy = dx @ dx, dx @ dy, dy @ dy
+    slope = sxy / sxx if sxx else 0.0
+    r2 = (sxy * sxy) / (sxx * syy) if sxx and syy else np.nan
+    return {"slope": slope, "intercept": y_mean - slope * x_mean, "r2": r2, "n": n}
+
+
+def _fingerprint(*arrays):
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+@timed()
+def analyze_series(key, time_ms, values, method="iqr", baseline_window=None):
+    """
+    Outlier-free values, outlier mask, bounds, rolling baseline and the OLS trend (on the outlier-free values,
+    x in ms) of one series, as a dict of arrays / numbers. key identifies the series, e.g.
+    (tuple(sorted(sensor_ids)), start, end, rate, series); results are cached per key. Treat them as read-only.
+    baseline_window: points in the rolling baseline, default one day of the series' spacing.
+    """
+    time_ms = np.asarray(time_ms, dtype='int64')
+    values = np.asarray(values, dtype='float64')
+    if baseline_window is None:
+        step = int(np.median(np.diff(time_ms))) if len(time_ms) > 1 else 3600 * 1000
+        baseline_window = max(1, 86400 * 1000 // max(step, 1))
+    fingerprint = _fingerprint(time_ms, values)
+    with _cache_lock:
+        entry = _cache.get(key)
+        if (entry is not None and entry["fingerprint"] == fingerprint and entry["method"] == method
+                and entry["baseline_window"] == baseline_window):
+            _cache.move_to_end(key)
+            return entry
+
+    normalized, outliers = clip_outliers(values, method)
+    entry = {
+        "fingerprint": fingerprint,
+        "method": method,
+        "baseline_window": baseline_window,
+        "normalized": normalized,
+        "outliers": outliers,
+        "bounds": outlier_bounds(values, method),
+        "baseline": rolling_baseline(normalized, baseline_window),
+        "trend": linear_trend(time_ms, normalized),
+    }
+    with _cache_lock:
+        _cache[key] = entry
+        _cache.move_to_end(key)
+        while len(_cache) > ANALYTICS_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return entry
@@ -0,0 +1,135 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Client_data_processing.aggregation import align_series
+from Alertlab_api.instrumentation import timed
+
+#########################################################################################################################
+# CHART DATA
+# Plotly sends every point to the browser, so a month of minute data for a few sensors meant hundreds of
+# thousands of bars. Chart frames are built here in one pass from the aligned (sensors x buckets) array and
+# downsampled to about one point per pixel of chart width:
+#   - bar chart: min-max per pixel bucket of the total over all sensors (a leak spike or a quiet night is never
+#     averaged away), keeping every sensor's reading at the chosen instants so the stacks stay consistent
+#   - scatter: LTTB (largest triangle three buckets), which keeps the visual shape of a single line
+# A box selection on the bar chart re-queries just that window (selection_window / drill_down_rate), so
+# zooming in brings back full resolution.
+
+# Roughly the plot width of a wide-layout chart; points beyond this cannot be told apart on screen
+CHART_WIDTH_PX = int(os.getenv("CHART_WIDTH_PX", "1600"))
+# Rows of the data table sent to the browser
+TABLE_MAX_ROWS = int(os.getenv("CHART_TABLE_MAX_ROWS", "5000"))
+# Hourly queries switch to minute data once the zoomed window is this short
+DRILL_DOWN_MINUTE_SECONDS = int(float(os.getenv("CHART_DRILL_DOWN_MINUTE_DAYS", "3")) * 86400)
+# Same local clock as the Datetime columns (UTC-4)
+LOCAL_OFFSET = pd.Timedelta(hours=4)
+
+
+def minmax_indices(y, n_buckets):
+    """
+    Sorted indices of the minimum and maximum of y in each of n_buckets equal-width buckets (NaNs are skipped
+    unless a bucket has nothing else). Returns every index if y is already small enough.
+    """
+    n = len(y)
+    if n_buckets <= 0 or n <= 2 * n_buckets:
+        return np.arange(n)
+    size = -(-n // n_buckets)
+    rows = -(-n // size)
+    padded = np.full(rows * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(rows, size)
+    offsets = np.arange(rows) * size
+    lows = np.argmin(np.where(np.isnan(padded), np.inf, padded), axis=1) + offsets
+    highs = np.argmax(np.where(np.isnan(padded), -np.inf, padded), axis=1) + offsets
+    return np.unique(np.minimum(np.concatenate([lows, highs]), n - 1))
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Largest triangle three buckets: indices of n_out points of (x, y) that keep the line's shape.
+    x must be increasing; NaN values count as 0 when picking points.
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype='float64')
+    y = np.nan_to_num(np.asarray(y, dtype='float64'))
+    # First and last points are always kept, the rest is split into n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype('int64')
+    selected = np.empty(n_out, dtype='int64')
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Average of the next bucket (the last point for the last bucket) is the third corner
+        next_lo, next_hi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        cx, cy = x[next_lo:next_hi].mean(), y[next_lo:next_hi].mean()
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+@timed()
+def bar_chart_frame(batches, sources, max_points=CHART_WIDTH_PX, bucket_how="sum"):
+    """
+    Long frame (Datetime, series, Source, Total) for the stacked bar chart, at most about max_points instants.
+    sources: display name per batch. bucket_how: see align_series (mixed rates go on the coarsest grid).
+    Returns (frame, number of instants before downsampling).
+    """
+    grid, stacked, present = align_series(batches, bucket_how=bucket_how)
+    if len(grid) == 0:
+        return pd.DataFrame(columns=['Datetime', 'series', 'Source', 'Total']), 0
+    total = np.where(present, stacked, 0.0).sum(axis=0)
+    total[~present.any(axis=0)] = np.nan
+    keep = minmax_indices(total, max_points // 2)
+    n_sources = len(batches)
+    datetimes = pd.to_datetime(grid[keep], unit='ms') - LOCAL_OFFSET
+    frame = pd.DataFrame({
+        'Datetime': np.tile(datetimes.to_numpy(), n_sources),
+        'series': stacked[:, keep].ravel(),
+        'Source': np.repeat(np.asarray(sources, dtype=object), len(keep)),
+        'Total': np.tile(np.round(total[keep], 3), n_sources),
+    })
+    return frame[present[:, keep].ravel()].reset_index(drop=True), len(grid)
+
+
+def downsample_frame(df, x="Datetime", y="series", max_points=CHART_WIDTH_PX):
+    """Rows of df picked by LTTB on (x, y), for a line or scatter chart."""
+    if len(df) <= max_points:
+        return df
+    x_values = pd.to_datetime(df[x]).to_numpy().astype('int64') if not np.issubdtype(df[x].dtype, np.number) else df[x].to_numpy()
+    return df.iloc[lttb_indices(x_values, df[y].to_numpy(dtype='float64'), max_points)]
+
+
+def table_frame(df, max_rows=TABLE_MAX_ROWS):
+    """The latest max_rows rows, so the table does not ship a whole range to the browser either."""
+    return df if len(df) <= max_rows else df.iloc[-max_rows:]
+
+
+def selection_window(event):
+    """
+    (start_unix, end_unix) of the x range of a box selection from st.plotly_chart(on_select=...), or None.
+    The chart's x values are local (UTC-4) datetimes.
+    """
+    try:
+        boxes = event["selection"]["box"]
+    except (KeyError, TypeError):
+        return None
+    if not boxes:
+        return None
+    try:
+        # Plotly trims trailing zeros, so the two ends do not always share a format
+        x0, x1 = sorted(pd.Timestamp(x) for x in boxes[0]["x"][:2])
+    except (KeyError, TypeError, ValueError):
+        return None
+    to_unix = lambda t: int((t + LOCAL_OFFSET).timestamp())
+    start, end = to_unix(x0), to_unix(x1)
+    return (start, end) if end > start else None
+
+
+def drill_down_rate(rate, start, end):
+    """Minute data once an hourly view is zoomed in far enough, the requested rate otherwise."""
+    return "m" if rate == "h" and int(end) - int(start) <= DRILL_DOWN_MINUTE_SECONDS else rate
@@ -1,14 +1,28 @@
 import pandas as pd
 import os
+import json
+import time
+import hashlib
+import threading
 from datetime import datetime, timedelta
+from collections import defaultdict
 import requests
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from Alertlab_api.alertlab_api import get_token, get_locations, get_property_detailsv4, get_sensoreventsatlocation, get_only_parent_id, get_all_sensors
+from Alertlab_api.alertlab_api import get_token, get_locations, get_property_detailsv4_batch, get_sensoreventsatlocation, get_only_parent_id, get_all_sensors
 from Alertlab_api.aws_utils import get_logger_and_log_stream
+from Alertlab_api.instrumentation import timed
 
 logger, log_stream = get_logger_and_log_stream()
 
+# Property metadata changes rarely, so the fleet-wide table is kept for this long.
+PROPERTY_METADATA_TTL_SECONDS = int(os.getenv("PROPERTY_METADATA_TTL_SECONDS", str(6 * 3600)))
+PROPERTY_METADATA_COLUMNS = ['_id_child', 'numberSuites', 'numberFloors', 'commercialPropertyType', 'age', 'numberUsers']
+
+_metadata_lock = threading.Lock()
+_metadata_table = None
+_metadata_loaded_at = 0.0
+
 
 def _clean_tombstone(tombstone_df):
     """
@@ -49,68 +63,178 @@ def _clean_tombstone(tombstone_df):
     df.rename(columns=renamed_columns, inplace=True)
     return df.reset_index(drop=True)
 
+def _normalize_property_details(details):
+    """
+    One row of the metadata table from a property details record, with the same defaults
+    get_property_metadata has always used for missing fields.
+    """
+    number_of_suites = details.get('numberSuites')
+    if number_of_suites is None:
+        number_of_suites = 1
+    users = details.get('users')
+    return {
+        '_id_child': details.get('_id'),
+        'numberSuites': number_of_suites,
+        'numberFloors': details.get('numberFloors', 1),
+        'commercialPropertyType': details.get('commercialPropertyType', 'Unknown'),
+        'age': details.get('age', 'Unknown'),
+        'numberUsers': len(users) if isinstance(users, list) else 0,
+    }
+
+def _typed_metadata_table(rows):
+    table = pd.DataFrame(rows, columns=PROPERTY_METADATA_COLUMNS)
+    table['_id_child'] = table['_id_child'].astype('string')
+    table['numberSuites'] = pd.to_numeric(table['numberSuites'], errors='coerce').astype('Int64')
+    table['numberFloors'] = pd.to_numeric(table['numberFloors'], errors='coerce').astype('Int64')
+    table['commercialPropertyType'] = table['commercialPropertyType'].astype('string')
+    table['age'] = table['age'].astype('string')
+    table['numberUsers'] = table['numberUsers'].astype('Int64')
+    return table.drop_duplicates(subset='_id_child', keep='last').reset_index(drop=True)
+
+@timed()
+def fetch_property_metadata_table(location_ids):
+    """Fetch and normalize property metadata for many locations in a few chunked requests."""
+    records = get_property_detailsv4_batch(location_ids)
+    logger.info(f"Fetched property details for {len(records)} of {len(set(location_ids))} location(s).")
+    return _typed_metadata_table([_normalize_property_details(record) for record in records])
+
+def get_property_metadata_table(location_ids, refresh=False):
+    """
+    Property metadata (suites, floors, type, age, user count) for the given locations, one row per _id_child.
+    Results are cached for PROPERTY_METADATA_TTL_SECONDS; only locations missing from the cache are fetched.
+    """
+    global _metadata_table, _metadata_loaded_at
+    location_ids = [i for i in pd.unique(pd.Series(location_ids, dtype='object').dropna())]
+    with _metadata_lock:
+        if refresh or _metadata_table is None or time.time() - _metadata_loaded_at > PROPERTY_METADATA_TTL_SECONDS:
+            _metadata_table = fetch_property_metadata_table(location_ids)
+            _metadata_loaded_at = time.time()
+        else:
+            known = set(_metadata_table['_id_child'].dropna())
+            missing = [i for i in location_ids if i not in known]
+            if missing:
+                _metadata_table = _typed_metadata_table(pd.concat([_metadata_table, fetch_property_metadata_table(missing)], ignore_index=True))
+        table = _metadata_table
+    return table[table['_id_child'].isin(location_ids)].reset_index(drop=True)
+
+def enrich_tombstone_with_property_details(tombstone_df):
+    """Left-join the property metadata table onto the tombstone by _id_child."""
+    metadata = get_property_metadata_table(tombstone_df['_id_child'])
+    df = tombstone_df.drop(columns=[c for c in PROPERTY_METADATA_COLUMNS[1:] if c in tombstone_df.columns])
+    df = df.merge(metadata.astype({'_id_child': object}), on='_id_child', how='left')
+    return df
+
 def get_property_metadata(property_id):
     """
     Get property metadata from settings using hidden APIs from alertAQ platform.
     Returns number of suites, number of floors, property type, property age, and number of users
+    Served from the cached metadata table (see get_property_metadata_table).
 
     Example:
     property_id = '5f5d6b4b4b0b6e001b7f7e9b'
     number_of_suites, number_of_floors, CommercialPropertyType, property_age, number_of_users = get_property_metadata(property_id)
 
     """
-    property_details = get_property_detailsv4(property_id)
-    try:
-        number_of_suites = property_details['dataModel'][0]['numberSuites']
-        if number_of_suites is None: 
-            number_of_suites = 1
-    except KeyError as e:
-        number_of_suites = 1
-        logger.error(f"KeyError: {e} - number_of_suites not found in property details")
-        pass
-    try:
-        number_of_floors = property_details['dataModel'][0]['numberFloors']
-    except KeyError as e:
-        number_of_floors = 1
-        logger.error(f"KeyError: {e} - number_of_floors not found in property details")
-        pass
-    try:
-        CommercialPropertyType = property_details['dataModel'][0]['commercialPropertyType']
-    except KeyError as e:
-        CommercialPropertyType = 'Unknown'
-        logger.error(f"KeyError: {e} - commercialPropertyType not found in property details")
-        pass
-    try:
-        property_age = property_details['dataModel'][0]['age']
-    except KeyError as e:
-        property_age = 'Unknown'
-        logger.error(f"KeyError: {e} - age not found in property details")
-        pass
-    try:
-        number_of_users = len(property_details['dataModel'][0]['users'])
-    except KeyError as e:
-        number_of_users = 0
-        logger.error(f"KeyError: {e} - users not found in property details")
-        pass
-    return number_of_suites, number_of_floors, CommercialPropertyType, property_age, number_of_users
+    table = get_property_metadata_table([property_id])
+    if table.empty:
+        logger.error(f"No property details found for {property_id}, using defaults")
+        return 1, 1, 'Unknown', 'Unknown', 0
+    row = table.iloc[0]
 
+    def value(column, default):
+        return default if pd.isna(row[column]) else row[column]
 
-def populate_client_data():
-    token = get_token()
-    locations = get_locations(token)
+    number_of_suites = int(value('numberSuites', 1))
+    number_of_floors = value('numberFloors', None)
+    number_of_floors = int(number_of_floors) if number_of_floors is not None else None
+    return number_of_suites, number_of_floors, value('commercialPropertyType', 'Unknown'), value('age', 'Unknown'), int(row['numberUsers'])
+
+
+#########################################################################################################################
+# INCREMENTAL TOMBSTONE REFRESH
+# The listings only come as full pulls, but most refreshes change a handful of locations at most. Each location
+# gets a fingerprint of its slice of the listings (its record, its parent's record and its Flowie sensors), and
+# refresh_client_data only runs the merge / clean steps for locations whose fingerprint is new or different,
+# keeping every other row of the previous tombstone as it is.
+
+LISTING_SENSOR_FIELDS = ['_id', 'name', 'serialNumber', 'friendlyType']
+FLOWIE_TYPES = ('Flowie', 'Flowie-O')
+
+
+def _flowie_sensors(sensors):
+    return [s for s in sensors if s.get('friendlyType') in FLOWIE_TYPES]
+
+def listing_hashes(locations, sensors):
+    """{location _id: fingerprint of everything its tombstone row is built from}, in listing order."""
+    by_id = {location.get('_id'): location for location in locations}
+    sensors_by_location = defaultdict(list)
+    for sensor in _flowie_sensors(sensors):
+        sensors_by_location[sensor.get('location_id')].append([sensor.get(field) for field in LISTING_SENSOR_FIELDS])
+    hashes = {}
+    for location in locations:
+        parent = by_id.get(location.get('parentID'))
+        payload = json.dumps([location, parent, sensors_by_location.get(location.get('_id'), [])], sort_keys=True, default=str)
+        hashes[location.get('_id')] = hashlib.blake2b(payload.encode('utf-8'), digest_size=12).hexdigest()
+    return hashes
+
+def build_tombstone_rows(locations, sensors, location_ids=None):
+    """Tombstone rows for the given location ids (every location if None), straight from the listings."""
     location_df = pd.DataFrame(locations)
+    sensors_df = pd.DataFrame(_flowie_sensors(sensors), columns=LISTING_SENSOR_FIELDS + ['location_id'])
+    children = location_df
+    if location_ids is not None:
+        location_ids = set(location_ids)
+        children = location_df[location_df['_id'].isin(location_ids)]
+        sensors_df = sensors_df[sensors_df['location_id'].isin(location_ids)]
+    sensors_df = sensors_df.groupby(by='location_id', as_index=False)[LISTING_SENSOR_FIELDS].agg(list)
+
+    # Get parent properties with self-join (parents come from the full listing)
+    children = pd.merge(children, location_df, left_on='parentID', right_on='_id', suffixes=('_child', '_parent'), how='left')
+
+    tombstone_df = pd.merge(children, sensors_df, left_on='_id_child', right_on='location_id', how='outer')
+    return _clean_tombstone(tombstone_df)
 
+def diff_listings(previous_hashes, hashes):
+    """{'added', 'changed', 'removed'}: location ids whose listing fingerprint appeared, differs or disappeared."""
+    previous_hashes = previous_hashes or {}
+    return {
+        'added': [i for i in hashes if i not in previous_hashes],
+        'changed': [i for i in hashes if i in previous_hashes and previous_hashes[i] != hashes[i]],
+        'removed': [i for i in previous_hashes if i not in hashes],
+    }
+
+@timed()
+def refresh_client_data(previous=None, previous_hashes=None):
+    """
+    Pull the listings and bring the previous tombstone (with the listing_hashes it was built from) up to date,
+    rebuilding only the rows of added or changed locations. With no previous tombstone everything is built.
+    Returns (tombstone_df, hashes, changes); tombstone_df is `previous` itself if nothing changed.
+    """
+    token = get_token()
+    locations = get_locations(token)
     sensors = get_all_sensors(token)
-    sensors_df = pd.DataFrame(sensors)
-    sensors_df = sensors_df[(sensors_df['friendlyType'] == 'Flowie-O') | (sensors_df['friendlyType'] == 'Flowie')]
-    sensors_df= sensors_df.groupby(by='location_id', as_index=False)[['_id', 'name', 'serialNumber', 'friendlyType']].agg(list)
+    hashes = listing_hashes(locations, sensors)
+    if previous is None or previous_hashes is None:
+        changes = diff_listings({}, hashes)
+        return build_tombstone_rows(locations, sensors), hashes, changes
 
-    # Get parent properties with self-join
-    location_df = pd.merge(location_df, location_df, left_on='parentID', right_on='_id', suffixes=('_child', '_parent'), how='left')
-    
-    tombstone_df = pd.merge(location_df,sensors_df,left_on='_id_child', right_on='location_id', how='outer')
-    tombstone_df = _clean_tombstone(tombstone_df)  
-    return tombstone_df
+    changes = diff_listings(previous_hashes, hashes)
+    rebuild = changes['added'] + changes['changed']
+    if not rebuild and not changes['removed']:
+        return previous, hashes, changes
+    keep = previous[~previous['_id_child'].isin(set(changes['changed']) | set(changes['removed']))]
+    parts = [keep]
+    if rebuild:
+        parts.append(build_tombstone_rows(locations, sensors, rebuild))
+    tombstone_df = pd.concat(parts, ignore_index=True)
+    # Same row order as a full build (the outer merge sorts by location id)
+    tombstone_df = tombstone_df.sort_values('_id_child', kind='stable').reset_index(drop=True)
+    return tombstone_df, hashes, changes
+
+@timed()
+def populate_client_data():
+    """The whole tombstone, built from scratch."""
+    return refresh_client_data()[0]
     
 
 
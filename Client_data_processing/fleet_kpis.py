@@ -0,0 +1,133 @@
+import os
+import sys
+import time
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api.alertlab_api import fetch_timeseries_batch
+from Alertlab_api.rollups import is_night
+from Alertlab_api.rate_limiter import request_priority, BACKGROUND
+from Alertlab_api import timeseries_store
+from Client_data_processing.aggregation import align_series
+from Alertlab_api.aws_utils import get_logger_and_log_stream
+from Alertlab_api.instrumentation import timed
+
+logger, log_stream = get_logger_and_log_stream()
+
+#########################################################################################################################
+# FLEET-WIDE KPIS
+# The dashboard's four KPIs for every property in the tombstone at once. All sensors' trailing 7 day hourly
+# series are stacked into one (sensors x hours) array, summed per property with a (properties x sensors)
+# membership matrix, and the KPIs are column reductions over the result.
+
+FLEET_KPIS_TTL_SECONDS = int(os.getenv("FLEET_KPIS_TTL_SECONDS", "900"))
+
+_cache_lock = threading.Lock()
+# building: an Event while one caller computes the table (single flight)
+_cache = {"computed_at": 0.0, "table": None, "building": None}
+
+
+def _property_sensors(tombstone_df):
+    """Rows of the tombstone that have at least one sensor, with their sensor lists."""
+    df = tombstone_df[tombstone_df['sensor_ids'].map(lambda s: isinstance(s, (list, tuple)) and len(s) > 0)]
+    return df.drop_duplicates(subset='_id_child').reset_index(drop=True)
+
+
+def fleet_kpis_from_frames(properties, sensor_ids, frames):
+    """
+    Compute the KPI table from already fetched hourly frames.
+    properties: tombstone rows with '_id_child', 'name_child', 'name_parent', 'sensor_ids' (and 'numberSuites' if enriched)
+    sensor_ids / frames: parallel lists; a None frame means the sensor could not be fetched.
+    """
+    fetched = [(s, f) for s, f in zip(sensor_ids, frames) if f is not None]
+    sensor_index = {s: i for i, (s, _) in enumerate(fetched)}
+    grid, stacked, present = align_series([f for _, f in fetched], rate="h", gap_policy="nan")
+
+    membership = np.zeros((len(properties), len(fetched)))
+    for row, sensors in enumerate(properties['sensor_ids']):
+        for sensor in sensors:
+            if sensor in sensor_index:
+                membership[row, sensor_index[sensor]] = 1.0
+
+    # (properties x hours) litres, NaN where none of the property's sensors reported
+    totals = membership @ np.where(present, stacked, 0.0)
+    reported = (membership @ present.astype('float64')) > 0
+    totals[~reported] = np.nan
+
+    night = is_night(grid)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        night_totals = totals[:, night]
+        night_mean = np.nanmean(night_totals, axis=1) if night.any() else np.full(len(properties), np.nan)
+        night_median = np.nanmedian(night_totals, axis=1) if night.any() else np.full(len(properties), np.nan)
+        seven_day_mean = np.nanmean(totals, axis=1) if len(grid) else np.full(len(properties), np.nan)
+        suites = pd.to_numeric(properties['numberSuites'], errors='coerce').fillna(1).to_numpy() if 'numberSuites' in properties else np.ones(len(properties))
+        suites = np.where(suites > 0, suites, 1)
+        table = pd.DataFrame({
+            '_id_child': properties['_id_child'].to_numpy(),
+            'name_child': properties['name_child'].to_numpy(),
+            'name_parent': properties['name_parent'].to_numpy(),
+            'sensors': membership.sum(axis=1).astype(int),
+            'night_mean': night_mean,
+            'night_median': night_median,
+            'seven_day_mean': seven_day_mean,
+            'night_day_ratio': night_mean / seven_day_mean,
+            'numberSuites': suites,
+            'night_per_suite': night_mean / suites,
+            'coverage': reported.mean(axis=1) if len(grid) else np.zeros(len(properties)),
+        })
+    table = table.sort_values('night_per_suite', ascending=False, na_position='last').reset_index(drop=True)
+    table.insert(0, 'rank', np.arange(1, len(table) + 1))
+    return table
+
+
+@timed()
+def compute_fleet_kpis(tombstone_df, token=None, end=None):
+    """Fetch the trailing 7 days for every sensor in the tombstone and rank every property."""
+    started = time.time()
+    properties = _property_sensors(tombstone_df)
+    sensor_ids = list(dict.fromkeys(s for sensors in properties['sensor_ids'] for s in sensors))
+    if end is None:
+        # Stop at the last complete, settled hour: that range stays fully held in the store, so repeat runs
+        # within the hour cost no requests and later runs only fetch the new hours.
+        end = datetime.fromtimestamp(((time.time() - timeseries_store.SETTLE_SECONDS) // 3600) * 3600 - 1)
+    end_unix = int(time.mktime(end.timetuple()))
+    start_unix = int(time.mktime((end - timedelta(days=7)).timetuple()))
+    results = fetch_timeseries_batch(sensor_ids, start_unix, end_unix, rate="h", series="W", token=token)
+    table = fleet_kpis_from_frames(properties, sensor_ids, [df for _, df, _ in results])
+    failed = sum(1 for _, df, _ in results if df is None)
+    logger.info(f"Fleet KPIs for {len(properties)} properties / {len(sensor_ids)} sensors in {time.time() - started:.1f}s ({failed} sensor(s) failed).")
+    return table
+
+
+def get_fleet_kpis(tombstone_df, token=None, refresh=False):
+    """
+    compute_fleet_kpis, shared by every session for FLEET_KPIS_TTL_SECONDS. One caller builds the table,
+    outside the lock and at background priority so it does not eat into the dashboards' interactive share;
+    meanwhile the others get the previous table, or wait for the first one to be built.
+    """
+    while True:
+        with _cache_lock:
+            table = _cache["table"]
+            if not refresh and table is not None and time.time() - _cache["computed_at"] <= FLEET_KPIS_TTL_SECONDS:
+                return table
+            building = _cache["building"]
+            if building is None:
+                building = _cache["building"] = threading.Event()
+                break
+        if table is not None:
+            return table
+        # Nothing to show yet: wait for the build in flight, and build it ourselves if it failed.
+        building.wait()
+        refresh = False
+    try:
+        with request_priority(BACKGROUND):
+            table = compute_fleet_kpis(tombstone_df, token=token)
+        with _cache_lock:
+            _cache["table"], _cache["computed_at"] = table, time.time()
+        return table
+    finally:
+        with _cache_lock:
+            _cache["building"] = None
+        building.set()
@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import bisect
+import hashlib
+import threading
+from collections import deque
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api.alertlab_api import fetch_timeseries_batch
+from Alertlab_api.rollups import is_night
+from Alertlab_api import timeseries_store
+from Client_data_processing.aggregation import align_series
+from Alertlab_api.aws_utils import get_logger_and_log_stream
+from Alertlab_api.instrumentation import timed
+
+logger, log_stream = get_logger_and_log_stream()
+
+#########################################################################################################################
+# ROLLING 7 DAY KPI STATE
+# The dashboard's night mean / night median / 7 day mean for a set of sensors, kept as running state over
+# the trailing WINDOW_HOURS of settled hourly totals instead of being recomputed from 7 days of rows on every Query.
+# Each read only fetches (from the store, so usually without a request) the hours that settled since the last
+# read, folds them in and evicts the ones that fell out of the window. State is persisted per sensor set:
+#   <KPI_STATE_DIR>/<sha1 of the sorted sensor ids>.json
+# A sensor that fails to fetch does not hold the others back: the hours are folded in without it, the range
+# it is missing is recorded per sensor, and its readings are added to those hours once a later read gets them.
+
+WINDOW_HOURS = 7 * 24
+KPI_STATE_DIR = os.getenv("KPI_STATE_DIR", os.path.join(timeseries_store.STORE_DIR, "_kpi_state"))
+HOUR_MS = 3600 * 1000
+# Missing sensors are asked for again at most this often (the page reads the KPIs several times per Query)
+GAP_RETRY_SECONDS = int(os.getenv("KPI_GAP_RETRY_SECONDS", "60"))
+
+_locks = {}
+_locks_guard = threading.Lock()
+_states = {}
+
+
+def kpi_ratio(numerator, denominator):
+    """numerator / denominator, NaN instead of an error or inf when the denominator is 0, NaN or missing (e.g. a week without water)."""
+    if numerator is None or denominator is None or np.isnan(denominator) or denominator == 0:
+        return np.nan
+    return np.float64(numerator) / np.float64(denominator)
+
+
+def state_key(sensor_ids):
+    return hashlib.sha1("|".join(sorted(sensor_ids)).encode("utf-8")).hexdigest()[:16]
+
+
+def _state_lock(key):
+    with _locks_guard:
+        return _locks.setdefault(key, threading.Lock())
+
+
+class RollingKpiState:
+    """
+    Hourly totals of one sensor set over a trailing window, with running sums and a sorted list of the
+    night hours (the streaming median: insert / remove by bisection, median read from the middle).
+    """
+
+    def __init__(self, sensor_ids, window_hours=WINDOW_HOURS):
+        self.sensor_ids = sorted(sensor_ids)
+        self.window_ms = window_hours * HOUR_MS
+        self.end_ms = None  # exclusive end of the hours folded in so far
+        self.hours = deque()  # (time_ms, litres), oldest first
+        self.total_sum = 0.0
+        self.night_sum = 0.0
+        self._night_sorted = []
+        self.gaps = {}  # sensor_id: [[start_ms, end_ms), ...] folded in without that sensor
+        self.gaps_tried_at = None
+
+    def push(self, time_ms, value):
+        time_ms, value = int(time_ms), float(value)
+        if self.hours and time_ms <= self.hours[-1][0]:
+            return
+        self.hours.append((time_ms, value))
+        self.total_sum += value
+        if is_night(time_ms):
+            self.night_sum += value
+            bisect.insort(self._night_sorted, value)
+
+    def add_to_hour(self, time_ms, value):
+        """Add a late reading (a sensor that was missing) to an hour already in the window, or insert the hour."""
+        time_ms, value = int(time_ms), float(value)
+        times = [t for t, _ in self.hours]
+        i = bisect.bisect_left(times, time_ms)
+        old = self.hours[i][1] if i < len(times) and times[i] == time_ms else None
+        if old is None:
+            self.hours.insert(i, (time_ms, value))
+        else:
+            self.hours[i] = (time_ms, old + value)
+        self.total_sum += value
+        if is_night(time_ms):
+            self.night_sum += value
+            if old is not None:
+                del self._night_sorted[bisect.bisect_left(self._night_sorted, old)]
+            bisect.insort(self._night_sorted, value if old is None else old + value)
+
+    def add_gap(self, sensor_id, start_ms, end_ms):
+        self.gaps[sensor_id] = timeseries_store.merge_intervals(self.gaps.get(sensor_id, []) + [[int(start_ms), int(end_ms)]])
+
+    def fill_gap(self, sensor_id, start_ms, end_ms):
+        remaining = [piece for g_start, g_end in self.gaps.get(sensor_id, [])
+                     for piece in timeseries_store.subtract_intervals(g_start, g_end, [[start_ms, end_ms]])]
+        if remaining:
+            self.gaps[sensor_id] = [list(piece) for piece in remaining]
+        else:
+            self.gaps.pop(sensor_id, None)
+
+    def evict(self, end_ms):
+        """Drop the hours (and recorded gaps) that are no longer inside the window ending at end_ms."""
+        window_start = end_ms - self.window_ms
+        while self.hours and self.hours[0][0] < window_start:
+            time_ms, value = self.hours.popleft()
+            self.total_sum -= value
+            if is_night(time_ms):
+                self.night_sum -= value
+                del self._night_sorted[bisect.bisect_left(self._night_sorted, value)]
+        for sensor_id in list(self.gaps):
+            self.fill_gap(sensor_id, float("-inf"), window_start)
+
+    def advance(self, grid, totals, end_ms):
+        """Fold in the hourly totals (NaN = no reading) of [self.end_ms, end_ms) and move the window to end_ms."""
+        for time_ms, value in zip(grid, totals):
+            if time_ms < end_ms and not np.isnan(value):
+                self.push(time_ms, value)
+        self.end_ms = int(end_ms)
+        self.evict(end_ms)
+
+    def kpis(self):
+        night = self._night_sorted
+        n = len(night)
+        if n == 0:
+            night_median = np.nan
+        elif n % 2:
+            night_median = night[n // 2]
+        else:
+            night_median = (night[n // 2 - 1] + night[n // 2]) / 2
+        # numpy floats like the frame-based KPIs used to return
+        return {
+            "night_mean": np.float64(self.night_sum / n) if n else np.nan,
+            "night_median": np.float64(night_median),
+            "seven_day_mean": np.float64(self.total_sum / len(self.hours)) if self.hours else np.nan,
+            "hours": len(self.hours),
+            "night_hours": n,
+            "end_ms": self.end_ms,
+            # Sensors whose readings are missing from some of the window's hours
+            "missing_sensors": sorted(self.gaps),
+        }
+
+    def to_dict(self):
+        return {"sensor_ids": self.sensor_ids, "window_ms": self.window_ms, "end_ms": self.end_ms, "hours": list(self.hours),
+                "gaps": self.gaps}
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls(data["sensor_ids"], data["window_ms"] // HOUR_MS)
+        # Rebuilding the sums from the hours also clears any floating point drift from long-running updates.
+        for time_ms, value in data["hours"]:
+            state.push(time_ms, value)
+        state.end_ms = data["end_ms"]
+        state.gaps = data.get("gaps", {})
+        return state
+
+
+def _state_path(key, root=None):
+    return os.path.join(root or KPI_STATE_DIR, f"{key}.json")
+
+
+def load_state(sensor_ids, root=None):
+    path = _state_path(state_key(sensor_ids), root)
+    try:
+        with open(path, "r") as f:
+            return RollingKpiState.from_dict(json.load(f))
+    except FileNotFoundError:
+        return RollingKpiState(sensor_ids)
+    except (ValueError, KeyError, OSError) as e:
+        logger.error(f"Unreadable KPI state {path}, starting over: {e}")
+        return RollingKpiState(sensor_ids)
+
+
+def save_state(state, root=None):
+    directory = root or KPI_STATE_DIR
+    os.makedirs(directory, exist_ok=True)
+    timeseries_store._atomic_write_bytes(_state_path(state_key(state.sensor_ids), root), json.dumps(state.to_dict()).encode("utf-8"))
+
+
+def settled_hour_ms(now=None):
+    """Start (ms) of the first hour that has not fully settled yet; the window ends here."""
+    now = time.time() if now is None else now
+    return int((now - timeseries_store.SETTLE_SECONDS) // 3600) * HOUR_MS
+
+
+def _hourly_totals(frames):
+    grid, stacked, present = align_series(frames, rate="h")
+    totals = np.where(present, stacked, 0.0).sum(axis=0)
+    totals[~present.any(axis=0)] = np.nan
+    return grid, totals
+
+
+def _fill_gaps(state, token=None):
+    """Fetch the hours each sensor is missing from and add its readings to them. Returns True if any were added."""
+    changed = False
+    for sensor_id, gaps in list(state.gaps.items()):
+        for gap_start, gap_end in gaps:
+            [(_, df, error)] = fetch_timeseries_batch([sensor_id], gap_start // 1000, gap_end // 1000 - 1, rate="h", series="W", token=token)
+            if df is None:
+                logger.warning(f"KPI state still missing sensor {sensor_id} for {gap_start}-{gap_end}: {error}")
+                continue
+            grid, totals = _hourly_totals([df])
+            for time_ms, value in zip(grid, totals):
+                if gap_start <= time_ms < gap_end and not np.isnan(value):
+                    state.add_to_hour(time_ms, value)
+            state.fill_gap(sensor_id, gap_start, gap_end)
+            changed = True
+    return changed
+
+
+@timed()
+def get_rolling_kpis(sensor_ids, token=None, now=None, root=None):
+    """
+    Night mean, night median and 7 day mean of the summed hourly water use of sensor_ids, after folding in the
+    hours that settled since the last call. The window is the WINDOW_HOURS before the last settled hour.
+    Sensors that cannot be fetched are left out of the new hours and listed in 'missing_sensors' until a later
+    call gets their readings; if none of them can be fetched the state simply waits for the next call.
+    """
+    key = state_key(sensor_ids)
+    with _state_lock(key):
+        state = _states.get(key) or load_state(sensor_ids, root)
+        _states[key] = state
+        end_ms = settled_hour_ms(now)
+        changed = False
+        if state.gaps and (state.gaps_tried_at is None or time.time() - state.gaps_tried_at >= GAP_RETRY_SECONDS):
+            state.gaps_tried_at = time.time()
+            changed = _fill_gaps(state, token)
+        start_ms = end_ms - state.window_ms if state.end_ms is None else max(state.end_ms, end_ms - state.window_ms)
+        if start_ms < end_ms:
+            results = fetch_timeseries_batch(state.sensor_ids, start_ms // 1000, end_ms // 1000 - 1, rate="h", series="W", token=token)
+            fetched = [df for _, df, _ in results if df is not None]
+            failed = [(sensor_id, error) for sensor_id, df, error in results if df is None]
+            if failed:
+                logger.warning(f"KPI state for {len(state.sensor_ids)} sensor(s): {len(failed)} failed to fetch "
+                               f"({failed[0][1]}), {'folding in the others' if fetched else 'not advanced'}")
+            if fetched:
+                grid, totals = _hourly_totals(fetched)
+                in_range = grid >= start_ms
+                state.advance(grid[in_range], totals[in_range], end_ms)
+                for sensor_id, _ in failed:
+                    state.add_gap(sensor_id, start_ms, end_ms)
+                changed = True
+        if changed:
+            save_state(state, root)
+        return state.kpis()
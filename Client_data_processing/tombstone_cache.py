@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import math
+import time
+import threading
+from datetime import datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Client_data_processing.client_data_processing import refresh_client_data, enrich_tombstone_with_property_details, PROPERTY_METADATA_COLUMNS
+from Alertlab_api.aws_utils import get_logger_and_log_stream
+
+logger, log_stream = get_logger_and_log_stream()
+
+#########################################################################################################################
+# SHARED TOMBSTONE SNAPSHOT
+# The tombstone (locations joined with their parents and Flowie sensors) is built once into a Parquet
+# snapshot and held once per process. Every Streamlit session reads the same DataFrame, and a background
+# thread refreshes it from the API when it is older than TOMBSTONE_TTL_SECONDS. The refresh is incremental
+# (see refresh_client_data): the listing fingerprints are stored in the snapshot, only changed locations are
+# rebuilt, and an unchanged tombstone is not rewritten at all.
+# TombstoneIndex holds the sidebar's lookups (organization -> properties -> sensors), built once per snapshot.
+
+_here = os.path.dirname(os.path.abspath(__file__))
+SNAPSHOT_PATH = os.getenv("TOMBSTONE_SNAPSHOT_PATH", os.path.join(_here, "tombstone.parquet"))
+LAST_UPDATED_PATH = os.getenv("TOMBSTONE_LAST_UPDATED_PATH", os.path.join(_here, "last_updated.txt"))
+TOMBSTONE_TTL_SECONDS = int(os.getenv("TOMBSTONE_TTL_SECONDS", str(6 * 3600)))
+# After a failed background refresh the next one waits this long, doubling per consecutive failure (up to the TTL)
+TOMBSTONE_RETRY_SECONDS = int(os.getenv("TOMBSTONE_RETRY_SECONDS", "300"))
+
+_JSON_COLUMNS_KEY = b"tombstone_json_columns"
+_LISTING_HASHES_KEY = b"tombstone_listing_hashes"
+
+_lock = threading.Lock()
+_build_lock = threading.Lock()
+_tombstone = None
+_updated_at = None
+_listing_hashes = None
+_index = None
+_refresh_thread = None
+_refresh_attempted_at = 0.0
+_refresh_failures = 0
+
+
+def _is_null(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _encode_nested_columns(df):
+    """
+    Parquet needs one type per column. Object columns holding lists/dicts or mixed types
+    (sensor_ids, ancestors, ...) are stored as JSON text and decoded again on load.
+    """
+    df = df.copy()
+    json_columns = []
+    for column in df.columns:
+        if df[column].dtype != object:
+            continue
+        values = [v for v in df[column] if not _is_null(v)]
+        if all(isinstance(v, str) for v in values):
+            continue
+        df[column] = [None if _is_null(v) else json.dumps(v, default=str) for v in df[column]]
+        json_columns.append(column)
+    return df, json_columns
+
+
+def _decode_nested_columns(df, json_columns):
+    for column in json_columns:
+        df[column] = [None if v is None else json.loads(v) for v in df[column]]
+    return df
+
+
+def write_snapshot(df, path=SNAPSHOT_PATH, last_updated_path=LAST_UPDATED_PATH, listing_hashes=None):
+    """Write the tombstone snapshot atomically and stamp last_updated.txt. Returns the timestamp."""
+    encoded, json_columns = _encode_nested_columns(df)
+    table = pa.Table.from_pandas(encoded, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[_JSON_COLUMNS_KEY] = json.dumps(json_columns).encode("utf-8")
+    if listing_hashes is not None:
+        metadata[_LISTING_HASHES_KEY] = json.dumps(listing_hashes).encode("utf-8")
+    table = table.replace_schema_metadata(metadata)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+    return stamp_last_updated(last_updated_path)
+
+
+def stamp_last_updated(last_updated_path=LAST_UPDATED_PATH):
+    updated_at = datetime.now()
+    with open(last_updated_path, "w") as f:
+        f.write(updated_at.isoformat(timespec="seconds"))
+    return updated_at
+
+
+def read_last_updated(last_updated_path=LAST_UPDATED_PATH):
+    try:
+        with open(last_updated_path, "r") as f:
+            return datetime.fromisoformat(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def read_listing_hashes(path=SNAPSHOT_PATH):
+    """Listing fingerprints the snapshot was built from, or None (e.g. a snapshot from before they were kept)."""
+    try:
+        hashes = (pq.read_schema(path).metadata or {}).get(_LISTING_HASHES_KEY)
+    except Exception:
+        return None
+    return json.loads(hashes) if hashes else None
+
+
+def read_snapshot(path=SNAPSHOT_PATH, last_updated_path=LAST_UPDATED_PATH):
+    """Return (tombstone_df, updated_at), or (None, None) if there is no usable snapshot."""
+    if not os.path.exists(path):
+        return None, None
+    try:
+        table = pq.read_table(path)
+        json_columns = json.loads((table.schema.metadata or {}).get(_JSON_COLUMNS_KEY, b"[]"))
+        df = _decode_nested_columns(table.to_pandas(), json_columns)
+    except Exception as e:
+        logger.error(f"Failed to read tombstone snapshot {path}: {e}")
+        return None, None
+    updated_at = read_last_updated(last_updated_path) or datetime.fromtimestamp(os.path.getmtime(path))
+    return df, updated_at
+
+
+def _load_snapshot():
+    """read_snapshot plus its listing fingerprints into the process-wide state. Called with _lock held."""
+    global _tombstone, _updated_at, _listing_hashes
+    df, updated_at = read_snapshot()
+    if df is not None:
+        _tombstone, _updated_at, _listing_hashes = df, updated_at, read_listing_hashes()
+    return df
+
+
+def _is_stale(updated_at):
+    return updated_at is None or (datetime.now() - updated_at).total_seconds() > TOMBSTONE_TTL_SECONDS
+
+
+def _same_metadata(previous, df):
+    columns = [c for c in PROPERTY_METADATA_COLUMNS if c in previous.columns]
+    return len(columns) == len(PROPERTY_METADATA_COLUMNS) and previous[columns].equals(df[columns])
+
+
+def refresh_tombstone():
+    """
+    Bring the tombstone up to date with the API, write the snapshot and swap it in for every session.
+    Only locations whose listings changed are rebuilt; if nothing changed, only last_updated.txt is stamped.
+    """
+    global _tombstone, _updated_at, _listing_hashes
+    started = time.time()
+    with _lock:
+        previous, previous_hashes = _tombstone, _listing_hashes
+    df, hashes, changes = refresh_client_data(previous, previous_hashes)
+    try:
+        df = enrich_tombstone_with_property_details(df)
+    except Exception as e:
+        logger.error(f"Could not join property metadata into the tombstone: {e}")
+    if previous is not None and not any(changes.values()) and _same_metadata(previous, df):
+        updated_at = stamp_last_updated()
+        with _lock:
+            _updated_at, _listing_hashes = updated_at, hashes
+        logger.info(f"Tombstone unchanged after {time.time() - started:.1f}s ({len(previous)} rows).")
+        return previous
+    updated_at = write_snapshot(df, listing_hashes=hashes)
+    with _lock:
+        _tombstone, _updated_at, _listing_hashes = df, updated_at, hashes
+    counts = ", ".join(f"{len(ids)} {kind}" for kind, ids in changes.items())
+    logger.info(f"Tombstone snapshot refreshed in {time.time() - started:.1f}s ({len(df)} rows; locations {counts}).")
+    return df
+
+
+def _retry_delay(failures):
+    """Seconds to wait after `failures` consecutive failed refreshes before trying again."""
+    if failures == 0:
+        return 0
+    return min(TOMBSTONE_RETRY_SECONDS * 2 ** (failures - 1), max(TOMBSTONE_RETRY_SECONDS, TOMBSTONE_TTL_SECONDS))
+
+
+def _refresh_in_background():
+    global _refresh_thread, _refresh_attempted_at
+
+    def run():
+        global _refresh_failures
+        try:
+            refresh_tombstone()
+        except Exception as e:
+            with _lock:
+                _refresh_failures += 1
+                delay = _retry_delay(_refresh_failures)
+            logger.error(f"Background tombstone refresh failed ({_refresh_failures} in a row), keeping the current snapshot "
+                         f"and retrying in {delay}s: {e}")
+        else:
+            with _lock:
+                _refresh_failures = 0
+
+    # Called with _lock held; only one refresh runs at a time, and not again until the failure backoff has passed.
+    if _refresh_thread is not None and _refresh_thread.is_alive():
+        return
+    if time.time() - _refresh_attempted_at < _retry_delay(_refresh_failures):
+        return
+    _refresh_attempted_at = time.time()
+    _refresh_thread = threading.Thread(target=run, name="tombstone-refresh", daemon=True)
+    _refresh_thread.start()
+
+
+def get_tombstone():
+    """
+    Return the process-wide tombstone DataFrame. It is shared by every session, so treat it as read-only.
+    Loads the snapshot on first use (building it from the API only if there is none) and schedules a
+    background refresh once it is older than TOMBSTONE_TTL_SECONDS.
+    """
+    with _lock:
+        if _tombstone is None:
+            if _load_snapshot() is not None:
+                logger.info(f"Tombstone loaded from snapshot taken {_updated_at}.")
+        if _tombstone is not None:
+            if _is_stale(_updated_at):
+                # Another process may already have written a newer snapshot.
+                on_disk = read_last_updated()
+                if on_disk is None or _is_stale(on_disk) or _load_snapshot() is None:
+                    _refresh_in_background()
+            return _tombstone
+    # No snapshot yet: the first session has to wait for the API once, the others wait for it.
+    with _build_lock:
+        if _tombstone is not None:
+            return _tombstone
+        return refresh_tombstone()
+
+
+class TombstoneIndex:
+    """
+    The sidebar's lookups over one tombstone, built in a single pass so that picking an organization or a
+    property is a dictionary lookup instead of a boolean mask over the whole frame.
+      parents                  organizations, sorted (the 'Select Organization' list)
+      properties(parent)       property names of an organization, in the order the sidebar has always shown them
+      property(parent, name)   {'_id_child', 'sensor_ids', 'sensor_names'} of a property
+      sensor_name(sensor_id)   display name of a sensor
+    """
+
+    def __init__(self, df):
+        self.source = df
+        properties = {}
+        self._properties = {}
+        self._sensor_names = {}
+        for parent, name, location_id, sensor_ids, sensor_names in zip(
+                df['name_parent'], df['name_child'], df['_id_child'], df['sensor_ids'], df['sensor_names']):
+            sensor_ids = list(sensor_ids) if isinstance(sensor_ids, (list, tuple)) else []
+            sensor_names = list(sensor_names) if isinstance(sensor_names, (list, tuple)) else []
+            properties.setdefault(parent, {}).setdefault(name, None)
+            # First row wins, like .iloc[0] on a name filter
+            self._properties.setdefault((parent, name), {
+                '_id_child': location_id, 'sensor_ids': sensor_ids, 'sensor_names': sensor_names})
+            for sensor_id, sensor_name in zip(sensor_ids, sensor_names):
+                self._sensor_names.setdefault(sensor_id, sensor_name)
+        self.parents = sorted(list(properties)[::-1])
+        self._by_parent = {parent: list(names)[::-1] for parent, names in properties.items()}
+
+    def properties(self, parent):
+        return self._by_parent.get(parent, [])
+
+    def property(self, parent, name):
+        return self._properties.get((parent, name), {'_id_child': None, 'sensor_ids': [], 'sensor_names': []})
+
+    def sensor_name(self, sensor_id, default=None):
+        return self._sensor_names.get(sensor_id, default)
+
+    def sensor_names(self, sensor_ids):
+        """{sensor_id: name} for the given ids, e.g. to label a table."""
+        return {sensor_id: self._sensor_names.get(sensor_id, sensor_id) for sensor_id in sensor_ids}
+
+
+def get_tombstone_index():
+    """TombstoneIndex of the current tombstone, rebuilt only when a new snapshot has been swapped in."""
+    global _index
+    df = get_tombstone()
+    with _lock:
+        if _index is None or _index.source is not df:
+            _index = TombstoneIndex(df)
+        return _index
@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
+from datetime import datetime, timedelta
+import numpy as np
+import requests
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from Alertlab_api import alertlab_api, timeseries_store
+from Alertlab_api.mock_server import MockAlertLabs, start_mock_server, MOCK_TOKEN
+from Alertlab_api.rate_limiter import RequestScheduler, set_scheduler
+from Alertlab_api.data_budget import DataBudgetLedger, set_ledger
+from Alertlab_api.query_planner import QueryPlan
+from Client_data_processing import client_data_processing, rolling_kpis, fleet_kpis
+from Client_data_processing.aggregation import aggregate
+
+#########################################################################################################################
+# BENCHMARKS
+# Runs the data paths behind the dashboard against the local mock AlertLabs server and reports latency
+# percentiles, AlertLabs requests / bytes per run and peak Python memory (tracemalloc, measured in a separate
+# run so it does not slow down the timed ones):
+#   python benchmarks/run.py
+#   python benchmarks/run.py --latency 0.25 --properties 50 --sensors-per-property 4 --json benchmarks/results/base.json
+#   python benchmarks/run.py --fixtures benchmarks/fixtures     (replay recorded locations / sensors, see mock_server.record_fixtures)
+# "cold" cases start every run from an empty timeseries store and empty caches, "warm" cases reuse them.
+# The mock runs in its own process so generating responses does not compete with the measured code for the GIL.
+
+PERCENTILES = (50, 90, 99)
+
+
+def _serve_mock(mock_kwargs, queue):
+    server, base_url = start_mock_server(MockAlertLabs(**mock_kwargs))
+    queue.put(base_url)
+    threading.Event().wait()
+
+
+class MockProcess:
+    """The mock AlertLabs server in a child process; stats() reads its request counters over HTTP."""
+
+    def __init__(self, **mock_kwargs):
+        queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_serve_mock, args=(mock_kwargs, queue), daemon=True)
+        self.process.start()
+        self.base_url = queue.get(timeout=60)
+
+    def stats(self):
+        return requests.get(f"{self.base_url}/_mock/stats", timeout=10).json()
+
+    def close(self):
+        self.process.terminate()
+        self.process.join(timeout=10)
+
+
+class Workspace:
+    """Points the store, KPI state and budget ledger at a scratch directory that can be wiped between runs."""
+
+    def __init__(self):
+        self.root = tempfile.mkdtemp(prefix="alertlabs-bench-")
+
+    def reset(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root)
+        timeseries_store.STORE_DIR = os.path.join(self.root, "store")
+        rolling_kpis.KPI_STATE_DIR = os.path.join(self.root, "kpi_state")
+        rolling_kpis._states.clear()
+        # Benchmarks measure speed, not the monthly device budget
+        set_ledger(DataBudgetLedger(path=os.path.join(self.root, "budget.json"), budget_bytes=1 << 50))
+        client_data_processing._metadata_table = None
+        fleet_kpis._cache["table"] = None
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+##### Cases
+
+def trailing_window(days):
+    end = datetime.now()
+    return int(time.mktime((end - timedelta(days=days)).timetuple())), int(time.mktime(end.timetuple()))
+
+
+def query_path(tombstone, rate="h"):
+    """
+    What one dashboard Query for the first property does (see the `if submitted` block of dashboard.py):
+    property metadata, the chart and heatmap windows through one QueryPlan, the rolling KPIs and the summed frames.
+    """
+    row = tombstone.iloc[0]
+    sensors = list(row['sensor_ids'])
+    client_data_processing.get_property_metadata(row['_id_child'])
+    start, end = trailing_window(7)
+    plan = QueryPlan(token=MOCK_TOKEN)
+    plan.add("chart", sensors, start, end, rate=rate, series="W")
+    plan.add("heatmap", sensors, start - 7 * 86400, end - 7 * 86400, rate="h", series="W")
+    plan.execute()
+    rolling_kpis.get_rolling_kpis(sensors, token=MOCK_TOKEN)
+    aggregate(plan.get("chart"), how="sum")
+    aggregate(plan.get("heatmap"), how="sum", rate="h")
+
+
+def build_cases(tombstone, sensors):
+    first = list(tombstone.iloc[0]['sensor_ids'])
+    week = trailing_window(7)
+    month = trailing_window(30)
+    quarter = trailing_window(90)
+    cases = [
+        ("populate_client_data", False, lambda i: client_data_processing.populate_client_data()),
+        ("get_list_timeseries 7d hourly, 1 property", True,
+         lambda i: alertlab_api.get_list_timeseries(first, *week, rate="h", series="W", token=MOCK_TOKEN)),
+        ("get_list_timeseries 7d hourly, 1 property", False,
+         lambda i: alertlab_api.get_list_timeseries(first, *week, rate="h", series="W", token=MOCK_TOKEN)),
+        ("get_list_timeseries 30d minute, 1 sensor", True,
+         lambda i: alertlab_api.get_list_timeseries(first[:1], *month, rate="m", series="W", token=MOCK_TOKEN)),
+        ("get_list_timeseries 90d minute, 1 sensor (chunked)", True,
+         lambda i: alertlab_api.get_list_timeseries(first[:1], *quarter, rate="m", series="W", token=MOCK_TOKEN)),
+        ("rolling KPIs, 1 property", True, lambda i: rolling_kpis.get_rolling_kpis(first, token=MOCK_TOKEN)),
+        ("rolling KPIs, 1 property", False, lambda i: rolling_kpis.get_rolling_kpis(first, token=MOCK_TOKEN)),
+        (f"fleet KPIs, {len(tombstone)} properties / {len(sensors)} sensors", True,
+         lambda i: fleet_kpis.compute_fleet_kpis(tombstone, token=MOCK_TOKEN)),
+        ("dashboard Query, hourly", True, lambda i: query_path(tombstone, "h")),
+        ("dashboard Query, hourly", False, lambda i: query_path(tombstone, "h")),
+        ("dashboard Query, minute", True, lambda i: query_path(tombstone, "m")),
+    ]
+    return cases
+
+
+##### Harness
+
+def run_case(name, cold, fn, mock, workspace, iterations):
+    latencies, counts, sent = [], [], []
+    workspace.reset()
+    if not cold:
+        fn(0)  # warm up the store and caches once, not timed
+    for i in range(iterations):
+        if cold:
+            workspace.reset()
+        before = mock.stats()
+        started = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - started)
+        after = mock.stats()
+        counts.append(sum(after["requests"].values()) - sum(before["requests"].values()))
+        sent.append(after["bytes_sent"] - before["bytes_sent"])
+
+    if cold:
+        workspace.reset()
+    tracemalloc.start()
+    fn(iterations)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {"case": name, "store": "cold" if cold else "warm", "runs": iterations}
+    for p in PERCENTILES:
+        result[f"p{p}_ms"] = round(float(np.percentile(latencies, p)) * 1000, 1)
+    result["max_ms"] = round(max(latencies) * 1000, 1)
+    result["requests"] = round(float(np.mean(counts)), 1)
+    result["response_kb"] = round(float(np.mean(sent)) / 1024, 1)
+    result["peak_mem_mb"] = round(peak / 1024 / 1024, 2)
+    return result
+
+
+def print_table(results):
+    columns = ["case", "store", "runs"] + [f"p{p}_ms" for p in PERCENTILES] + ["max_ms", "requests", "response_kb", "peak_mem_mb"]
+    widths = {c: max(len(c), *(len(str(r[c])) for r in results)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for r in results:
+        print("  ".join(str(r[c]).ljust(widths[c]) for c in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard data paths against the mock AlertLabs server.")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--properties", type=int, default=20)
+    parser.add_argument("--sensors-per-property", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the mock adds to every response")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--mock-requests-per-hour", type=int, default=None, help="make the mock answer 429 beyond this rate")
+    parser.add_argument("--requests-per-hour", type=int, default=3600 * 1000,
+                        help="client side request budget (the real account has 3600)")
+    parser.add_argument("--fixtures", help="directory with recorded locations / sensors / property details")
+    parser.add_argument("--only", help="run only cases whose name contains this text")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    mock = MockProcess(n_sensors=args.properties * args.sensors_per_property, n_locations=args.properties, latency=args.latency,
+                       jitter=args.jitter, requests_per_hour=args.mock_requests_per_hour, fixtures_dir=args.fixtures)
+    base_url = mock.base_url
+    alertlab_api.set_base_url(base_url)
+    alertlab_api.set_token(MOCK_TOKEN)
+    set_scheduler(RequestScheduler(requests_per_hour=args.requests_per_hour, burst=max(5, args.requests_per_hour // 3600)))
+    workspace = Workspace()
+    try:
+        workspace.reset()
+        tombstone = client_data_processing.populate_client_data()
+        tombstone = tombstone[tombstone['sensor_ids'].map(lambda s: isinstance(s, list) and len(s) > 0)].reset_index(drop=True)
+        sensors = sorted({s for ids in tombstone['sensor_ids'] for s in ids})
+        print(f"Mock AlertLabs on {base_url}: {len(tombstone)} properties with sensors, {len(sensors)} sensors, "
+              f"latency {args.latency * 1000:.0f}+{args.jitter * 1000:.0f} ms")
+        results = []
+        for name, cold, fn in build_cases(tombstone, sensors):
+            if args.only and args.only not in name:
+                continue
+            results.append(run_case(name, cold, fn, mock, workspace, args.iterations))
+            print(f"  {name} ({'cold' if cold else 'warm'}): p50 {results[-1]['p50_ms']} ms", flush=True)
+        print()
+        print_table(results)
+        throttled = mock.stats()["throttled"]
+        if throttled:
+            print(f"\nThe mock answered {throttled} request(s) with 429.")
+        if args.json:
+            os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+            with open(args.json, "w") as f:
+                json.dump({"args": vars(args), "results": results}, f, indent=1)
+    finally:
+        workspace.close()
+        mock.close()
+
+
+if __name__ == "__main__":
+    main()
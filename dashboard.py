@@ -1,6 +1,18 @@
-from Client_data_processing.client_data_processing import populate_client_data, get_property_metadata
-from Alertlab_api.alertlab_api import get_token, get_list_timeseries
+from Client_data_processing.client_data_processing import get_property_metadata
+from Client_data_processing.tombstone_cache import get_tombstone, get_tombstone_index
+from Alertlab_api.alertlab_api import get_token, get_list_timeseries, iter_list_timeseries
+from Alertlab_api.range_chunking import split_range, stitch
+from Alertlab_api.rate_limiter import get_scheduler
+from Alertlab_api.data_budget import get_ledger
+from Alertlab_api.query_planner import QueryPlan
+from Alertlab_api.leak_detector import read_events
 from Alertlab_api.aws_utils import upload_log_to_s3, get_logger_and_log_stream
+from Alertlab_api.instrumentation import span, timed, begin_trace, export_json, export_prometheus
+from Client_data_processing.aggregation import aggregate, bucket_how_for
+from Client_data_processing.analytics import analyze_series
+from Client_data_processing.chart_data import bar_chart_frame, downsample_frame, table_frame, selection_window, drill_down_rate
+from Client_data_processing.fleet_kpis import get_fleet_kpis
+from Client_data_processing.rolling_kpis import get_rolling_kpis, kpi_ratio
 import ast
 import time
 import pytz
@@ -8,85 +20,95 @@ import pandas as pd
 from datetime import datetime, timedelta
 import streamlit as st
 import altair as alt
+import numpy as np
 import plotly.express as px
+import plotly.graph_objects as go
 import streamlit_toggle as tog
 
 logger, log_stream = get_logger_and_log_stream()
 LOG_KEY = f"logs/{datetime.now().strftime('%Y-%m-%d')}/dashboard_log.txt"
 
-def sum_columns(dataframes, column_names):
-    if len(dataframes) > 1:
-        # Initialize a dataframe with the structure of the first dataframe in the list
-        summed_df = dataframes[0].copy()
-        # Iterate through the list of dataframes, starting from the second dataframe
-        for df in dataframes[1:]:
-            for col in column_names:
-                # Sum the specified columns
-                summed_df[col] += df[col]
-        return summed_df
-    elif len(dataframes) == 1:
-        return dataframes[0]
+def last_week_window():
+    # Unix timestamps for the start of last week (Monday) to the end of Sunday
+    today = datetime.now()
+    last_sunday = today - timedelta(days=today.weekday() + 1)
+    start_of_last_week = last_sunday - timedelta(days=6)
+    start_of_last_week_unix = int(time.mktime(start_of_last_week.replace(hour=0, minute=0, second=0, microsecond=0).timetuple()))
+    end_of_last_week_unix = int(time.mktime(last_sunday.replace(hour=23, minute=59, second=59, microsecond=0).timetuple()))
+    return start_of_last_week_unix, end_of_last_week_unix
 
+def chart_window(start_date, end_date, rate, submitted, selection):
+    """
+    Window and rate of the chart: the sidebar's, or the range last box-selected on the bar chart (drill-down),
+    plus whether this rerun should query (Query pressed, a new box selected or Reset zoom pressed).
+    A new Query, the Reset zoom button or a different selection (property, sensors, dates, ...) goes back
+    to the sidebar's window.
+    """
+    box = selection_window(st.session_state.get("bar_chart"))
+    requested = bool(submitted or st.session_state.get("reset_zoom"))
+    if requested or selection != st.session_state.get("chart_selection"):
+        st.session_state.chart_zoom = None
+        # The selection made on the previous chart stays in its widget state, it must not zoom the new one
+        st.session_state.applied_box = box
+        st.session_state.chart_selection = selection
+    elif box is not None and box != st.session_state.get("applied_box"):
+        st.session_state.chart_zoom = box
+        st.session_state.applied_box = box
+        requested = True
+    zoom = st.session_state.get("chart_zoom")
+    if zoom is None:
+        return start_date, end_date, rate, requested
+    return zoom[0], zoom[1], drill_down_rate(rate, *zoom), requested
+
+def plan_query(queried_sensors, start_date, end_date, rate, series):
+    """Collect every window a Query needs so overlapping fetches are made only once."""
+    plan = QueryPlan(token=st.session_state.token)
+    if len(queried_sensors) != 0:
+        # Windows longer than one chunk are streamed into the chart instead (see stream_chart_data)
+        if len(split_range(start_date, end_date, rate)) == 1:
+            plan.add("chart", queried_sensors, start_date, end_date, rate=rate, series=series)
+        plan.add("heatmap", queried_sensors, *last_week_window(), rate="h", series="W")
+    return plan.execute()
+
+def kpi_value(value, digits=None):
+    """Rounded KPI, or 'N/A' when there was nothing to average or divide by."""
+    return "N/A" if value is None or np.isnan(value) else round(value, digits)
+
+@timed()
 def get_7_day_night_average(sensor_list):
     if len(sensor_list) > 0:
-        # Get today's date and convert to unix time
-        today = datetime.now()
-        today_unix = int(time.mktime(today.timetuple()))
-        # Get 7 days ago date and convert to unix time
-        seven_days_ago = today - timedelta(days=7)
-        seven_days_ago_unix = int(time.mktime(seven_days_ago.timetuple()))
-        # Query for all the sensors at the location
-        seven_days_dataframes = get_list_timeseries(sensor_list, start_date=seven_days_ago_unix, end_date=today_unix, rate="h", series="W", token = st.session_state.token)
-        # Sum the dataframes
-        cumulative_seven_day_consumption = sum_columns(seven_days_dataframes, ['series'])
-        # Convert the datetime strings into Datetime objects and adjust for UTC to EDT
-        cumulative_seven_day_consumption['Datetime'] = pd.to_datetime(cumulative_seven_day_consumption['Datetime'])
-        # Filter the data for Datetime values that are Mondays between 1AM and 5AM EDT
-        filtered_data = cumulative_seven_day_consumption[(cumulative_seven_day_consumption['Datetime'].dt.hour >= 1) &
-                                                         (cumulative_seven_day_consumption['Datetime'].dt.hour <= 5)]
-        # Calculate the mean and median of the series column for the filtered data
-        mean_series = filtered_data['series'].mean()
-        median_series = filtered_data['series'].median()
-        return mean_series, median_series, cumulative_seven_day_consumption
+        # Rolling 1-5 AM state over the trailing 7 days; only the hours that settled since the last Query are fetched
+        kpis = get_rolling_kpis(sensor_list, token = st.session_state.token)
+        st.session_state.kpi_missing_sensors = kpis["missing_sensors"]
+        return kpis["night_mean"], kpis["night_median"]
     
-#Redundancy in first two functions. Have to combine later. 
+@timed()
 def get_7_day_average(sensor_list):
     if len(sensor_list) > 0:
-        # Get today's date and convert to unix time
-        today = datetime.now()
-        today_unix = int(time.mktime(today.timetuple()))
-        # Get 7 days ago date and convert to unix time
-        seven_days_ago = today - timedelta(days=7)
-        seven_days_ago_unix = int(time.mktime(seven_days_ago.timetuple()))
-        # Query for all the sensors at the location
-        seven_day_dataframes = get_list_timeseries(sensor_list, start_date=seven_days_ago_unix, end_date=today_unix, rate="h", series="W", token = st.session_state.token)
-        # Sum the dataframes
-        cumulative_seven_day_consumption = sum_columns(seven_day_dataframes, ['series'])
-        # Convert the datetime strings into Datetime objects and adjust for UTC to EDT
-        cumulative_seven_day_consumption['Datetime'] = pd.to_datetime(cumulative_seven_day_consumption['Datetime'])
-        # Calculate the mean of the series column for the past week
-        mean_series = cumulative_seven_day_consumption['series'].mean()
-        return mean_series, cumulative_seven_day_consumption
+        # Same rolling state as the night average, so this is a lookup after the first call
+        kpis = get_rolling_kpis(sensor_list, token = st.session_state.token)
+        return kpis["seven_day_mean"]
     
-def generate_heatmap(sensor_list):
+@timed()
+def generate_heatmap(sensor_list, seven_day_dataframes=None):
     if len(sensor_list) > 0:
         # Calculate the Unix timestamps for the start of last week (Monday) to the end of Sunday
         today = datetime.now()
         last_sunday = today - timedelta(days=today.weekday() + 1)
         start_of_last_week = last_sunday - timedelta(days=6)
-        start_of_last_week_unix = int(time.mktime(start_of_last_week.replace(hour=0, minute=0, second=0, microsecond=0).timetuple()))
-        end_of_last_week_unix = int(time.mktime(last_sunday.replace(hour=23, minute=59, second=59, microsecond=0).timetuple()))
+        start_of_last_week_unix, end_of_last_week_unix = last_week_window()
 
-        # Fetch the data for the entire last week
-        seven_day_dataframes = get_list_timeseries(
-            sensor_list, 
-            start_date=start_of_last_week_unix, 
-            end_date=end_of_last_week_unix, 
-            rate="h", 
-            series="W",
-            token = st.session_state.token
-        )
-        cumulative_seven_day_consumption = sum_columns(seven_day_dataframes, ['series'])
+        # Fetch the data for the entire last week unless the query plan already did
+        if seven_day_dataframes is None:
+            seven_day_dataframes = get_list_timeseries(
+                sensor_list, 
+                start_date=start_of_last_week_unix, 
+                end_date=end_of_last_week_unix, 
+                rate="h", 
+                series="W",
+                token = st.session_state.token
+            )
+        cumulative_seven_day_consumption = aggregate(seven_day_dataframes, how="sum", rate="h")
         cumulative_seven_day_consumption['Datetime'] = pd.to_datetime(cumulative_seven_day_consumption['Datetime'], unit='ms')
         cumulative_seven_day_consumption['Day'] = cumulative_seven_day_consumption['Datetime'].dt.day_name()
         cumulative_seven_day_consumption['Hour'] = cumulative_seven_day_consumption['Datetime'].dt.hour
@@ -121,63 +143,93 @@ def generate_heatmap(sensor_list):
         )
         return fig
     
+@timed()
 def timeseries_bar_graph(dataframes):
-    # Prepare an empty DataFrame to concatenate all data
-    combined_df = pd.DataFrame()
-    # Loop over each DataFrame and map the correct sensor names
-    for idx, df in enumerate(dataframes):
-        df['Source'] = f"{sensor_names[idx]}"  # Fallback if sensor names are missing
-        combined_df = pd.concat([combined_df, df], ignore_index=True)
+    # One pass over the aligned sensors, downsampled to the chart width (see chart_data.py)
+    sources = [tombstone_index.sensor_name(df.sensor_id, df.sensor_id) for df in dataframes]
+    combined_df, instants = bar_chart_frame(dataframes, sources, bucket_how=bucket_how_for(series))
+    title = "Total Litres Over Time"
+    if instants > combined_df['Datetime'].nunique():
+        title += f" (min/max of {instants} readings, select a range to zoom in)"
 
     # Create a bar plot with different colors for each source file
-    fig = px.bar(combined_df, x='Datetime', y='series', color='Source', title="Total Litres Over Time", height=600)
+    fig = px.bar(combined_df, x='Datetime', y='series', color='Source', title=title, height=600, custom_data=['Source', 'Total'])
 
     # Customize hover template to include the total value for each datetime
     fig.update_traces(hovertemplate='<b>Date:</b> %{x}<br>' +
                                     '<b>Source:</b> %{customdata[0]}<br>' +
                                     '<b>Value:</b> %{y}<br>' +
                                     '<b>Total:</b> %{customdata[1]}<extra></extra>')
-
-    # Add custom data for hover: Source and Total
-    totals_df = combined_df.groupby('Datetime')['series'].sum().round(3).reset_index()
-    combined_df = combined_df.merge(totals_df, on='Datetime', suffixes=('', '_Total'))
-    fig.update_traces(customdata=combined_df[['Source', 'series_Total']].values)
+    fig.update_layout(dragmode="select")
 
     return fig
 
-def make_timeseries_chart(queried_sensors, start_date, end_date, rate, series):
+@timed()
+def stream_chart_data(queried_sensors, start_date, end_date, rate, series, placeholder):
+    """Fetch a long chart window chunk by chunk, redrawing the bar chart in placeholder as each chunk arrives."""
+    chunks = {}
+    time_series_data = []
+    for _, chunk_end, batches in iter_list_timeseries(queried_sensors, start_date, end_date, rate=rate, series=series, token = st.session_state.token):
+        for batch in batches:
+            chunks.setdefault(batch.sensor_id, []).append(batch)
+        time_series_data = [stitch(chunks[sensor]) for sensor in queried_sensors if sensor in chunks]
+        if time_series_data and chunk_end < int(float(end_date)):
+            with span("chart_render", chart="bar_progress"):
+                placeholder.plotly_chart(timeseries_bar_graph(time_series_data), theme="streamlit")
+    return time_series_data
+
+@timed()
+def make_timeseries_chart(queried_sensors, start_date, end_date, rate, series, plan=None):
     if len(queried_sensors) != 0:
-        time_series_data = get_list_timeseries(queried_sensors, start_date=start_date_unix, end_date=end_date_unix, rate=rate, series=series, token = st.session_state.token)
+        bar_chart = st.empty()
+        if plan is not None and plan.has("chart"):
+            time_series_data = plan.get("chart")
+        elif len(split_range(start_date, end_date, rate)) > 1:
+            time_series_data = stream_chart_data(queried_sensors, start_date, end_date, rate, series, bar_chart)
+        else:
+            time_series_data = get_list_timeseries(queried_sensors, start_date=start_date, end_date=end_date, rate=rate, series=series, token = st.session_state.token)
         #timeseries_bar_graph(time_series_data)
         # Sum the displayed dataframes
-        cumulative_timeseries_data = sum_columns(time_series_data, ['series'])
+        # Grid inferred from the data: if the data budget served any sensor hourly, everything is summed up to hours
+        cumulative_timeseries_data = aggregate(time_series_data, how="sum", bucket_how=bucket_how_for(series))
         # Casting data type for time as string
         #cumulative_timeseries_data["series"] = cumulative_timeseries_data["Datetime"].astype(str)
-        cumulative_timeseries_data['series'] = cumulative_timeseries_data['series'].fillna(0).astype(float)
-        cumulative_timeseries_data['series'] = cumulative_timeseries_data['series'].apply(lambda x: round(x))
+        cumulative_timeseries_data['series'] = np.round(cumulative_timeseries_data['series'].fillna(0).to_numpy(dtype='float64'))
         cumulative_timeseries_data['change'] = cumulative_timeseries_data['series'].pct_change().mul(100).round(2)
-        # Create an outier free column
-        cumulative_timeseries_data['normalized'] = cumulative_timeseries_data['series']
-        Q1 = cumulative_timeseries_data['normalized'].quantile(0.25)
-        Q3 = cumulative_timeseries_data['normalized'].quantile(0.75)
-        IQR = Q3 - Q1
-        # Define the bounds for outliers
-        lower_bound = Q1 - 1.5 * IQR
-        upper_bound = Q3 + 1.5 * IQR
-        median_value = cumulative_timeseries_data['normalized'].median()
-        # Replace outliers with the median
-        cumulative_timeseries_data['normalized'] = cumulative_timeseries_data['normalized'].apply(
-            lambda x: median_value if x < lower_bound or x > upper_bound else x
-        )
+        # Outlier-free column (IQR outliers replaced with the median), baseline and trend, cached per sensor set and window
+        analysis = analyze_series((tuple(sorted(queried_sensors)), start_date, end_date, rate, series),
+                                  cumulative_timeseries_data['time'].to_numpy(), cumulative_timeseries_data['series'].to_numpy())
+        cumulative_timeseries_data['normalized'] = analysis["normalized"]
+        cumulative_timeseries_data['baseline'] = analysis["baseline"]
         # Generate the chart
         fig = timeseries_bar_graph(time_series_data)
-        fig2 = px.scatter(cumulative_timeseries_data, x="Datetime", y="normalized", height=700, trendline="ols", trendline_scope="overall", trendline_color_override="#d52b1e")
-        fig2.update_layout(showlegend=False)   
-        fig3 = generate_heatmap(queried_sensors)     
-        st.plotly_chart(fig, theme="streamlit")
-        st.plotly_chart(fig2, theme="streamlit")
-        st.altair_chart(fig3, theme="streamlit", use_container_width=True)
-        st.write(cumulative_timeseries_data)
+        with span("chart_build", chart="trend_scatter"):
+            # Points are downsampled to the chart width, the trend line is fitted on every reading
+            scatter_points = downsample_frame(cumulative_timeseries_data, x="Datetime", y="normalized")
+            fig2 = px.scatter(scatter_points, x="Datetime", y="normalized", height=700)
+            baseline_points = downsample_frame(cumulative_timeseries_data, x="Datetime", y="baseline")
+            fig2.add_trace(go.Scatter(x=baseline_points['Datetime'], y=baseline_points['baseline'], mode="lines",
+                                      line=dict(color="#8c8c8c", width=1), name="Rolling median"))
+            trend = analysis["trend"]
+            if trend["n"] > 1:
+                ends = cumulative_timeseries_data['time'].iloc[[0, -1]].to_numpy(dtype='float64')
+                fig2.add_trace(go.Scatter(x=cumulative_timeseries_data['Datetime'].iloc[[0, -1]], y=trend["slope"] * ends + trend["intercept"],
+                                          mode="lines", line=dict(color="#d52b1e"), name=f"OLS trend (R² {trend['r2']:.2f})"))
+            fig2.update_layout(showlegend=False)   
+        fig3 = generate_heatmap(queried_sensors, plan.get("heatmap") if plan is not None else None)
+        # Rendering serializes the figures for the browser, which is its own cost
+        with span("chart_render", chart="bar"):
+            # Box-selecting a range reruns the script with that window (see chart_window)
+            bar_chart.plotly_chart(fig, theme="streamlit", on_select="rerun", selection_mode="box", key="bar_chart")
+        with span("chart_render", chart="trend_scatter"):
+            st.plotly_chart(fig2, theme="streamlit")
+        with span("chart_render", chart="heatmap"):
+            st.altair_chart(fig3, theme="streamlit", use_container_width=True)
+        with span("chart_render", chart="table"):
+            table = table_frame(cumulative_timeseries_data)
+            if len(table) < len(cumulative_timeseries_data):
+                st.caption(f"Latest {len(table)} of {len(cumulative_timeseries_data)} rows")
+            st.write(table)
         
 # Settings
 st.set_page_config(
@@ -187,14 +239,16 @@ st.set_page_config(
     initial_sidebar_state="expanded")
 alt.themes.enable("dark")
 
-if 'token' not in st.session_state:
-    token = get_token()
-    st.session_state.token = token
+# Timing spans of this run, shown in the hidden panel at the bottom (open the app with ?debug=1)
+run_trace = begin_trace()
+run_started = time.perf_counter()
 
-if 'df' not in st.session_state:
-    st.session_state.df = populate_client_data()
-    logger.info("Dataframe populated successfully")
-df = st.session_state.df
+# Cached in-process by the token manager, so this is cheap on every rerun and never goes stale
+st.session_state.token = get_token()
+
+# Shared, read-only tombstone snapshot (one copy per process, refreshed in the background) and its lookups
+df = get_tombstone()
+tombstone_index = get_tombstone_index()
 
 with st.sidebar:
     # Dashboard title
@@ -211,15 +265,14 @@ with st.sidebar:
     
     st.markdown(f'<p class="big-font">{title}</p>', unsafe_allow_html=True)
     # Parent Organization filter
-    parent_list = sorted(list(df.name_parent.unique())[::-1])
-    selected_address = st.selectbox('Select Organization:', parent_list)
-    logger.info(f"Selected_parent: {selected_address}")
-    df_selected_parent = df[df.name_parent == selected_address]
+    parent_list = tombstone_index.parents
+    selected_parent = st.selectbox('Select Organization:', parent_list)
+    logger.info(f"Selected_parent: {selected_parent}")
     # Address Filter Dropdown
-    address_list = list(df_selected_parent.name_child.unique())[::-1]
+    address_list = tombstone_index.properties(selected_parent)
     selected_address = st.selectbox('Select Property:', address_list)
     logger.info(f"Selected child: {selected_address}")
-    df_selected_address = df[df.name_child == selected_address]
+    selected_property = tombstone_index.property(selected_parent, selected_address)
     # Calendar widget 
     default_date_last_week = datetime.today() - timedelta(days=7)
     start_date = st.date_input("Start Date", default_date_last_week)
@@ -240,10 +293,10 @@ with st.sidebar:
         series="T_0"
     # List of sensors as buttons
     buttons = []
-    sensor_list = df_selected_address["sensor_ids"].iloc[0]
-    sensor_names = df_selected_address["sensor_names"].iloc[0]
-    for i in sensor_list:
-        buttons.append(tog.st_toggle_switch(label=sensor_names[sensor_list.index(i)],
+    sensor_list = selected_property["sensor_ids"]
+    sensor_names = selected_property["sensor_names"]
+    for i, name in zip(sensor_list, sensor_names):
+        buttons.append(tog.st_toggle_switch(label=name,
                                             key=i))
     for button in buttons:
         if button:
@@ -254,26 +307,50 @@ with st.sidebar:
         if button == True:
             queried_sensors.append(sensor_id)        
     # Get the selected suite numbers ##This workflow is switched to decrease boot time
-    #amount_of_suites = df_selected_address["numberSuites"].iloc[0]
+    #amount_of_suites = df[df._id_child == selected_property["_id_child"]]["numberSuites"].iloc[0]
     #if not isinstance(amount_of_suites, (int, float)):
         #amount_of_suites = 1
     # Initiate Query and get list of dataframes from selected sensors
     submitted = st.button("Query")
     logger.info(f"BROWSING: Queried_sensors: {queried_sensors}, rate: {rate}, series: {series}, start_date: {start_date}, end_date: {end_date}")
+    # Shared AlertLabs request queue (3600 requests/hour across all sessions)
+    with st.expander("API request queue"):
+        st.json(get_scheduler().stats())
+    # Monthly AlertLabs data budget (100 MB per device) for this property's sensors
+    with st.expander("Data budget (this month)"):
+        budget = get_ledger().summary(sensor_list)
+        budget["sensor_id"] = budget["sensor_id"].map(tombstone_index.sensor_names(sensor_list)).fillna(budget["sensor_id"])
+        st.dataframe(budget, hide_index=True)
+    # Continuous flow / night flow events from the leak detector (fed by the backfill daemon)
+    with st.expander("Leak alerts"):
+        leak_events = read_events(sensor_list)
+        if leak_events.empty:
+            st.write("No leak events for this property.")
+        else:
+            leak_events["sensor"] = leak_events["sensor_id"].map(tombstone_index.sensor_names(sensor_list)).fillna(leak_events["sensor_id"])
+            st.dataframe(leak_events[["sensor", "kind", "start", "end", "value", "baseline"]], hide_index=True)
+    # Every property ranked by night flow per suite
+    fleet_submitted = st.button("Fleet leaderboard")
     
 
-if submitted == True:
-    logger.info(f"QUERIED: Queried_sensors: {queried_sensors}, rate: {rate}, series: {series}, start_date: {start_date}, end_date: {end_date}")
+# A box selection on the chart (or Reset zoom) reruns the script without the Query button being pressed
+chart_selection = (selected_property["_id_child"], tuple(queried_sensors), start_date_unix, end_date_unix, rate, series)
+chart_start_unix, chart_end_unix, chart_rate, chart_requested = chart_window(start_date_unix, end_date_unix, rate, submitted, chart_selection)
+zoomed = st.session_state.get("chart_zoom") is not None
+if chart_requested:
+    logger.info(f"QUERIED: Queried_sensors: {queried_sensors}, rate: {chart_rate}, series: {series}, start_date: {start_date}, end_date: {end_date}, zoomed: {zoomed}")
 
     # Get the metadata for the selected address
-    amount_of_suites, number_of_floors, CommercialPropertyType, property_age, number_of_users = get_property_metadata(df_selected_address["_id_child"].iloc[0])
+    amount_of_suites, number_of_floors, CommercialPropertyType, property_age, number_of_users = get_property_metadata(selected_property["_id_child"])
     
-    mean, median, cumulative_seven_night_consumption = get_7_day_night_average(sensor_list)
-    seven_day_mean, cumulative_seven_day_consumption  = get_7_day_average(sensor_list)
+    # One plan for every window on the page, so overlapping windows are fetched once
+    plan = plan_query(queried_sensors, chart_start_unix, chart_end_unix, chart_rate, series)
+    mean, median = get_7_day_night_average(sensor_list)
+    seven_day_mean = get_7_day_average(sensor_list)
     st.session_state.mean = mean
     st.session_state.median = median
     st.session_state.seven_day_mean = seven_day_mean
-    st.session_state.suite_mean = (st.session_state.mean/amount_of_suites)
+    st.session_state.suite_mean = kpi_ratio(st.session_state.mean, amount_of_suites)
     st.markdown(
         """
     <style>
@@ -293,27 +370,50 @@ if submitted == True:
     kpi1, kpi2, kpi3, kpi4 = st.columns(4)
     kpi1.metric(
         label="7 Day 12AM-5AM (Avg)",
-        value=round(st.session_state.mean)
+        value=kpi_value(st.session_state.mean)
     )
     kpi2.metric(
         label="Ratio (Metric1, Metric3)",
-        value=round(st.session_state.mean/st.session_state.seven_day_mean, 2)
+        value=kpi_value(kpi_ratio(st.session_state.mean, st.session_state.seven_day_mean), 2)
     )
     kpi3.metric(
         label="Trailing 7 Day Average",
-        value = round(st.session_state.seven_day_mean)
+        value = kpi_value(st.session_state.seven_day_mean)
     )
     kpi4.metric(
         label="Per Suite Average (l/h/u)",
-        value = round(st.session_state.suite_mean)
+        value = kpi_value(st.session_state.suite_mean)
     )
+    # Sensors that could not be fetched are left out of the KPIs until they come back
+    missing = st.session_state.get("kpi_missing_sensors") or []
+    if missing:
+        st.warning(f"KPIs are missing readings from: {', '.join(tombstone_index.sensor_name(s, s) for s in missing)}")
     # Function to make timeseries chart  
-    make_timeseries_chart(queried_sensors, start_date_unix, end_date_unix, rate, series)
+    if zoomed:
+        st.button("Reset zoom", key="reset_zoom")
+    make_timeseries_chart(queried_sensors, chart_start_unix, chart_end_unix, chart_rate, series, plan)
     logger.info("Session ran successfully")
     # Upload logs to S3
     upload_log_to_s3(logger, log_stream)
     
+if fleet_submitted == True:
+    st.subheader("Fleet leaderboard (7 day 1-5 AM average per suite, worst first)")
+    fleet_kpis = get_fleet_kpis(df, token=st.session_state.token)
+    st.dataframe(fleet_kpis.drop(columns=['_id_child']), hide_index=True, use_container_width=True)
+    logger.info(f"FLEET: leaderboard shown for {len(fleet_kpis)} properties")
+
 st.write("How KPI 1 is calculated: This is the 1-5 AM (inclusive) average for the past 7 days")
 st.write("How KPI 2 is calculated: This is the KPI1 divided by KPI3 and rounded to 2 decimals")
 st.write("How KPI 3 is calculated: This is the mean of the water measures (7 days * 24 hours)")
-st.write("How KPI 4 is calculated: This is KPI 1 divided by the number of suites")
\ No newline at end of file
+st.write("How KPI 4 is calculated: This is KPI 1 divided by the number of suites")
+
+# Hidden timing panel for this run and the process-wide histograms
+if "debug" in st.query_params:
+    with st.expander("Timings (this run)", expanded=True):
+        st.write(f"Script run: {(time.perf_counter() - run_started) * 1000:.0f} ms, {len(run_trace)} spans")
+        if run_trace:
+            trace_df = pd.DataFrame(run_trace)
+            st.dataframe(trace_df.groupby("span")["ms"].agg(["count", "sum", "max"]).sort_values("sum", ascending=False))
+            st.dataframe(trace_df.drop(columns=["at"]), hide_index=True, use_container_width=True)
+        st.download_button("Histograms (JSON)", export_json(), file_name="timings.json", mime="application/json")
+        st.download_button("Histograms (Prometheus)", export_prometheus(), file_name="timings.prom", mime="text/plain")
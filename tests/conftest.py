@@ -0,0 +1,32 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The store, ledger and KPI state paths are read from the environment at import time, so point them at a
+# scratch directory before any test imports the modules. The shared S3 tier stays off unless a test swaps
+# in a cache on mock_server.MockS3.
+os.environ.setdefault("TIMESERIES_STORE_DIR", tempfile.mkdtemp(prefix="alertlabs-tests-"))
+os.environ.setdefault("TIMESERIES_SHARED_CACHE_DISABLED", "1")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+@pytest.fixture
+def mock_api():
+    """A mock AlertLabs server that alertlab_api talks to, with a scheduler that does not pace the test."""
+    from Alertlab_api import alertlab_api
+    from Alertlab_api.mock_server import MockAlertLabs, start_mock_server, MOCK_TOKEN
+    from Alertlab_api.rate_limiter import RequestScheduler, get_scheduler, set_scheduler
+
+    base_url, api_url, scheduler = alertlab_api.ALERTAQ_URL, alertlab_api.ALERTAQ_API_URL, get_scheduler()
+    mock = MockAlertLabs(n_sensors=3, n_locations=2)
+    server, url = start_mock_server(mock)
+    alertlab_api.set_base_url(url)
+    alertlab_api.set_token(MOCK_TOKEN)
+    set_scheduler(RequestScheduler(requests_per_hour=3600 * 1000, burst=100))
+    yield mock
+    server.shutdown()
+    alertlab_api.set_base_url(base_url, api_url)
+    alertlab_api.invalidate_token()
+    set_scheduler(scheduler)
@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+from Alertlab_api import backfill, timeseries_store
+from Alertlab_api.mock_server import MOCK_TOKEN
+
+SENSORS = ["sensor-0", "sensor-1", "sensor-2"]
+
+
+def _daemon(tmp_path, **kwargs):
+    now = (int(time.time()) // 86400) * 86400
+    options = dict(rate="m", history_days=15, requests_per_hour=3600 * 1000, token=MOCK_TOKEN,
+                   checkpoint_path=str(tmp_path / "checkpoint.json"), store_root=str(tmp_path / "store"),
+                   clock=lambda: now, sleep=lambda seconds: None)
+    options.update(kwargs)
+    daemon = backfill.BackfillDaemon(**options)
+    written = []
+    daemon.listeners.append(lambda sensor_id, rows, rate, series: written.append(sensor_id))
+    return daemon, written, now
+
+
+def test_round_robin_over_sensors(mock_api, tmp_path):
+    daemon, written, _ = _daemon(tmp_path)
+    daemon.run_once()
+    # 15 days in 7 day chunks is three requests per sensor, one sensor after the other
+    assert written == SENSORS * 3
+    assert mock_api.requests["timeseries"] == 9
+
+
+def test_checkpoint_resumes_where_it_stopped(mock_api, tmp_path):
+    daemon, written, now = _daemon(tmp_path, sensors=SENSORS)
+    for sensor_id in SENSORS:
+        daemon.step(sensor_id)
+    cursors = {key: state["cursor"] for key, state in backfill.load_checkpoint(daemon.checkpoint_path).items()}
+    assert cursors == {f"{s}|W|m": now - 15 * 86400 + backfill.CHUNK_SECONDS["m"] for s in SENSORS}
+
+    # A new daemon on the same checkpoint only fetches what is left
+    restarted, written_after, _ = _daemon(tmp_path, sensors=SENSORS)
+    restarted.run_once()
+    assert written_after == SENSORS * 2
+    assert mock_api.requests["timeseries"] == 9
+    settled = now - timeseries_store.SETTLE_SECONDS
+    assert all(state["cursor"] == settled for state in restarted.checkpoint.values())
+
+    # Caught up: nothing is requested again
+    again, written_again, _ = _daemon(tmp_path, sensors=SENSORS)
+    again.run_once()
+    assert written_again == []
+    assert mock_api.requests["timeseries"] == 9
+
+
+def test_failing_sensor_backs_off_and_is_parked(mock_api, tmp_path):
+    clock = {"now": (int(time.time()) // 86400) * 86400}
+    daemon, written, _ = _daemon(tmp_path, sensors=["no-such-sensor", "sensor-0"], history_days=2,
+                                 clock=lambda: clock["now"], max_failures=3, retry_seconds=60)
+    daemon.run_once()
+    assert daemon.checkpoint["no-such-sensor|W|m"]["failures"] == 1
+    assert written == ["sensor-0"]
+
+    # Within the backoff the sensor is not asked for again
+    daemon.run_once()
+    assert mock_api.requests["timeseries"] == 2
+
+    for delay in (60, 120):
+        clock["now"] += delay
+        daemon.run_once()
+    assert daemon.is_parked("no-such-sensor")
+    requests = mock_api.requests["timeseries"]
+    clock["now"] += 600
+    daemon.run_once()
+    assert mock_api.requests["timeseries"] - requests <= 1  # sensor-0 tailing, never the parked sensor
+    assert not daemon.is_parked("sensor-0")
+
+
+@pytest.mark.parametrize("content", ["", "{not json"])
+def test_unreadable_checkpoint_starts_over(tmp_path, content):
+    path = tmp_path / "checkpoint.json"
+    path.write_text(content)
+    assert backfill.load_checkpoint(str(path)) == {}
@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+from Alertlab_api.timeseries_batch import TimeseriesBatch
+from Client_data_processing.chart_data import (minmax_indices, lttb_indices, bar_chart_frame, selection_window, drill_down_rate,
+                                               DRILL_DOWN_MINUTE_SECONDS)
+
+
+def reference_lttb(x, y, n_out):
+    """Textbook LTTB (Steinarsson 2013), one point at a time."""
+    n = len(y)
+    every = (n - 2) / (n_out - 2)
+    selected = [0]
+    a = 0
+    for i in range(n_out - 2):
+        avg_start, avg_end = int(np.floor((i + 1) * every)) + 1, min(int(np.floor((i + 2) * every)) + 1, n)
+        avg_x = sum(x[avg_start:avg_end]) / (avg_end - avg_start)
+        avg_y = sum(y[avg_start:avg_end]) / (avg_end - avg_start)
+        start, end = int(np.floor(i * every)) + 1, int(np.floor((i + 1) * every)) + 1
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((x[a] - avg_x) * (y[j] - y[a]) - (x[a] - x[j]) * (avg_y - y[a])) / 2
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return np.array(selected)
+
+
+@pytest.mark.parametrize("n, n_out", [(1000, 50), (997, 13), (10, 3), (5000, 1600)])
+def test_lttb_matches_the_reference(n, n_out):
+    rng = np.random.default_rng(n)
+    x = np.cumsum(rng.integers(1, 5, n)).astype('float64')
+    y = rng.normal(size=n).cumsum()
+    indices = lttb_indices(x, y, n_out)
+    assert len(indices) == n_out
+    assert np.array_equal(indices, reference_lttb(list(x), list(y), n_out))
+
+
+def test_lttb_keeps_the_ends_and_a_spike():
+    y = np.zeros(10000)
+    y[4321] = 100.0
+    indices = lttb_indices(np.arange(10000), y, 100)
+    assert indices[0] == 0 and indices[-1] == 9999
+    assert 4321 in indices
+    assert (np.diff(indices) > 0).all()
+
+
+def test_lttb_leaves_short_series_alone():
+    assert np.array_equal(lttb_indices(np.arange(5), np.ones(5), 10), np.arange(5))
+    assert np.array_equal(lttb_indices(np.arange(5), np.ones(5), 2), np.arange(5))
+
+
+def test_minmax_keeps_every_bucket_extreme():
+    rng = np.random.default_rng(0)
+    y = rng.normal(size=10007)
+    n_buckets = 100
+    indices = minmax_indices(y, n_buckets)
+    assert (np.diff(indices) > 0).all()
+    assert len(indices) <= 2 * n_buckets
+    size = -(-len(y) // n_buckets)
+    for start in range(0, len(y), size):
+        bucket = y[start:start + size]
+        assert start + int(np.argmin(bucket)) in indices
+        assert start + int(np.argmax(bucket)) in indices
+
+
+def test_minmax_skips_nans_unless_the_bucket_is_empty():
+    y = np.full(100, np.nan)
+    y[10:20] = np.arange(10)
+    indices = minmax_indices(y, 10)
+    assert {10, 19} <= set(indices)
+
+
+def test_minmax_leaves_short_series_alone():
+    assert np.array_equal(minmax_indices(np.arange(8.0), 4), np.arange(8))
+
+
+def _minutes(sensor_id, values, start_ms=1_700_000_000_000 // 60000 * 60000):
+    time_ms = start_ms + np.arange(len(values), dtype='int64') * 60000
+    return TimeseriesBatch(time_ms, values, sensor_id, "m", "W")
+
+
+def test_bar_chart_keeps_a_spike_and_consistent_stacks():
+    a = np.ones(20000)
+    a[12345] = 500.0
+    b = np.full(20000, 2.0)
+    frame, instants = bar_chart_frame([_minutes("a", a), _minutes("b", b)], ["A", "B"], max_points=200)
+    assert instants == 20000
+    assert frame['Datetime'].nunique() <= 200
+    assert frame['Total'].max() == 502.0
+    # Every instant has both sensors' readings, adding up to the total shown
+    per_instant = frame.groupby('Datetime').agg(series=('series', 'sum'), total=('Total', 'first'), sources=('Source', 'count'))
+    assert (per_instant['sources'] == 2).all()
+    assert np.allclose(per_instant['series'], per_instant['total'])
+
+
+def test_bar_chart_of_nothing():
+    frame, instants = bar_chart_frame([], [])
+    assert frame.empty and instants == 0
+
+
+def test_selection_window_and_drill_down():
+    event = {"selection": {"box": [{"x": ["2024-07-02 08:00:00", "2024-07-01 20:00"]}]}}
+    start, end = selection_window(event)
+    assert end - start == 12 * 3600
+    assert drill_down_rate("h", start, end) == "m"
+    assert drill_down_rate("h", 0, DRILL_DOWN_MINUTE_SECONDS + 1) == "h"
+    assert drill_down_rate("d", start, end) == "d"
+    assert selection_window({"selection": {"box": []}}) is None
+    assert selection_window(None) is None
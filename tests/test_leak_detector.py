@@ -0,0 +1,96 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from Alertlab_api import leak_detector, timeseries_store
+from Alertlab_api.leak_detector import LeakDetector, replay, read_events, CONTINUOUS_FLOW_HOURS, NIGHT_WARMUP
+
+MINUTE_MS = 60000
+# A local (UTC-4) midnight
+MIDNIGHT_MS = (1_700_000_000 // 86400 * 86400 + 4 * 3600) * 1000
+
+
+def _minutes(start_ms, n):
+    return start_ms + np.arange(n, dtype='int64') * MINUTE_MS
+
+
+def _quiet_days(n_days, night_flow=0.2):
+    """
+    Minute series of n_days without flow except a night mean of night_flow from 1 to 6 AM local, on every
+    other minute (a toilet cistern, not a continuous leak).
+    """
+    time_ms = _minutes(MIDNIGHT_MS, n_days * 1440)
+    local_hour = (time_ms // 3600000 - 4) % 24
+    values = np.where((local_hour >= 1) & (local_hour <= 5) & (np.arange(len(time_ms)) % 2 == 0), 2 * night_flow, 0.0)
+    return time_ms, values
+
+
+def test_continuous_flow_is_flagged_once_with_the_leak_rate():
+    time_ms = _minutes(MIDNIGHT_MS + 8 * 3600000, 6 * 60)
+    values = np.full(len(time_ms), 3.0)
+    values[int(CONTINUOUS_FLOW_HOURS * 60) - 30:] = 0.7  # the flow drops to the leak rate before the alert
+    events = replay({"s": (time_ms, values)})
+    assert [e["kind"] for e in events] == ["continuous_flow"]
+    event = events[0]
+    assert event["start_ms"] == time_ms[0]
+    assert event["end_ms"] == time_ms[int(CONTINUOUS_FLOW_HOURS * 60) - 1]
+    assert event["value"] == 0.7
+
+
+def test_a_stop_or_a_gap_breaks_the_run():
+    n = int(CONTINUOUS_FLOW_HOURS * 60)
+    time_ms = _minutes(MIDNIGHT_MS + 8 * 3600000, n + 10)
+    values = np.full(len(time_ms), 1.0)
+    values[n // 2] = 0.0
+    assert replay({"s": (time_ms, values)}) == []
+
+    gapped = np.concatenate([time_ms[:n // 2], time_ms[n // 2:] + 10 * MINUTE_MS])
+    assert replay({"s": (gapped, np.ones(len(gapped)))}) == []
+
+
+def test_night_spike_after_warmup():
+    time_ms, values = _quiet_days(NIGHT_WARMUP + 2)
+    last_night = time_ms >= MIDNIGHT_MS + (NIGHT_WARMUP + 1) * 86400000
+    values = np.where(last_night, values * 7.5, values)
+    events = replay({"s": (time_ms, values)})
+    assert [e["kind"] for e in events] == ["night_flow_spike"]
+    assert events[0]["value"] == 1.5
+    assert events[0]["baseline"] == 0.2
+
+
+def test_no_spike_during_warmup():
+    time_ms, values = _quiet_days(NIGHT_WARMUP)
+    values = np.where(time_ms >= MIDNIGHT_MS + (NIGHT_WARMUP - 1) * 86400000, values * 10, values)
+    assert replay({"s": (time_ms, values)}) == []
+
+
+def test_feeding_in_pieces_matches_one_pass(tmp_path):
+    time_ms, values = _quiet_days(NIGHT_WARMUP + 2)
+    values = np.where(time_ms >= MIDNIGHT_MS + (NIGHT_WARMUP + 1) * 86400000, values * 8 + 0.1, values)
+    expected = [(e["kind"], e["start_ms"], e["end_ms"], e["value"]) for e in replay({"s": (time_ms, values)})]
+    assert expected
+
+    # A persisted detector reloaded between pieces, with overlapping pieces, raises the same events once
+    pieces = np.array_split(np.arange(len(time_ms)), 7)
+    events = []
+    for piece in pieces:
+        detector = LeakDetector(root=str(tmp_path))
+        lo = max(0, piece[0] - 30)
+        events += detector.feed("s", time_ms[lo:piece[-1] + 1], values[lo:piece[-1] + 1])
+    assert [(e["kind"], e["start_ms"], e["end_ms"], e["value"]) for e in events] == expected
+    assert len(read_events(["s"], root=str(tmp_path))) == len(expected)
+
+
+def test_catch_up_reads_held_settled_rows(tmp_path):
+    root = str(tmp_path)
+    now = int(time.time())
+    start = (now // 86400 - 2) * 86400
+    time_ms = _minutes(start * 1000, int(CONTINUOUS_FLOW_HOURS * 60) + 5)
+    rows = pd.DataFrame({'time': time_ms, 'series': 2.0})
+    timeseries_store.write_rows("s", rows, leak_detector.RATE, leak_detector.SERIES,
+                                covered=(start, int(time_ms[-1] // 1000) + 60), root=root)
+    detector = LeakDetector(root=root, clock=lambda: now)
+    assert [e["kind"] for e in detector.catch_up("s")] == ["continuous_flow"]
+    # Nothing new is held, so a second catch_up raises nothing
+    assert detector.catch_up("s") == []
@@ -0,0 +1,106 @@
+import gzip
+import logging
+
+import pytest
+
+from Alertlab_api.log_shipper import S3LogShipper
+from Alertlab_api.mock_server import MockS3
+
+
+class FailingS3(MockS3):
+    def __init__(self):
+        super().__init__()
+        self.down = True
+
+    def put_object(self, **kwargs):
+        if self.down:
+            raise ConnectionError("S3 unreachable")
+        return super().put_object(**kwargs)
+
+
+@pytest.fixture
+def clock():
+    return {"now": 1000.0}
+
+
+def _shipper(s3, clock, **kwargs):
+    options = dict(max_segment_bytes=100, max_segment_seconds=60, max_buffer_bytes=1000, clock=lambda: clock["now"], start_thread=False)
+    options.update(kwargs)
+    shipper = S3LogShipper(s3, "bucket", "logs/", **options)
+    shipper.setFormatter(logging.Formatter("%(message)s"))
+    logger = logging.getLogger(f"test-log-shipper-{id(shipper)}")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(shipper)
+    return shipper, logger
+
+
+def _uploaded(s3, shipper, sequence):
+    return gzip.decompress(s3.get_object(Bucket="bucket", Key=shipper.key_for(sequence))["Body"].read()).decode()
+
+
+def test_segment_is_sealed_at_max_segment_bytes(clock):
+    s3 = MockS3()
+    shipper, logger = _shipper(s3, clock)
+    for i in range(5):
+        logger.info(f"record {i:02d} " + "x" * 30)  # 41 bytes a line, a segment is full after three
+    assert shipper.flush(force=False) == 1
+    assert _uploaded(s3, shipper, 1).splitlines() == [f"record {i:02d} " + "x" * 30 for i in range(3)]
+    # The two records of the open segment are still held, and go out with a forced flush
+    assert shipper.buffered_bytes() == 82
+    assert shipper.flush() == 1
+    assert _uploaded(s3, shipper, 2).count("\n") == 2
+    assert shipper.buffered_bytes() == 0
+
+
+def test_segment_is_rotated_after_max_segment_seconds(clock):
+    s3 = MockS3()
+    shipper, logger = _shipper(s3, clock)
+    logger.info("short")
+    assert shipper.flush(force=False) == 0
+    clock["now"] += 61
+    assert shipper.flush(force=False) == 1
+    assert _uploaded(s3, shipper, 1) == "short\n"
+
+
+def test_buffer_is_capped_while_s3_is_down(clock):
+    s3 = FailingS3()
+    shipper, logger = _shipper(s3, clock, max_buffer_bytes=300)
+    for i in range(40):
+        logger.info(f"record {i:02d} " + "x" * 30)
+        shipper.flush(force=False)
+    assert shipper.buffered_bytes() <= 300
+    assert shipper.uploaded_segments == 0
+
+    s3.down = False
+    shipper.flush()
+    # The oldest segments were dropped, and the first segment uploaded afterwards says so
+    first = min(int(key.split("part-")[1][:5]) for _, key in s3._objects)
+    text = _uploaded(s3, shipper, first)
+    assert "bytes of earlier log records dropped" in text.splitlines()[0]
+    assert "record 39" in _uploaded(s3, shipper, shipper._sequence)
+    assert shipper.buffered_bytes() == 0
+
+
+def test_failed_upload_keeps_the_segment_queued(clock):
+    s3 = FailingS3()
+    shipper, logger = _shipper(s3, clock)
+    logger.info("kept")
+    assert shipper.flush() == 0
+    assert shipper.getvalue() == "kept\n"
+    s3.down = False
+    assert shipper.flush() == 1
+    assert _uploaded(s3, shipper, 1) == "kept\n"
+
+
+def test_close_uploads_what_is_left(clock):
+    s3 = MockS3()
+    shipper, logger = _shipper(s3, clock)
+    logger.info("last words")
+    shipper.close()
+    assert _uploaded(s3, shipper, 1) == "last words\n"
+
+
+def test_no_bucket_uploads_nothing(clock):
+    shipper = S3LogShipper(MockS3(), None, "logs/", clock=lambda: clock["now"], start_thread=False)
+    assert shipper.flush() == 0
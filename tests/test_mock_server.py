@@ -0,0 +1,87 @@
+import json
+
+import numpy as np
+import pytest
+import requests
+
+from Alertlab_api import alertlab_api
+from Alertlab_api.mock_server import MockAlertLabs, start_mock_server, synthetic_values, MOCK_TOKEN, RATE_MS
+from Alertlab_api.rate_limiter import RequestScheduler, get_scheduler, set_scheduler
+
+START = 1_700_000_000 // 86400 * 86400
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(mock):
+        server, url = start_mock_server(mock)
+        servers.append(server)
+        return url
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def test_timeseries_is_deterministic_and_inclusive(serve):
+    url = serve(MockAlertLabs())
+    query = {"sensorID": "sensor-0", "from": START, "to": START + 3600, "rate": "m"}
+    first = requests.get(f"{url}/api/v4/public/timeseries", params=query).json()["dataModel"]["sensor-0"]
+    again = requests.get(f"{url}/api/v4/public/timeseries", params=query).json()["dataModel"]["sensor-0"]
+    assert first == again
+    assert len(first) == 61
+    assert first[-1][0] == (START + 3600) * 1000
+
+
+@pytest.mark.parametrize("coarse", ["sample", "sum"])
+def test_coarse_buckets(coarse):
+    minutes = synthetic_values("sensor-0", START * 1000 + np.arange(60) * RATE_MS["m"])
+    hourly = synthetic_values("sensor-0", [START * 1000], "h", coarse)[0]
+    expected = minutes.sum() if coarse == "sum" else minutes[0] * 60
+    assert hourly == pytest.approx(expected, abs=1e-3)
+
+
+def test_unknown_sensor_is_an_api_error(serve):
+    url = serve(MockAlertLabs())
+    body = requests.get(f"{url}/api/v4/public/timeseries", params={"sensorID": "nope", "from": START, "to": START + 60}).json()
+    assert body["error"] and body["dataModel"] is None
+
+
+def test_rate_limit_answers_429_with_retry_after(serve):
+    mock = MockAlertLabs(requests_per_hour=3600, burst=2)
+    url = serve(mock)
+    statuses = [requests.get(f"{url}/api/v4/public/sensors") for _ in range(3)]
+    assert [r.status_code for r in statuses] == [200, 200, 429]
+    assert int(statuses[2].headers["Retry-After"]) >= 1
+    assert mock.throttled == 1
+
+
+def test_client_waits_out_the_mock_429(serve):
+    mock = MockAlertLabs(n_sensors=2, requests_per_hour=3600, burst=1)
+    url = serve(mock)
+    base_url, api_url, scheduler = alertlab_api.ALERTAQ_URL, alertlab_api.ALERTAQ_API_URL, get_scheduler()
+    alertlab_api.set_base_url(url)
+    # The client's own bucket is generous, so only the server's Retry-After slows it down
+    set_scheduler(RequestScheduler(requests_per_hour=3600 * 1000, burst=100))
+    try:
+        assert len(alertlab_api.get_all_sensors(MOCK_TOKEN)) == 2
+        assert len(alertlab_api.get_all_sensors(MOCK_TOKEN)) == 2
+        assert get_scheduler().stats()["retries"] == 1
+        assert mock.throttled == 1
+    finally:
+        alertlab_api.set_base_url(base_url, api_url)
+        set_scheduler(scheduler)
+
+
+def test_fixtures_replace_generated_listings(serve, tmp_path):
+    sensors = [{"_id": "real-1", "name": "Kitchen", "friendlyType": "Flowie", "location_id": "loc-a"}]
+    details = [{"_id": "loc-a", "numberSuites": 12}]
+    (tmp_path / "sensors.json").write_text(json.dumps(sensors))
+    (tmp_path / "property_details.json").write_text(json.dumps(details))
+    url = serve(MockAlertLabs(fixtures_dir=str(tmp_path)))
+    assert requests.get(f"{url}/api/v4/public/sensors").json()["dataModel"] == sensors
+    read = requests.post(f"{url}/api/v4/dataModel/read", json={"locationsV2": {"where": {"_id": {"$in": ["loc-a"]}}}}).json()
+    assert read["dataModel"] == details
+    # Listings without a fixture are still generated
+    assert requests.get(f"{url}/api/v4/public/locations").json()["dataModel"]
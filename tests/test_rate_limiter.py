@@ -0,0 +1,111 @@
+import time
+from email.utils import formatdate
+
+import pytest
+
+from Alertlab_api.rate_limiter import RequestScheduler, TokenBucket, parse_retry_after, DEFAULT_RETRY_AFTER, BACKGROUND
+
+
+class FakeClock:
+    """time.monotonic / time.sleep stand-ins: sleeping moves the clock forward, nothing really waits."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class FakeResponse:
+    def __init__(self, status_code, retry_after=None):
+        self.status_code = status_code
+        self.headers = {} if retry_after is None else {"Retry-After": retry_after}
+
+
+def _sender(responses, clock):
+    """send() for RequestScheduler.execute returning the given responses in turn, noting when each was sent."""
+    sent_at = []
+    responses = list(responses)
+
+    def send():
+        sent_at.append(clock())
+        return responses.pop(0)
+    return send, sent_at
+
+
+def _scheduler(clock, **kwargs):
+    return RequestScheduler(requests_per_hour=3600, burst=5, clock=clock, sleep=clock.sleep, **kwargs)
+
+
+def test_429_waits_for_retry_after_then_retries():
+    clock = FakeClock()
+    scheduler = _scheduler(clock)
+    send, sent_at = _sender([FakeResponse(429, "7"), FakeResponse(200)], clock)
+
+    response = scheduler.execute(send)
+
+    assert response.status_code == 200
+    assert len(sent_at) == 2
+    assert sent_at[1] - sent_at[0] == pytest.approx(7.0)
+    stats = scheduler.stats()
+    assert stats["throttled"] == 1
+    assert stats["retries"] == 1
+
+
+def test_retry_after_pauses_every_caller():
+    clock = FakeClock()
+    scheduler = _scheduler(clock)
+    scheduler.throttle(12)
+    waited = scheduler.acquire(BACKGROUND)
+    assert waited == pytest.approx(12.0)
+    assert scheduler.stats()["retries"] == 0
+
+
+def test_503_with_retry_after_is_retried_but_not_without():
+    clock = FakeClock()
+    scheduler = _scheduler(clock)
+    send, sent_at = _sender([FakeResponse(503, "2"), FakeResponse(503), FakeResponse(200)], clock)
+
+    response = scheduler.execute(send)
+
+    assert response.status_code == 503
+    assert len(sent_at) == 2
+
+
+def test_gives_up_after_max_retries_with_the_last_response():
+    clock = FakeClock()
+    scheduler = _scheduler(clock, max_retries=2)
+    send, sent_at = _sender([FakeResponse(429, "1")] * 3, clock)
+
+    response = scheduler.execute(send)
+
+    assert response.status_code == 429
+    assert len(sent_at) == 3
+    assert scheduler.stats()["retries"] == 2
+
+
+def test_burst_then_one_request_per_second():
+    clock = FakeClock()
+    scheduler = RequestScheduler(requests_per_hour=3600, burst=2, clock=clock, sleep=clock.sleep)
+    waits = [scheduler.acquire() for _ in range(4)]
+    assert waits == pytest.approx([0.0, 0.0, 1.0, 1.0])
+
+
+def test_throttle_drains_the_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(1.0, 5, clock)
+    bucket.drain()
+    assert bucket.time_until_available() == pytest.approx(1.0)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after("-3") == 0.0
+    assert parse_retry_after(None) == DEFAULT_RETRY_AFTER
+    assert parse_retry_after("soon") == DEFAULT_RETRY_AFTER
+    assert 0 < parse_retry_after(formatdate(time.time() + 60, usegmt=True)) <= 60
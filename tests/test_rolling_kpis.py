@@ -0,0 +1,39 @@
+import numpy as np
+
+from Client_data_processing.rolling_kpis import RollingKpiState, kpi_ratio, HOUR_MS, WINDOW_HOURS
+
+
+def _week_of(value, end_ms=1_700_000_000 // 3600 * HOUR_MS):
+    state = RollingKpiState(["sensor-0"])
+    grid = np.arange(end_ms - WINDOW_HOURS * HOUR_MS, end_ms, HOUR_MS)
+    state.advance(grid, np.full(len(grid), value), end_ms)
+    return state
+
+
+def test_all_zero_week_gives_zero_kpis_and_no_ratio():
+    kpis = _week_of(0.0).kpis()
+    assert kpis["hours"] == WINDOW_HOURS
+    assert kpis["seven_day_mean"] == 0.0
+    assert kpis["night_mean"] == 0.0
+    # The dashboard's Ratio and per suite KPIs divide by these; a week without water must not raise
+    assert np.isnan(kpi_ratio(kpis["night_mean"], kpis["seven_day_mean"]))
+    assert np.isnan(kpi_ratio(kpis["night_mean"], 0))
+
+
+def test_kpis_are_numpy_floats():
+    kpis = _week_of(2.0).kpis()
+    for name in ("night_mean", "night_median", "seven_day_mean"):
+        assert isinstance(kpis[name], np.float64)
+    assert kpi_ratio(kpis["night_mean"], kpis["seven_day_mean"]) == 1.0
+
+
+def test_kpi_ratio_of_missing_values_is_nan():
+    assert np.isnan(kpi_ratio(1.0, np.nan))
+    assert np.isnan(kpi_ratio(1.0, None))
+    assert np.isnan(kpi_ratio(None, 4))
+    assert kpi_ratio(6.0, 4) == 1.5
+
+
+def test_empty_state_has_no_kpis():
+    kpis = RollingKpiState(["sensor-0"]).kpis()
+    assert np.isnan(kpis["night_mean"]) and np.isnan(kpis["seven_day_mean"])
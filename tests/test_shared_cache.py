@@ -0,0 +1,115 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from Alertlab_api import timeseries_store
+from Alertlab_api.mock_server import MockS3
+from Alertlab_api.shared_cache import SharedDayCache, DiskLRU
+
+SENSOR = "sensor-0"
+DAY_START = (int(time.time()) // 86400 - 10) * 86400
+DAY = timeseries_store._day_of(DAY_START * 1000)
+
+
+class RacingS3(MockS3):
+    """MockS3 whose head_object waits until `parties` callers have checked, so they all see the day unpublished."""
+
+    def __init__(self, parties, directory=None):
+        super().__init__(directory)
+        self._barrier = threading.Barrier(parties, timeout=10)
+
+    def head_object(self, **kwargs):
+        try:
+            return super().head_object(**kwargs)
+        finally:
+            self._barrier.wait()
+
+
+def _replica(s3, tmp_path, name, offset=0.0):
+    """A replica's cache and local store, holding DAY of minute data (its values shifted by offset)."""
+    root = str(tmp_path / name / "store")
+    time_ms = (DAY_START + np.arange(0, 86400, 60)) * 1000
+    rows = pd.DataFrame({'time': time_ms, 'series': np.arange(len(time_ms)) % 7 + offset})
+    timeseries_store.write_rows(SENSOR, rows, "m", "W", covered=(DAY_START, DAY_START + 86400), root=root)
+    cache = SharedDayCache(s3, "bucket", local=DiskLRU(str(tmp_path / name / "lru"), 10 * 1024 * 1024), start_thread=False)
+    return cache, root
+
+
+def test_concurrent_publishers_agree_on_one_day(tmp_path):
+    s3 = RacingS3(parties=2)
+    first, first_root = _replica(s3, tmp_path, "a", offset=0.0)
+    second, second_root = _replica(s3, tmp_path, "b", offset=0.5)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        created = list(executor.map(lambda c: c[0].publish_day(SENSOR, DAY, "m", "W", c[1]),
+                                    [(first, first_root), (second, second_root)]))
+
+    # Both saw the day unpublished, IfNoneMatch let exactly one pointer through
+    assert sorted(created) == [False, True]
+    assert first.stats["published"] + second.stats["published"] == 1
+    assert first.stats["already_published"] + second.stats["already_published"] == 1
+    # Every replica reads the winner's rows, including the one that lost
+    winner, loser = (first, second) if created[0] else (second, first)
+    assert winner.get_day(SENSOR, DAY, "m", "W")['series'].equals(loser.get_day(SENSOR, DAY, "m", "W")['series'])
+    expected_offset = 0.0 if winner is first else 0.5
+    assert loser.get_day(SENSOR, DAY, "m", "W")['series'].min() == expected_offset
+
+
+def test_put_if_none_match_lets_one_writer_win_on_disk(tmp_path):
+    s3 = MockS3(directory=str(tmp_path / "s3"))
+    cache = SharedDayCache(s3, "bucket", local=DiskLRU(str(tmp_path / "lru"), 1024), start_thread=False)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        created = list(executor.map(lambda i: cache._put_if_absent("key", f"writer {i}".encode()), range(8)))
+    assert created.count(True) == 1
+    assert s3.get_object(Bucket="bucket", Key="key")["Body"].read() == f"writer {created.index(True)}".encode()
+
+
+def test_published_day_fills_another_replicas_gap(tmp_path):
+    s3 = MockS3()
+    publisher, publisher_root = _replica(s3, tmp_path, "a")
+    assert publisher.publish_day(SENSOR, DAY, "m", "W", publisher_root)
+    assert not publisher.publish_day(SENSOR, DAY, "m", "W", publisher_root)
+
+    reader = SharedDayCache(s3, "bucket", local=DiskLRU(str(tmp_path / "b" / "lru"), 10 * 1024 * 1024), start_thread=False)
+    reader_root = str(tmp_path / "b" / "store")
+    now = int(time.time())
+    gaps = [(DAY_START - 3600, now)]
+    left = reader.fill_gaps(SENSOR, gaps, "m", "W", reader_root)
+
+    # The published day is now held locally; the hour before it and the open days after it are still missing
+    assert left[0] == (DAY_START - 3600, DAY_START)
+    assert left[1][0] == DAY_START + 86400
+    held = timeseries_store.read_rows(SENSOR, DAY_START, DAY_START + 86399, "m", "W", reader_root)
+    original = timeseries_store.read_rows(SENSOR, DAY_START, DAY_START + 86399, "m", "W", publisher_root)
+    assert held['series'].equals(original['series'])
+    assert reader.stats["hits"] == 1
+
+
+def test_open_or_partial_days_are_not_published(tmp_path):
+    s3 = MockS3()
+    cache = SharedDayCache(s3, "bucket", local=DiskLRU(str(tmp_path / "lru"), 1024), start_thread=False)
+    root = str(tmp_path / "store")
+    today = timeseries_store._day_of(int(time.time()) * 1000)
+    assert not cache.publish_day(SENSOR, today, "m", "W", root)
+    # Held for only half the day
+    rows = pd.DataFrame({'time': [DAY_START * 1000], 'series': [1.0]})
+    timeseries_store.write_rows(SENSOR, rows, "m", "W", covered=(DAY_START, DAY_START + 43200), root=root)
+    assert not cache.publish_day(SENSOR, DAY, "m", "W", root)
+    assert s3.calls["put_object"] == 0
+
+
+def test_corrupt_object_is_not_served(tmp_path):
+    s3 = MockS3()
+    publisher, root = _replica(s3, tmp_path, "a")
+    publisher.publish_day(SENSOR, DAY, "m", "W", root)
+    pointer_key = publisher.pointer_key(SENSOR, "m", "W", DAY)
+    object_key = publisher._pointers[pointer_key]["object"]
+    s3._objects[("bucket", object_key)] = b"not the parquet that was published"
+
+    reader = SharedDayCache(s3, "bucket", local=DiskLRU(str(tmp_path / "b" / "lru"), 1024 * 1024), start_thread=False)
+    gaps = [(DAY_START, DAY_START + 86400)]
+    assert reader.fill_gaps(SENSOR, gaps, "m", "W", str(tmp_path / "b" / "store")) == gaps
+    assert reader.stats["errors"] == 1